@@ -0,0 +1,370 @@
+"""
+Benchmark del pipeline DICOM sobre los estudios de ejemplo
+
+Mide, con un índice y caches vacíos en un directorio temporal:
+
+- get_dicom_studies en frío (construye el índice) y en caliente
+- extracción de metadatos (archivos/s); corre después de construir el
+  índice, así que los archivos ya están en el cache de páginas del sistema
+  operativo: mide el parseo, no la lectura del disco
+- latencia de render de un corte: sin caches, con los píxeles en cache
+  (otra ventana) y desde el cache de imágenes
+- scroll de la serie más grande: un request a la vez, en orden, como un
+  usuario bajando por los cortes (cortes/s y latencias)
+- RSS máximo del proceso después de cada sección (null en sistemas sin el
+  módulo resource, como Windows)
+
+Los renders que fallan no entran en las latencias: se cuentan aparte en
+"failures" (la ruta de los endpoints devolvería la imagen de error).
+
+Los resultados se guardan en JSON (por defecto en benchmarks/results/) junto
+con el commit, las versiones y la configuración, para comparar corridas con
+--compare.
+
+Uso:
+    python benchmarks/bench_dicom_pipeline.py [--folder data/dicom] [--slices 20]
+        [--format png] [--transcode] [--json salida.json] [--compare anterior.json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Configuración fija para que las corridas sean comparables (antes de importar el servicio)
+os.environ.setdefault("DICOM_PREFETCH_CONCURRENCY", "0")
+os.environ.setdefault("DICOM_TRANSCODE_ON_INGEST", "0")
+os.environ.setdefault("DICOM_DISK_CACHE_MB", "0")
+
+import numpy as np  # noqa: E402
+import pydicom  # noqa: E402
+
+from services.dicom_service import DicomService  # noqa: E402
+from services.dicom_imaging import build_render_params  # noqa: E402
+
+# Variables de entorno que cambian el resultado y se guardan con la corrida
+CONFIG_ENV = (
+    "DICOM_RENDER_MODE", "DICOM_RENDER_WORKERS", "DICOM_PIXEL_CACHE_MB", "DICOM_RENDER_CACHE_MB",
+    "DICOM_DISK_CACHE_MB", "DICOM_PNG_COMPRESS_LEVEL", "DICOM_METADATA_READ_MODE",
+    "DICOM_RENDER_READ_MODE", "DICOM_MEMMAP_PIXELS", "DICOM_PREFETCH_CONCURRENCY",
+    "DICOM_TRANSCODE_ON_INGEST"
+)
+
+# Métricas que compara --compare (sección, clave) y si menor es mejor
+COMPARED = (
+    ("studies", "cold_ms", True),
+    ("studies", "warm_ms_median", True),
+    ("metadata", "files_per_second", False),
+    ("render", "cold_ms_median", True),
+    ("render", "pixels_cached_ms_median", True),
+    ("render", "image_cached_ms_median", True),
+    ("scroll", "slices_per_second", False),
+    ("scroll", "p95_ms", True),
+    ("memory", "peak_rss_mb", True),
+)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """RSS máximo del proceso (ru_maxrss está en KB en Linux y en bytes en macOS)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _latency_summary(timings: List[float]) -> Dict[str, Any]:
+    if not timings:
+        return {"count": 0}
+    ordered = np.array(timings)
+    return {
+        "count": len(timings),
+        "mean_ms": round(float(ordered.mean()), 3),
+        "median_ms": round(float(np.percentile(ordered, 50)), 3),
+        "p95_ms": round(float(np.percentile(ordered, 95)), 3),
+        "max_ms": round(float(ordered.max()), 3)
+    }
+
+
+def _timed(function: Callable[[], Any]) -> float:
+    started = time.perf_counter()
+    function()
+    return (time.perf_counter() - started) * 1000
+
+
+def _timed_render(service: DicomService, path: str, params: Dict[str, Any]) -> Optional[float]:
+    """
+    Latencia de un render por la ruta que lanza excepciones (None si falló)
+
+    get_dicom_image devuelve la imagen de error en vez de fallar, y eso
+    contaría como un render rápido y exitoso.
+    """
+    started = time.perf_counter()
+    try:
+        service._render_cached(service._resolve_image_request(path), params)
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"⚠️ Render fallido {path}: {e}")
+        return None
+    return (time.perf_counter() - started) * 1000
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_studies(service: DicomService, repeats: int) -> Dict[str, Any]:
+    """get_dicom_studies con el índice vacío y luego ya construido"""
+    cold_ms = _timed(service.get_dicom_studies)
+    warm = [_timed(service.get_dicom_studies) for _ in range(repeats)]
+    return {
+        "instances": service.index.count(),
+        "cold_ms": round(cold_ms, 1),
+        "warm_ms_median": round(statistics.median(warm), 3),
+        "warm": _latency_summary(warm)
+    }
+
+
+def bench_metadata(service: DicomService, paths: List[str]) -> Dict[str, Any]:
+    """extract_dicom_metadata sobre todas las instancias"""
+    started = time.perf_counter()
+    errors = 0
+    for path in paths:
+        try:
+            service.extract_dicom_metadata(path)
+        except Exception:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    return {
+        "files": len(paths),
+        "errors": errors,
+        "read_mode": service.metadata_read_mode,
+        "os_page_cache": "warm",
+        "total_ms": round(elapsed * 1000, 1),
+        "files_per_second": round(len(paths) / elapsed, 1) if elapsed else None
+    }
+
+
+def bench_render(service: DicomService, paths: List[str], image_format: str) -> Dict[str, Any]:
+    """Latencia de un corte: sin caches, con píxeles en cache y con la imagen en cache"""
+    params = build_render_params(image_format=image_format)
+    other_window = build_render_params(preset="bone", image_format=image_format)
+    service.pixel_cache.clear()
+    service.render_cache.clear()
+
+    passes = {}
+    failures = 0
+    for name, render_params in (("cold", params), ("pixels_cached", other_window), ("image_cached", params)):
+        timings = [_timed_render(service, path, render_params) for path in paths]
+        failures += sum(timing is None for timing in timings)
+        passes[name] = [timing for timing in timings if timing is not None]
+    cold, pixels_cached, image_cached = passes["cold"], passes["pixels_cached"], passes["image_cached"]
+    return {
+        "slices": len(paths),
+        "format": image_format,
+        "failures": failures,
+        "cold_ms_median": _latency_summary(cold).get("median_ms"),
+        "pixels_cached_ms_median": _latency_summary(pixels_cached).get("median_ms"),
+        "image_cached_ms_median": _latency_summary(image_cached).get("median_ms"),
+        "cold": _latency_summary(cold),
+        "pixels_cached": _latency_summary(pixels_cached),
+        "image_cached": _latency_summary(image_cached)
+    }
+
+
+def bench_scroll(service: DicomService, image_format: str) -> Dict[str, Any]:
+    """Recorrer la serie más grande corte a corte por la ruta asíncrona (pool de render)"""
+    series = max(
+        (service.index.get_series_instance_paths(uid) for uid in _series_uids(service)),
+        key=len
+    )
+    params = build_render_params(image_format=image_format)
+    service.pixel_cache.clear()
+    service.render_cache.clear()
+
+    failures = []
+
+    async def scroll() -> List[float]:
+        timings = []
+        for path in series:
+            started = time.perf_counter()
+            try:
+                await service._render_cached_async(service._resolve_image_request(path), params)
+            except Exception as e:
+                logging.getLogger(__name__).warning(f"⚠️ Render fallido {path}: {e}")
+                failures.append(path)
+                continue
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    started = time.perf_counter()
+    timings = asyncio.run(scroll())
+    elapsed = time.perf_counter() - started
+    summary = _latency_summary(timings)
+    return {
+        "slices": len(series),
+        "format": image_format,
+        "failures": len(failures),
+        "render_mode": service.render_mode,
+        "total_ms": round(elapsed * 1000, 1),
+        "slices_per_second": round(len(series) / elapsed, 1) if elapsed else None,
+        "p95_ms": summary.get("p95_ms"),
+        "latency": summary
+    }
+
+
+def _series_uids(service: DicomService) -> List[str]:
+    return sorted({
+        study["series_instance_uid"] for study in service.index.list_instances()
+        if study.get("series_instance_uid") not in (None, "N/A")
+    })
+
+
+def run(folder: str, slices: int, image_format: str, transcode: bool) -> Dict[str, Any]:
+    memory = {"start_rss_mb": _peak_rss_mb()}
+    with tempfile.TemporaryDirectory() as cache_folder:
+        service = DicomService(dicom_folder=folder, cache_folder=cache_folder)
+        try:
+            studies = bench_studies(service, repeats=20)
+            memory["after_studies_mb"] = _peak_rss_mb()
+
+            paths = sorted(path for path, _ in service.index.iter_paths())
+            metadata = bench_metadata(service, paths)
+            memory["after_metadata_mb"] = _peak_rss_mb()
+
+            transcode_result = service.transcode_pending() if transcode else None
+
+            step = max(1, len(paths) // slices) if slices else 1
+            render = bench_render(service, paths[::step][:slices], image_format)
+            memory["after_render_mb"] = _peak_rss_mb()
+
+            service.metrics.reset()
+            scroll = bench_scroll(service, image_format)
+            memory["after_scroll_mb"] = _peak_rss_mb()
+            stages = service.get_pipeline_stats()["stages"]
+        finally:
+            service.shutdown()
+
+    memory["peak_rss_mb"] = _peak_rss_mb()
+    return {
+        "benchmark": "dicom_pipeline",
+        "timestamp": datetime.now().isoformat(),
+        "commit": _git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "pydicom": pydicom.__version__,
+            "config": {name: os.environ[name] for name in CONFIG_ENV if name in os.environ}
+        },
+        "folder": folder,
+        "studies": studies,
+        "metadata": metadata,
+        "transcode": transcode_result,
+        "render": render,
+        "scroll": dict(scroll, stages=stages),
+        "memory": memory
+    }
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Diferencias relativas de las métricas principales contra otra corrida"""
+    rows = []
+    for section, key, lower_is_better in COMPARED:
+        before = (previous.get(section) or {}).get(key)
+        after = (current.get(section) or {}).get(key)
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        improved = change < 0 if lower_is_better else change > 0
+        rows.append({
+            "metric": f"{section}.{key}",
+            "before": before,
+            "after": after,
+            "change_pct": round(change, 1),
+            "verdict": "mejor" if improved and abs(change) >= 5 else
+                       "peor" if not improved and abs(change) >= 5 else "igual"
+        })
+    return rows
+
+
+def _ms(value: Optional[float], decimals: int, width: int = 9) -> str:
+    """Latencia alineada o n/d si todos los renders de la sección fallaron"""
+    return f"{value:>{width}.{decimals}f}" if value is not None else f"{'n/d':>{width}}"
+
+
+def print_report(results: Dict[str, Any], comparison: Optional[List[Dict[str, Any]]] = None):
+    studies, metadata, render, scroll = (results[key] for key in ("studies", "metadata", "render", "scroll"))
+    print(f"\n📊 Pipeline DICOM — {studies['instances']} instancias en {results['folder']} "
+          f"(commit {results['commit'] or '?'})\n")
+    print(f"  get_dicom_studies   frío {studies['cold_ms']:>9.1f} ms   caliente {studies['warm_ms_median']:>8.3f} ms")
+    print(f"  metadatos           {metadata['files_per_second']:>9.1f} archivos/s ({metadata['read_mode']}, "
+          f"cache de páginas del SO caliente)")
+    print(f"  render {render['format']:<5}        frío {_ms(render['cold_ms_median'], 1)} ms   "
+          f"píxeles en cache {_ms(render['pixels_cached_ms_median'], 1, 7)} ms   "
+          f"imagen en cache {_ms(render['image_cached_ms_median'], 3, 7)} ms   "
+          f"fallidos {render['failures']}")
+    print(f"  scroll {scroll['slices']} cortes    {scroll['slices_per_second']:>9.1f} cortes/s   "
+          f"p95 {_ms(scroll['p95_ms'], 1, 7)} ms ({scroll['render_mode']})   fallidos {scroll['failures']}")
+    peak_rss = results['memory']['peak_rss_mb']
+    print(f"  RSS máximo          {f'{peak_rss:>9.1f} MB' if peak_rss is not None else '      n/d (sin módulo resource)'}")
+
+    if comparison:
+        print(f"\n{'métrica':<34}{'antes':>12}{'ahora':>12}{'cambio':>10}  ")
+        for row in comparison:
+            print(f"{row['metric']:<34}{row['before']:>12}{row['after']:>12}{row['change_pct']:>9.1f}%  {row['verdict']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline DICOM")
+    parser.add_argument("--folder", default=os.getenv("DICOM_FOLDER", "data/dicom"))
+    parser.add_argument("--slices", type=int, default=20, help="cortes para la latencia de render")
+    parser.add_argument("--format", dest="image_format", default="png", choices=("png", "webp", "jpeg"))
+    parser.add_argument("--transcode", action="store_true",
+                        help="transcodificar las instancias comprimidas antes de medir el render")
+    parser.add_argument("--json", dest="json_path",
+                        help="archivo de resultados (por defecto benchmarks/results/pipeline-<fecha>.json)")
+    parser.add_argument("--compare", dest="compare_path", help="resultados anteriores para comparar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.folder, args.slices, args.image_format, args.transcode)
+
+    comparison = None
+    if args.compare_path:
+        with open(args.compare_path, 'r', encoding='utf-8') as file:
+            comparison = compare(results, json.load(file))
+        results["comparison"] = {"against": args.compare_path, "metrics": comparison}
+    print_report(results, comparison)
+
+    json_path = args.json_path or os.path.join(
+        ROOT, "benchmarks", "results", f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+    with open(json_path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultados guardados en {json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark de modos de lectura DICOM
+
+Compara, sobre los estudios de ejemplo, el tiempo y los bytes leídos por
+archivo con cada modo de read_dicom_dataset:
+
+- Metadatos: full (lectura original) vs header vs tags
+- Render: full + pixel_array vs deferred + pixel_array
+
+Uso:
+    python benchmarks/bench_dicom_read.py [--folder data/dicom] [--limit 200] [--json salida.json]
+
+Los bytes leídos salen de /proc/self/io (rchar); en sistemas sin /proc se
+informan como null.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import statistics
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.dicom_service import DicomService, read_dicom_dataset  # noqa: E402
+
+
+def _bytes_read() -> Optional[int]:
+    """Bytes leídos por el proceso hasta ahora (rchar de /proc/self/io)"""
+    try:
+        with open('/proc/self/io', 'r') as file:
+            for line in file:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def list_sample_files(folder: str, limit: int) -> List[str]:
+    """Instancias indexadas (incluye las referenciadas por DICOMDIR)"""
+    with tempfile.TemporaryDirectory() as cache_folder:
+        service = DicomService(dicom_folder=folder, cache_folder=cache_folder)
+        service.rebuild_index(full=True)
+        paths = sorted(path for path, _ in service.index.iter_paths())
+    return paths[:limit] if limit else paths
+
+
+def measure(name: str, paths: List[str], read: Callable[[str], Any]) -> Dict[str, Any]:
+    """Tiempo y bytes leídos por archivo para una función de lectura"""
+    timings = []
+    bytes_per_file = []
+    errors = 0
+    for path in paths:
+        before = _bytes_read()
+        started = time.perf_counter()
+        try:
+            read(path)
+        except Exception:
+            errors += 1
+            continue
+        timings.append((time.perf_counter() - started) * 1000)
+        after = _bytes_read()
+        if before is not None and after is not None:
+            bytes_per_file.append(after - before)
+
+    return {
+        "mode": name,
+        "files": len(timings),
+        "errors": errors,
+        "ms_per_file_mean": round(statistics.mean(timings), 3) if timings else None,
+        "ms_per_file_median": round(statistics.median(timings), 3) if timings else None,
+        "bytes_per_file_mean": int(statistics.mean(bytes_per_file)) if bytes_per_file else None,
+        "total_ms": round(sum(timings), 1)
+    }
+
+
+def _read_with_pixels(mode: str) -> Callable[[str], Any]:
+    def read(path: str):
+        ds = read_dicom_dataset(path, mode, force=True)
+        return ds.pixel_array
+    return read
+
+
+def run(folder: str, limit: int) -> Dict[str, Any]:
+    paths = list_sample_files(folder, limit)
+    results = {
+        "folder": folder,
+        "files": len(paths),
+        "metadata": [
+            measure(mode, paths, lambda path, mode=mode: read_dicom_dataset(path, mode, force=True))
+            for mode in ("full", "header", "tags")
+        ],
+        "render": [
+            measure(f"{mode}+pixels", paths, _read_with_pixels(mode))
+            for mode in ("full", "deferred")
+        ]
+    }
+    return results
+
+
+def print_table(results: Dict[str, Any]):
+    print(f"\n📊 {results['files']} archivos en {results['folder']}\n")
+    print(f"{'grupo':<10}{'modo':<18}{'ms/archivo':>12}{'mediana':>10}{'bytes/archivo':>16}{'errores':>9}")
+    for group in ("metadata", "render"):
+        for row in results[group]:
+            print(
+                f"{group:<10}{row['mode']:<18}{row['ms_per_file_mean'] or 0:>12.3f}"
+                f"{row['ms_per_file_median'] or 0:>10.3f}{row['bytes_per_file_mean'] or 0:>16,}{row['errors']:>9}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de modos de lectura DICOM")
+    parser.add_argument("--folder", default=os.getenv("DICOM_FOLDER", "data/dicom"))
+    parser.add_argument("--limit", type=int, default=0, help="máximo de archivos (0 = todos)")
+    parser.add_argument("--json", dest="json_path", help="guardar los resultados en este archivo")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.folder, args.limit)
+    print_table(results)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultados guardados en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, FileResponse, Response
 from pydantic import BaseModel
 import logging
 import os
 from datetime import datetime
 from typing import Dict, List, Optional, Any
 import io
+import json
 import asyncio
 
 # ===== TUS SERVICIOS EXISTENTES (CONSERVAMOS TODO) =====
@@ -26,7 +27,8 @@ from services.vital_signs_service import VitalSignsManager
 from fastapi import WebSocket, WebSocketDisconnect
 
 # ===== NUEVO SERVICIO DE DICOM =====
-from services.dicom_service import DicomService
+from services.dicom_service import DicomService, DicomRenderBusyError
+from services.dicom_imaging import build_render_params, negotiate_image_format, IMAGE_FORMATS, WINDOW_PRESETS
 
 
 # Configurar logging
@@ -333,35 +335,91 @@ async def refresh_token_api(username: str):
 async def get_dicom_studies():
     """Obtener lista de estudios DICOM disponibles"""
     try:
-        studies = dicom_service.get_dicom_studies()
+        studies = await dicom_service.get_dicom_studies_async()
         return studies
     except Exception as e:
         logger.error(f"Error obteniendo estudios DICOM: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error obteniendo estudios DICOM: {str(e)}")
 
+async def _iter_open_file(source, chunk_size: int = 256 * 1024):
+    """Enviar un archivo ya abierto por bloques (lecturas fuera del event loop) y cerrarlo al final"""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, source.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        source.close()
+
 @app.get("/api/dicom/image")
-async def get_dicom_image(file_path: str):
-    """Convertir archivo DICOM a imagen PNG - VERSIÓN CORREGIDA"""
+async def get_dicom_image(
+    request: Request,
+    file_path: str,
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: Optional[str] = None,
+    quality: Optional[int] = None,
+    auto_window: bool = False
+):
+    """
+    Convertir archivo DICOM a imagen (PNG, WebP o JPEG) - VERSIÓN CORREGIDA
+    
+    - wc / ww: centro y ancho de ventana en unidades reescaladas (HU en CT)
+    - preset: ventana predefinida (brain, bone, lung, ...); wc/ww la sobreescriben
+    - auto_window: ventana entre los percentiles 1 y 99 del corte (si no hay wc/ww/preset)
+    - invert: invertir escala de grises
+    - size: lado máximo de la miniatura (64, 128 o 256); sin él, resolución completa
+    - format: png, webp (sin pérdida) o jpeg; sin él se negocia con Accept
+    - quality: calidad JPEG (1-95)
+    """
+    try:
+        image_format = negotiate_image_format(request.headers.get("accept"), format)
+        render_params = build_render_params(wc=wc, ww=ww, preset=preset, invert=invert, size=size,
+                                            image_format=image_format, quality=quality,
+                                            auto_window=auto_window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    media_type = IMAGE_FORMATS[image_format]
+    
     try:
         logger.info(f"🖼️ Solicitud de imagen DICOM: {file_path}")
         
         # ✅ CORRECCIÓN: NO validar archivo aquí, dejar que DicomService lo maneje
         # El DicomService tiene la lógica completa de búsqueda de archivos
         
-        # Obtener los bytes de la imagen directamente del servicio
-        image_bytes = dicom_service.get_dicom_image(file_path)
+        # Si está en el cache de disco se envía desde el archivo ya abierto (sin re-decodificar)
+        # La conversión corre en el pool de renderizado, no en el event loop
+        cached_file, image_bytes = await dicom_service.get_dicom_image_or_file_async(file_path, render_params)
+        if cached_file is not None:
+            return StreamingResponse(
+                _iter_open_file(cached_file),
+                media_type=media_type,
+                headers={
+                    "Content-Length": str(os.fstat(cached_file.fileno()).st_size),
+                    "Cache-Control": "max-age=3600",
+                    "Vary": "Accept"
+                }
+            )
         
         logger.info(f"✅ Imagen DICOM convertida: {file_path} ({len(image_bytes)} bytes)")
         
-        return StreamingResponse(
-            io.BytesIO(image_bytes),
-            media_type="image/png",
-            headers={
-                "Cache-Control": "max-age=3600",
-                "Content-Type": "image/png"
-            }
+        return Response(
+            content=image_bytes,
+            media_type=media_type,
+            headers={"Cache-Control": "max-age=3600", "Vary": "Accept"}
         )
         
+    except DicomRenderBusyError as e:
+        logger.warning(f"⏳ {e}")
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        logger.error(f"⏱️ Timeout renderizando imagen DICOM: {file_path}")
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
     except Exception as e:
         # Logging detallado del error
         logger.error(f"💥 Error en endpoint DICOM: {str(e)}")
@@ -376,12 +434,11 @@ async def get_dicom_image(file_path: str):
         error_detail = f"Error procesando imagen DICOM: {str(e)}"
         logger.error(f"🚨 Error 500: {error_detail}")
         raise HTTPException(status_code=500, detail=error_detail)
-
         
 @app.get("/api/dicom/health")
 async def dicom_health_check():
     """Health check para servicio DICOM"""
-    return dicom_service.health_check()
+    return await dicom_service.health_check_async()
 
 @app.get("/api/hospital/structure")
 async def get_hospital_structure():
@@ -668,6 +725,73 @@ async def websocket_endpoint(websocket: WebSocket):
         vital_signs_service.connected_clients.remove(websocket) 
 
 
+@app.websocket("/ws/dicom/cine/{series_uid}")
+async def dicom_cine_websocket(
+    websocket: WebSocket,
+    series_uid: str,
+    fps: float = 20,
+    loop: bool = True,
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: str = "jpeg",
+    quality: Optional[int] = None
+):
+    """
+    Reproducción cine de una serie DICOM
+    
+    Envía frames binarios (4 bytes de índice + imagen) al fps pedido y acepta
+    mensajes de control JSON: play, pause, seek {index}, fps {value}, loop {value}
+    """
+    await websocket.accept()
+    session = None
+    try:
+        image_format = negotiate_image_format(None, format)
+        render_params = build_render_params(wc=wc, ww=ww, preset=preset, invert=invert, size=size,
+                                            image_format=image_format, quality=quality)
+        session = await dicom_service.create_cine_session_async(series_uid, render_params, fps=fps, loop=loop)
+    except (ValueError, FileNotFoundError) as e:
+        await websocket.send_json({"type": "error", "message": str(e)})
+        await websocket.close()
+        return
+    except (DicomRenderBusyError, asyncio.TimeoutError):
+        await websocket.send_json({"type": "error", "message": "Servidor DICOM ocupado, reintente en unos segundos"})
+        await websocket.close()
+        return
+    except Exception as e:
+        logger.error(f"💥 Error preparando cine DICOM: {e}")
+        await websocket.send_json({"type": "error", "message": "Error preparando la reproducción cine"})
+        await websocket.close()
+        return
+    
+    await websocket.send_json(dict(
+        session.get_state(), type="ready", media_type=IMAGE_FORMATS[image_format]
+    ))
+    
+    tasks = [
+        asyncio.create_task(session.play(websocket)),
+        asyncio.create_task(session.receive_controls(websocket))
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            if error and not isinstance(error, WebSocketDisconnect):
+                logger.error(f"💥 Error en cine DICOM: {error}")
+                await websocket.send_json({"type": "error", "message": str(error)})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"💥 Error en WebSocket cine DICOM: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        session.close()
+        logger.info(f"🎞️ Cine DICOM finalizado: {session.sent} frames enviados ({session.late} tarde)")
+
+
 @app.post("/api/vital-signs/{bed_id}/simulate")
 async def start_simulation(bed_id: str):
     """Iniciar simulación de signos vitales para una cama específica"""
@@ -730,50 +854,423 @@ async def test_vital_signs_file():
 # 🩻 APIs DICOM
 # ========================================
 
-@app.get("/api/dicom/studies")
-async def get_dicom_studies():
-    """Obtener lista de estudios DICOM disponibles"""
+@app.get("/api/dicom/window-presets")
+async def get_dicom_window_presets():
+    """Presets de ventana disponibles para /api/dicom/image"""
+    return {
+        name: {"wc": wc, "ww": ww}
+        for name, (wc, ww) in WINDOW_PRESETS.items()
+    }
+
+@app.get("/api/dicom/metadata/{file_name}")
+async def get_dicom_metadata(file_name: str):
+    """Obtener metadatos detallados de un archivo DICOM"""
     try:
-        return dicom_service.get_dicom_studies()
+        metadata = await dicom_service.get_dicom_metadata_async(file_name)
+        return metadata
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Archivo DICOM no encontrado")
     except Exception as e:
-        logger.error(f"Error en get_dicom_studies: {e}")
-        raise HTTPException(status_code=500, detail="Error obteniendo estudios DICOM")
+        logger.error(f"Error obteniendo metadatos DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error obteniendo metadatos DICOM")
 
-@app.get("/api/dicom/image")
-async def get_dicom_image(file_path: str):
-    """Convertir archivo DICOM a imagen PNG"""
+@app.get("/api/dicom/encode-stats")
+async def get_dicom_encode_stats():
+    """Tiempos medios de codificación por formato (para elegir el formato por defecto)"""
+    return {
+        "success": True,
+        "formats": list(IMAGE_FORMATS),
+        "stats": dicom_service.get_encode_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/api/dicom/pipeline-stats")
+async def get_dicom_pipeline_stats():
+    """Latencias p50/p95/p99 por etapa del render (resolve, dcmread, decode, ...) y por modalidad/sintaxis"""
+    return {
+        "success": True,
+        "stats": dicom_service.get_pipeline_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.post("/api/dicom/pipeline-stats/reset")
+async def reset_dicom_pipeline_stats():
+    """Reiniciar los histogramas de latencia del pipeline"""
+    dicom_service.metrics.reset()
+    return {"success": True, "timestamp": datetime.now().isoformat()}
+
+@app.get("/api/dicom/patients")
+async def get_dicom_patients(cursor: Optional[str] = None, limit: int = 50):
+    """Listar pacientes del índice DICOM (paginado por cursor)"""
+    try:
+        return await dicom_service.get_patients_async(cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listando pacientes DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error listando pacientes DICOM")
+
+@app.get("/api/dicom/search")
+async def search_dicom(
+    level: str = "studies",
+    patient_id: Optional[str] = Query(None, alias="PatientID"),
+    modality: Optional[str] = Query(None, alias="Modality"),
+    study_date: Optional[str] = Query(None, alias="StudyDate"),
+    body_part: Optional[str] = Query(None, alias="BodyPartExamined"),
+    description: Optional[str] = None,
+    includefield: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50
+):
+    """
+    Buscar estudios o series en el índice DICOM (estilo QIDO-RS)
+    
+    - level: studies o series
+    - PatientID, Modality, BodyPartExamined: coincidencia exacta
+    - StudyDate: AAAAMMDD, AAAAMMDD-, -AAAAMMDD o AAAAMMDD-AAAAMMDD
+    - description: subcadena de la descripción del estudio o de la serie
+    - includefield: campos a devolver separados por coma
+    """
+    fields = [name.strip() for name in includefield.split(",") if name.strip()] if includefield else None
+    try:
+        return await dicom_service.search_async(
+            level=level, patient_id=patient_id, modality=modality, study_date=study_date,
+            body_part=body_part, description=description, fields=fields, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error buscando en el índice DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error buscando en el índice DICOM")
+
+@app.get("/api/dicom/hierarchy/studies")
+async def get_dicom_study_list(patient_id: Optional[str] = None, cursor: Optional[str] = None, limit: int = 50):
+    """Listar estudios con conteos e instancia representativa (paginado por cursor)"""
+    try:
+        return await dicom_service.get_studies_page_async(patient_id=patient_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listando estudios DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error listando estudios DICOM")
+
+@app.get("/api/dicom/hierarchy/studies/{study_uid}/series")
+async def get_dicom_study_series(study_uid: str, cursor: Optional[str] = None, limit: int = 50):
+    """Listar las series de un estudio (paginado por cursor)"""
+    try:
+        return await dicom_service.get_study_series_async(study_uid, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listando series DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error listando series DICOM")
+
+@app.get("/api/dicom/hierarchy/series/{series_uid}/instances")
+async def get_dicom_series_instances(series_uid: str, cursor: Optional[str] = None, limit: int = 50):
+    """Listar las instancias de una serie (paginado por cursor)"""
+    try:
+        return await dicom_service.get_series_instances_async(series_uid, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listando instancias DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error listando instancias DICOM")
+
+@app.post("/api/dicom/index/rebuild")
+async def rebuild_dicom_index(full: bool = True):
+    """Reconstruir el índice de metadatos DICOM (full=false: solo cambios)"""
+    try:
+        return await dicom_service.rebuild_index_async(full=full)
+    except Exception as e:
+        logger.error(f"Error reconstruyendo índice DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error reconstruyendo índice DICOM")
+
+@app.post("/api/dicom/transcode")
+async def transcode_dicom_instances():
+    """Lanzar en segundo plano la transcodificación de las instancias comprimidas"""
+    try:
+        scheduled = dicom_service.schedule_transcode()
+        return dict(dicom_service.get_transcode_status(), scheduled=scheduled)
+    except Exception as e:
+        logger.error(f"Error lanzando transcodificación DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error lanzando transcodificación DICOM")
+
+@app.get("/api/dicom/stats")
+async def get_dicom_slice_stats(file_path: str):
+    """Histograma, min/max, media, percentiles y ventana automática de un corte"""
+    try:
+        return await dicom_service.get_slice_stats_async(file_path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
+    except Exception as e:
+        logger.error(f"Error calculando estadísticas DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error calculando estadísticas DICOM")
+
+@app.get("/api/dicom/stats/series/{series_uid}")
+async def get_dicom_series_stats(series_uid: str):
+    """Estadísticas de todos los píxeles de una serie (exactas, sumando los conteos de cada corte)"""
+    try:
+        return await dicom_service.get_series_stats_async(series_uid)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
+    except Exception as e:
+        logger.error(f"Error calculando estadísticas de la serie DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error calculando estadísticas de la serie DICOM")
+
+@app.get("/api/dicom/volume/{series_uid}")
+async def get_dicom_volume_info(series_uid: str):
+    """Ensamblar (o abrir) el volumen 3D de una serie y devolver sus dimensiones"""
+    try:
+        return await dicom_service.get_volume_info_async(series_uid)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
+    except Exception as e:
+        logger.error(f"Error construyendo volumen DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error construyendo volumen DICOM")
+
+@app.get("/api/dicom/mpr/{series_uid}")
+async def get_dicom_mpr(
+    request: Request,
+    series_uid: str,
+    plane: str = "axial",
+    index: Optional[int] = None,
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: Optional[str] = None,
+    quality: Optional[int] = None
+):
+    """
+    Reconstrucción multiplanar: corte axial, coronal o sagital del volumen
+    
+    - index: corte dentro del plano (por defecto, el central)
+    - wc / ww / preset / invert / size / format / quality: igual que /api/dicom/image
+    """
     try:
-        image_data = dicom_service.get_dicom_image(file_path)
+        image_format = negotiate_image_format(request.headers.get("accept"), format)
+        render_params = build_render_params(wc=wc, ww=ww, preset=preset, invert=invert, size=size,
+                                            image_format=image_format, quality=quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        if index is None:
+            info = await dicom_service.get_volume_info_async(series_uid)
+            if plane not in info["planes"]:
+                raise ValueError(f"Plano desconocido: {plane}")
+            index = info["planes"][plane] // 2
         
+        image_bytes = await dicom_service.render_mpr_async(series_uid, plane, index, render_params)
         return StreamingResponse(
-            io.BytesIO(image_data),
-            media_type="image/png",
-            headers={"Cache-Control": "max-age=3600"}
+            io.BytesIO(image_bytes),
+            media_type=IMAGE_FORMATS[image_format],
+            headers={"Cache-Control": "max-age=3600", "Vary": "Accept"}
         )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (ValueError, IndexError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
+    except Exception as e:
+        logger.error(f"Error generando MPR DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error generando reconstrucción multiplanar")
+
+@app.get("/api/dicom/slab/{series_uid}")
+async def get_dicom_slab(
+    request: Request,
+    series_uid: str,
+    mode: str = "mip",
+    plane: str = "axial",
+    index: Optional[int] = None,
+    thickness: int = 10,
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: Optional[str] = None,
+    quality: Optional[int] = None
+):
+    """
+    Proyección de slab grueso (mip, minip, avg) a lo largo de cualquier plano
+    
+    - index: corte central del slab (por defecto, el central del volumen)
+    - thickness: número de cortes del slab
+    - wc / ww / preset / invert / size / format / quality: igual que /api/dicom/image
+    """
+    try:
+        image_format = negotiate_image_format(request.headers.get("accept"), format)
+        render_params = build_render_params(wc=wc, ww=ww, preset=preset, invert=invert, size=size,
+                                            image_format=image_format, quality=quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        if index is None:
+            info = await dicom_service.get_volume_info_async(series_uid)
+            if plane not in info["planes"]:
+                raise ValueError(f"Plano desconocido: {plane}")
+            index = info["planes"][plane] // 2
         
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Archivo DICOM no encontrado")
+        image_bytes = await dicom_service.render_slab_async(
+            series_uid, plane, index, thickness, mode.lower(), render_params
+        )
+        return StreamingResponse(
+            io.BytesIO(image_bytes),
+            media_type=IMAGE_FORMATS[image_format],
+            headers={"Cache-Control": "max-age=3600", "Vary": "Accept"}
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (ValueError, IndexError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
     except Exception as e:
-        logger.error(f"Error convirtiendo imagen DICOM: {e}")
-        raise HTTPException(status_code=500, detail="Error procesando imagen DICOM")
+        logger.error(f"Error generando slab DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error generando proyección de slab")
 
-@app.get("/api/dicom/metadata/{file_name}")
-async def get_dicom_metadata(file_name: str):
-    """Obtener metadatos detallados de un archivo DICOM"""
+class RawPixelResponse(Response):
+    """Respuesta binaria que envía un memoryview tal cual (sin copiarlo a bytes)"""
+    media_type = "application/octet-stream"
+    
+    def render(self, content: Any) -> Any:
+        if isinstance(content, memoryview):
+            return content
+        return super().render(content)
+
+@app.get("/api/dicom/raw")
+async def get_dicom_raw_pixels(file_path: str, size: Optional[int] = None):
+    """
+    Píxeles decodificados en crudo para ventana/nivel en el cliente
+    
+    El cuerpo son los valores reescalados (int16/uint16 little-endian, uint8 o
+    float32 según la serie) y la cabecera X-DICOM-Header trae un JSON con
+    shape, dtype, rescale y ventana por defecto.
+    """
     try:
-        metadata = dicom_service.get_dicom_metadata(file_name)
-        return metadata
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Archivo DICOM no encontrado")
+        size = build_render_params(size=size).get("size")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        pixels, header = await dicom_service.get_raw_slice_async(file_path, size)
+        return RawPixelResponse(
+            content=memoryview(pixels).cast("B"),
+            headers={
+                "X-DICOM-Header": json.dumps(header),
+                "Access-Control-Expose-Headers": "X-DICOM-Header",
+                "Cache-Control": "max-age=3600"
+            }
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DicomRenderBusyError:
+        raise HTTPException(status_code=503, detail="Servidor DICOM ocupado, reintente en unos segundos")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Tiempo de procesamiento DICOM excedido")
     except Exception as e:
-        logger.error(f"Error obteniendo metadatos DICOM: {e}")
-        raise HTTPException(status_code=500, detail="Error obteniendo metadatos DICOM")
+        logger.error(f"Error obteniendo píxeles DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error obteniendo píxeles DICOM")
+
+async def _dicom_zip_response(series_uid: Optional[str], study_uid: Optional[str], mode: str,
+                        format: str, render_args: Dict[str, Any]) -> StreamingResponse:
+    """ZIP en streaming de una serie o estudio (los errores se validan antes de enviar bytes)"""
+    try:
+        image_format = negotiate_image_format(None, format)
+        render_params = build_render_params(image_format=image_format, **render_args)
+        export, filename = await dicom_service.create_zip_export_async(
+            series_uid=series_uid, study_uid=study_uid, mode=mode, render_params=render_params
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error preparando exportación DICOM: {e}")
+        raise HTTPException(status_code=500, detail="Error preparando exportación DICOM")
+
+    return StreamingResponse(
+        export.stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/dicom/export/series/{series_uid}")
+async def export_dicom_series(
+    series_uid: str,
+    mode: str = "rendered",
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: str = "png",
+    quality: Optional[int] = None,
+    auto_window: bool = False
+):
+    """
+    Descargar una serie como ZIP generado en streaming
+
+    - mode: rendered (imágenes con la ventana pedida) o dicom (archivos originales)
+    - wc / ww / preset / invert / size / format / quality / auto_window: igual que /api/dicom/image
+    """
+    return await _dicom_zip_response(series_uid, None, mode, format, dict(
+        wc=wc, ww=ww, preset=preset, invert=invert, size=size, quality=quality, auto_window=auto_window
+    ))
+
+@app.get("/api/dicom/export/study/{study_uid}")
+async def export_dicom_study(
+    study_uid: str,
+    mode: str = "rendered",
+    wc: Optional[float] = None,
+    ww: Optional[float] = None,
+    preset: Optional[str] = None,
+    invert: bool = False,
+    size: Optional[int] = None,
+    format: str = "png",
+    quality: Optional[int] = None,
+    auto_window: bool = False
+):
+    """
+    Descargar un estudio completo como ZIP (una carpeta por serie)
+
+    Mismos parámetros que /api/dicom/export/series/{series_uid}
+    """
+    return await _dicom_zip_response(None, study_uid, mode, format, dict(
+        wc=wc, ww=ww, preset=preset, invert=invert, size=size, quality=quality, auto_window=auto_window
+    ))
 
 @app.get("/api/dicom/test")
 async def test_dicom_processing():
     """Test para verificar procesamiento DICOM"""
     try:
-        return dicom_service.test_dicom_processing()
+        return await dicom_service.test_dicom_processing_async()
     except Exception as e:
         logger.error(f"Error en test DICOM: {e}")
         return {
@@ -782,18 +1279,6 @@ async def test_dicom_processing():
             "timestamp": datetime.now().isoformat()
         }
 
-@app.get("/api/dicom/health")
-async def dicom_health_check():
-    """Health check específico para servicio DICOM"""
-    try:
-        return dicom_service.health_check()
-    except Exception as e:
-        logger.error(f"Error en health check DICOM: {e}")
-        return {
-            "status": "error",
-            "message": str(e),
-            "timestamp": datetime.now().isoformat()
-        }
 # ===== TUS ENDPOINTS DE MONITOREO (CONSERVAMOS) =====
 
 @app.get("/api/health")
@@ -1165,6 +1650,14 @@ async def startup_event():
     else:
         logger.info("✅ Todos los archivos de hospital disponibles")
     
+    # Primera sincronización del índice DICOM en su hilo (los requests la esperan sin bloquear el loop)
+    dicom_service.schedule_index_refresh()
+    logger.info("🗂️ Sincronización del índice DICOM en segundo plano iniciada")
+    
+    # Decodificar una vez las instancias DICOM comprimidas (en segundo plano)
+    if dicom_service.schedule_transcode():
+        logger.info("🔁 Transcodificación DICOM en segundo plano iniciada")
+    
     logger.info("✅ Sistema listo para recibir conexiones")
 
 @app.on_event("shutdown")
@@ -1182,6 +1675,9 @@ async def shutdown_event():
     # Limpiar cache del hospital
     hospital_service.invalidate_cache()
     
+    # Cerrar pool de renderizado DICOM
+    dicom_service.shutdown()
+    
     logger.info("✅ Sistema cerrado correctamente")
 
 # ===== CONFIGURACIÓN PARA DESARROLLO (ACTUALIZADA) =====
@@ -0,0 +1,252 @@
+"""
+Caches para el pipeline de imágenes DICOM
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, BinaryIO, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LRUByteCache:
+    """
+    Cache LRU en memoria limitada por bytes (no por número de entradas)
+
+    Las imágenes DICOM varían mucho de tamaño (thumbnail vs CT completo), así
+    que el presupuesto se mide con `sizeof` sobre cada valor almacenado.
+    """
+
+    def __init__(self, max_bytes: int, name: str = "cache",
+                 sizeof: Callable[[Any], int] = len):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._sizeof = sizeof
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+
+        # Contadores
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Obtener un valor y marcarlo como usado recientemente"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> bool:
+        """Guardar un valor desalojando los menos usados si se excede el presupuesto"""
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            # Un valor más grande que todo el presupuesto vaciaría el cache
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._current_bytes -= self._sizes.pop(key)
+                del self._entries[key]
+
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._current_bytes += size
+
+            while self._current_bytes > self.max_bytes and self._entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._current_bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+        return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def clear(self):
+        """Vaciar el cache (los contadores se conservan)"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._current_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas para health checks"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "current_bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class DiskRenderCache:
+    """
+    Cache en disco de imágenes codificadas, compartido entre workers de uvicorn
+
+    - Direccionado por contenido: el nombre del archivo es el SHA-256 de la clave
+    - Escrituras atómicas (archivo temporal + os.replace), nunca se leen a medias
+    - Límite de tamaño con desalojo LRU por atime (se actualiza en cada hit)
+    - Seguro entre procesos: los borrados/lecturas concurrentes se toleran
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, name: str = "disk_render"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.name = name
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Tamaño aproximado: se calcula al primer put y se recalcula al desalojar
+        self._approx_bytes: Optional[int] = None
+
+        # Contadores (por proceso)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_digest(key: Hashable) -> str:
+        """SHA-256 estable de la clave"""
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def path_for(self, key: Hashable, extension: str = "png") -> str:
+        """Ruta del archivo para una clave (subcarpeta por los 2 primeros hex)"""
+        digest = self.key_digest(key)
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{extension}")
+
+    def open_file(self, key: Hashable, extension: str = "png") -> Optional[BinaryIO]:
+        """
+        Abrir el archivo cacheado si existe (y actualizar su atime para el LRU)
+
+        Con el descriptor ya abierto, que otro worker lo desaloje después no
+        corta la lectura: el archivo sigue accesible hasta cerrarlo.
+        """
+        path = self.path_for(key, extension)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path, (time.time(), os.fstat(file.fileno()).st_mtime))
+        except OSError:
+            # Desalojado justo después de abrirlo: igual se lee desde el descriptor
+            pass
+        with self._lock:
+            self.hits += 1
+        return file
+
+    def get(self, key: Hashable, extension: str = "png") -> Optional[bytes]:
+        """Leer los bytes cacheados"""
+        file = self.open_file(key, extension)
+        if file is None:
+            return None
+        with file:
+            return file.read()
+
+    def put(self, key: Hashable, data: bytes, extension: str = "png") -> Optional[str]:
+        """Guardar de forma atómica y devolver la ruta final"""
+        if len(data) > self.max_bytes:
+            return None
+
+        path = self.path_for(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan_size()
+            self.writes += 1
+            self._approx_bytes += len(data)
+            needs_eviction = self._approx_bytes > self.max_bytes
+
+        if needs_eviction:
+            self.evict()
+        return path
+
+    def _iter_files(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.startswith(".tmp-"):
+                    continue
+                full_path = os.path.join(root, file)
+                try:
+                    yield full_path, os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+
+    def _scan_size(self) -> int:
+        return sum(st.st_size for _, st in self._iter_files())
+
+    def evict(self, target_ratio: float = 0.9):
+        """
+        Desalojar por atime (más antiguo primero) hasta quedar bajo el límite
+
+        Se baja hasta el 90% del límite para no escanear en cada escritura.
+        """
+        with self._lock:
+            entries = sorted(self._iter_files(), key=lambda item: item[1].st_atime)
+            total = sum(st.st_size for _, st in entries)
+            target = int(self.max_bytes * target_ratio)
+
+            for path, st in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+                total -= st.st_size
+
+            self._approx_bytes = total
+        logger.info(f"🧹 Cache de disco '{self.name}' desalojado: {total} bytes en uso")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas para health checks"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "cache_dir": self.cache_dir,
+                "approx_bytes": self._approx_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
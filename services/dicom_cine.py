@@ -0,0 +1,241 @@
+"""
+Reproducción cine de una serie DICOM por WebSocket
+
+Cada sesión mantiene un playhead, renderiza por adelantado los cortes que
+vienen y guarda los últimos frames enviados en memoria, así la reproducción
+no depende de un request HTTP por corte.
+"""
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MIN_FPS = 1
+MAX_FPS = 60
+
+
+class CineSession:
+    """
+    Sesión de reproducción de una serie
+
+    Mensajes del servidor:
+    - texto JSON {"type": "ready" | "state" | "error", ...}
+    - binario: 4 bytes big-endian con el índice del frame + imagen codificada
+
+    Mensajes de control del cliente (texto JSON, campo "action"):
+    play, pause, seek {"index"}, fps {"value"}, loop {"value"}
+    """
+
+    def __init__(self, paths: List[str], render: Callable[[str, Dict[str, Any]], Awaitable[bytes]],
+                 render_params: Dict[str, Any], fps: float = 20, loop: bool = True,
+                 render_ahead: int = 12, buffer_frames: int = 64,
+                 busy_errors: Tuple[type, ...] = ()):
+        self.paths = paths
+        self.render_params = render_params
+        self.fps = self._clamp_fps(fps)
+        self.loop = loop
+        self.render_ahead = max(1, render_ahead)
+        self.buffer_frames = max(self.render_ahead, buffer_frames)
+        self._render = render
+        self._busy_errors = busy_errors
+
+        self.playhead = 0
+        self.playing = True
+        self._seeked = False
+        self._frames: "OrderedDict[int, bytes]" = OrderedDict()
+        self._pending: Dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+
+        # Contadores
+        self.sent = 0
+        self.late = 0
+
+    @staticmethod
+    def _clamp_fps(fps: float) -> float:
+        return float(min(MAX_FPS, max(MIN_FPS, fps)))
+
+    # ===== RENDER POR ADELANTADO =====
+
+    def _window(self) -> List[int]:
+        """Índices desde el playhead hasta `render_ahead` frames por delante"""
+        count = len(self.paths)
+        indices = []
+        for offset in range(self.render_ahead):
+            index = self.playhead + offset
+            if index >= count:
+                if not self.loop:
+                    break
+                index %= count
+            indices.append(index)
+        return indices
+
+    def _schedule_ahead(self):
+        """Lanzar el render de los frames próximos y cancelar los que quedaron lejos"""
+        window = self._window()
+        wanted = set(window)
+        for index, task in list(self._pending.items()):
+            if index not in wanted:
+                task.cancel()
+                del self._pending[index]
+        for index in window:
+            if index not in self._frames and index not in self._pending:
+                self._pending[index] = asyncio.get_running_loop().create_task(self._render_frame(index))
+
+    async def _render_frame(self, index: int) -> bytes:
+        while True:
+            try:
+                return await self._render(self.paths[index], self.render_params)
+            except self._busy_errors:
+                await asyncio.sleep(0.02)
+
+    async def _get_frame(self, index: int) -> bytes:
+        """Frame desde el buffer o esperando su render"""
+        frame = self._frames.get(index)
+        if frame is not None:
+            self._frames.move_to_end(index)
+            return frame
+
+        task = self._pending.pop(index, None)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._render_frame(index))
+        frame = await task
+
+        self._frames[index] = frame
+        while len(self._frames) > self.buffer_frames:
+            self._frames.popitem(last=False)
+        return frame
+
+    # ===== CONTROL =====
+
+    def handle_control(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Aplicar un mensaje de control y devolver el estado resultante"""
+        action = message.get("action")
+        if action == "play":
+            self.playing = True
+            if not self.loop and self.playhead == len(self.paths) - 1:
+                self.playhead = 0
+                self._seeked = True
+        elif action == "pause":
+            self.playing = False
+        elif action == "seek":
+            index = int(message.get("index", 0))
+            if not 0 <= index < len(self.paths):
+                raise ValueError(f"Índice fuera de rango (0-{len(self.paths) - 1})")
+            self.playhead = index
+            self._seeked = True
+        elif action == "fps":
+            self.fps = self._clamp_fps(float(message.get("value", self.fps)))
+        elif action == "loop":
+            self.loop = bool(message.get("value", True))
+        else:
+            raise ValueError(f"Acción desconocida: {action}")
+
+        self._wakeup.set()
+        return self.get_state()
+
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            "type": "state",
+            "playing": self.playing,
+            "index": self.playhead,
+            "frames": len(self.paths),
+            "fps": self.fps,
+            "loop": self.loop,
+            "sent": self.sent,
+            "late": self.late
+        }
+
+    # ===== BUCLES =====
+
+    async def _send_frame(self, websocket, index: int):
+        frame = await self._get_frame(index)
+        await websocket.send_bytes(index.to_bytes(4, "big") + frame)
+        self.sent += 1
+
+    def _next_index(self, index: int) -> Optional[int]:
+        """Frame siguiente (None al final de la serie sin loop)"""
+        if index + 1 < len(self.paths):
+            return index + 1
+        return 0 if self.loop else None
+
+    async def play(self, websocket):
+        """
+        Bucle de reproducción: un frame cada 1/fps
+
+        El playhead es el frame que el cliente tiene en pantalla. Los instantes
+        de envío se calculan sobre el reloj del event loop para que el fps no
+        derive; si un frame sale tarde se cuenta en `late`. En pausa solo se
+        envía el frame de un seek. Los demás mensajes de control no adelantan
+        el frame siguiente.
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        shown: Optional[int] = None
+
+        while True:
+            self._schedule_ahead()
+
+            if self._seeked or shown is None:
+                index = self.playhead
+            elif self.playing:
+                index = self._next_index(shown)
+                if index is None:
+                    self.playing = False
+                    await websocket.send_text(json.dumps(self.get_state()))
+                    continue
+            else:
+                index = None
+
+            self._seeked = False
+            if index is not None:
+                self.playhead = index
+                await self._send_frame(websocket, index)
+                shown = index
+
+            if not self.playing:
+                self._wakeup.clear()
+                if not self._seeked:
+                    await self._wakeup.wait()
+                next_tick = loop.time()
+                continue
+
+            frame_tick = next_tick
+            next_tick = frame_tick + 1.0 / self.fps
+            if next_tick < loop.time():
+                self.late += 1
+                next_tick = loop.time()
+                continue
+            
+            # Solo el tick, un seek o una pausa hacen avanzar el bucle; un
+            # cambio de fps o de loop solo recalcula cuándo sale el próximo frame
+            while True:
+                self._wakeup.clear()
+                if self._seeked or not self.playing:
+                    next_tick = loop.time()
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_tick - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                next_tick = max(frame_tick + 1.0 / self.fps, loop.time())
+
+    async def receive_controls(self, websocket):
+        """Bucle de mensajes de control del cliente"""
+        while True:
+            text = await websocket.receive_text()
+            try:
+                state = self.handle_control(json.loads(text))
+            except (ValueError, TypeError, AttributeError) as e:
+                await websocket.send_text(json.dumps({"type": "error", "message": str(e)}))
+                continue
+            await websocket.send_text(json.dumps(state))
+
+    def close(self):
+        """Cancelar los renders pendientes"""
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+        self._frames.clear()
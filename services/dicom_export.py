@@ -0,0 +1,236 @@
+"""
+Exportación de series y estudios DICOM como ZIP en streaming
+
+El ZIP se genera de forma incremental: cada entrada se escribe apenas su
+imagen está lista y los bytes salen al cliente enseguida, sin armar el
+archivo completo en memoria ni en disco. Mientras se escribe una entrada,
+las siguientes ya se están renderizando en el pool.
+"""
+import io
+import os
+import re
+import json
+import time
+import asyncio
+import zipfile
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de los bloques al copiar DICOM originales
+COPY_CHUNK_BYTES = 1024 * 1024
+
+EXPORT_MODES = ("rendered", "dicom")
+
+# Extensión de las imágenes renderizadas según el formato
+_IMAGE_EXTENSIONS = {"jpeg": "jpg"}
+
+
+def safe_filename(text: str, default: str = "sin_nombre") -> str:
+    """Componente de ruta seguro dentro del ZIP (sin separadores ni caracteres raros)"""
+    cleaned = re.sub(r"[^\w.-]+", "_", str(text or "")).strip("._")
+    return cleaned[:80] or default
+
+
+def build_export_items(series: List[Dict[str, Any]], paths_by_series: Dict[str, List[str]],
+                       mode: str, image_format: str = "png") -> List[Tuple[str, str]]:
+    """
+    Nombres dentro del ZIP: una carpeta por serie y los cortes en orden
+
+    Modo "rendered": <serie>/0001.png; modo "dicom": <serie>/0001_<archivo original>.
+    """
+    extension = _IMAGE_EXTENSIONS.get(image_format, image_format)
+    items = []
+    for info in series:
+        folder = safe_filename(
+            f"{info.get('series_number', 0):03d}_{info.get('modality') or ''}_{info.get('series_description') or ''}"
+        )
+        for position, path in enumerate(paths_by_series.get(info["series_uid"], []), start=1):
+            if mode == "rendered":
+                name = f"{position:04d}.{extension}"
+            else:
+                name = f"{position:04d}_{safe_filename(os.path.basename(path), 'instancia')}"
+            items.append((f"{folder}/{name}", path))
+    return items
+
+
+class _ZipSink(io.RawIOBase):
+    """
+    Destino no buscable para zipfile: acumula lo escrito hasta `drain`
+
+    Sin seek, zipfile escribe cada entrada con data descriptor y nunca
+    vuelve atrás, así lo ya drenado se puede enviar de inmediato.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipExport:
+    """
+    Un ZIP en streaming con las imágenes renderizadas o los DICOM originales
+
+    `items` son pares (nombre dentro del ZIP, ruta DICOM) en el orden de
+    escritura. En modo "rendered" se mantienen hasta `render_ahead` renders
+    en curso por delante del escritor; la memoria queda acotada a esas
+    imágenes más un bloque de copia. Las entradas van sin comprimir (PNG,
+    WebP y JPEG ya lo están). Al final se agrega manifest.json con los
+    archivos incluidos y los que fallaron.
+    """
+
+    def __init__(self, items: List[Tuple[str, str]],
+                 render: Callable[[str, Dict[str, Any]], Awaitable[bytes]],
+                 render_params: Dict[str, Any], mode: str = "rendered",
+                 render_ahead: int = 8, busy_errors: Tuple[type, ...] = (),
+                 manifest: Optional[Dict[str, Any]] = None):
+        if mode not in EXPORT_MODES:
+            raise ValueError(f"Modo de exportación desconocido: {mode} (disponibles: {', '.join(EXPORT_MODES)})")
+        self.items = items
+        self.mode = mode
+        self.render_params = render_params
+        self.render_ahead = max(1, render_ahead)
+        self._render = render
+        self._busy_errors = busy_errors
+        self._manifest = dict(manifest or {})
+
+        self.written = 0
+        self.errors: List[Dict[str, str]] = []
+        self.bytes_sent = 0
+
+    async def _render_item(self, path: str) -> bytes:
+        while True:
+            try:
+                return await self._render(path, self.render_params)
+            except self._busy_errors:
+                await asyncio.sleep(0.05)
+
+    def _entry(self, arcname: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        return info
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Generador de bloques del ZIP (para StreamingResponse)"""
+        started = time.perf_counter()
+        sink = _ZipSink()
+        loop = asyncio.get_running_loop()
+        pending: Deque[Tuple[str, str, Optional[asyncio.Task]]] = deque()
+        upcoming = iter(self.items)
+
+        def top_up():
+            while len(pending) < self.render_ahead:
+                try:
+                    arcname, path = next(upcoming)
+                except StopIteration:
+                    return
+                task = loop.create_task(self._render_item(path)) if self.mode == "rendered" else None
+                pending.append((arcname, path, task))
+
+        try:
+            with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+                top_up()
+                while pending:
+                    arcname, path, task = pending.popleft()
+                    top_up()
+                    # Lo que falla antes de abrir la entrada se anota en el manifest y se omite
+                    try:
+                        if task is not None:
+                            content = await task
+                        else:
+                            source = await loop.run_in_executor(None, open, path, "rb")
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"⚠️ No se pudo exportar {path}: {e}")
+                        self.errors.append({"file": arcname, "source": path, "error": str(e)})
+                        continue
+
+                    if task is not None:
+                        archive.writestr(self._entry(arcname), content)
+                    else:
+                        with source:
+                            async for chunk in self._copy_file(archive, arcname, source, sink):
+                                yield chunk
+                    self.written += 1
+
+                    data = sink.drain()
+                    if data:
+                        self.bytes_sent += len(data)
+                        yield data
+
+                manifest = dict(
+                    self._manifest,
+                    mode=self.mode,
+                    render_params=self.render_params if self.mode == "rendered" else None,
+                    files=self.written,
+                    errors=self.errors,
+                    created=datetime.now().isoformat()
+                )
+                archive.writestr(self._entry("manifest.json"),
+                                 json.dumps(manifest, indent=2, ensure_ascii=False))
+
+            data = sink.drain()
+            self.bytes_sent += len(data)
+            yield data
+            logger.info(
+                f"📦 Exportación ZIP completada: {self.written} archivos, {len(self.errors)} errores, "
+                f"{self.bytes_sent} bytes en {(time.perf_counter() - started) * 1000:.0f} ms"
+            )
+        finally:
+            for _, _, task in pending:
+                if task is not None:
+                    task.cancel()
+
+    async def _copy_file(self, archive: zipfile.ZipFile, arcname: str, source: BinaryIO,
+                         sink: _ZipSink) -> AsyncIterator[bytes]:
+        """
+        Copiar un DICOM original ya abierto por bloques (la lectura corre fuera del event loop)
+
+        Parte de la entrada ya se envió, así que un fallo a mitad de la copia
+        no se puede omitir: se propaga y corta la descarga, en vez de dejar
+        en el ZIP un DICOM truncado que parezca completo.
+        """
+        loop = asyncio.get_running_loop()
+        expected = os.fstat(source.fileno()).st_size
+        entry = self._entry(arcname)
+        entry.file_size = expected
+        copied = 0
+        try:
+            with archive.open(entry, mode="w") as target:
+                while True:
+                    chunk = await loop.run_in_executor(None, source.read, COPY_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    copied += len(chunk)
+                    target.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        self.bytes_sent += len(data)
+                        yield data
+                if copied != expected:
+                    raise OSError(f"se leyeron {copied} de {expected} bytes")
+        except OSError as e:
+            logger.error(f"💥 Exportación ZIP abortada en {arcname}: {e}")
+            raise
@@ -0,0 +1,466 @@
+"""
+Funciones de imagen (numpy puro) para el pipeline DICOM
+
+Aquí no se lee ningún archivo: reciben arrays ya decodificados y devuelven
+arrays uint8 listos para codificar.
+"""
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Presets de ventana (centro, ancho) en unidades Hounsfield
+WINDOW_PRESETS: Dict[str, Tuple[float, float]] = {
+    "brain": (40, 80),
+    "subdural": (75, 215),
+    "stroke": (40, 40),
+    "bone": (400, 1800),
+    "lung": (-600, 1500),
+    "mediastinum": (50, 350),
+    "abdomen": (40, 400),
+    "liver": (30, 150),
+    "soft_tissue": (50, 400),
+}
+
+# Formatos de salida soportados -> media type
+IMAGE_FORMATS: Dict[str, str] = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+DEFAULT_JPEG_QUALITY = 85
+
+# Niveles de la pirámide de resolución (lado máximo en píxeles); None = completo
+PYRAMID_LEVELS: Tuple[int, ...] = (64, 128, 256)
+
+
+@dataclass
+class DecodedSlice:
+    """
+    Corte decodificado y ya reescalado (unidades de modalidad, p. ej. HU)
+
+    Es lo que guarda el cache de píxeles: cualquier variante de render
+    (ventana, tamaño, formato) se deriva de aquí sin volver a leer el archivo.
+    """
+    pixels: np.ndarray
+    window: Optional[Tuple[float, float]]
+    photometric: str
+    transfer_syntax: str = "Unknown"
+    modality: str = "N/A"
+    rescale: Tuple[float, float] = (1.0, 0.0)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.pixels.nbytes)
+
+    @property
+    def is_color(self) -> bool:
+        return self.pixels.ndim == 3 and self.pixels.shape[-1] in (3, 4)
+
+
+def rescale_pixels(pixels: np.ndarray, slope: float, intercept: float) -> np.ndarray:
+    """
+    Aplicar RescaleSlope/Intercept eligiendo el dtype más compacto
+
+    - Sin rescale: el array se devuelve tal cual (sin copia)
+    - Rescale entero que cabe en int16 (caso típico CT): int16
+    - Cualquier otro caso: float32
+    """
+    if slope == 1 and intercept == 0:
+        return pixels
+    if pixels.dtype.kind in "iu" and float(slope).is_integer() and float(intercept).is_integer():
+        low = int(pixels.min()) * int(slope) + int(intercept)
+        high = int(pixels.max()) * int(slope) + int(intercept)
+        low, high = min(low, high), max(low, high)
+        info = np.iinfo(np.int16)
+        if info.min <= low and high <= info.max:
+            rescaled = pixels.astype(np.int16)
+            if slope != 1:
+                rescaled *= np.int16(slope)
+            rescaled += np.int16(intercept)
+            return rescaled
+    return pixels.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+
+
+def _area_weights(source: int, target: int) -> np.ndarray:
+    """Matriz (target x source) de promedio de áreas para un factor no entero"""
+    scale = source / target
+    edges = np.arange(target + 1) * scale
+    columns = np.arange(source)[None, :]
+    overlap = np.minimum(edges[1:, None], columns + 1) - np.maximum(edges[:-1, None], columns)
+    return (np.clip(overlap, 0, None) / scale).astype(np.float32)
+
+
+def downsample_area(pixels: np.ndarray, max_side: int) -> np.ndarray:
+    """
+    Reducir por promedio de áreas hasta que el lado mayor sea max_side
+
+    Primero con el mayor factor entero que no baja de max_side: cada píxel
+    de salida es la media de un bloque factor x factor (reshape + mean, sin
+    bucles; los bordes que no completan un bloque se descartan). Lo que
+    falta, menos de un factor 2, se reduce con pesos de área fraccionarios,
+    así el lado mayor queda exactamente en max_side. Los enteros se
+    redondean al dtype original para seguir usando la LUT de ventana.
+    """
+    height, width = pixels.shape[:2]
+    longest = max(height, width)
+    if longest <= max_side:
+        return pixels
+    target_h = max(round(height * max_side / longest), 1)
+    target_w = max(round(width * max_side / longest), 1)
+
+    factor = longest // max_side
+    if factor > 1:
+        out_h, out_w = max(height // factor, 1), max(width // factor, 1)
+        cropped = pixels[:out_h * factor, :out_w * factor]
+        blocks = cropped.reshape((out_h, factor, out_w, factor) + pixels.shape[2:])
+        averaged = blocks.mean(axis=(1, 3), dtype=np.float32)
+    else:
+        averaged = pixels.astype(np.float32)
+
+    if averaged.shape[:2] != (target_h, target_w):
+        rows = _area_weights(averaged.shape[0], target_h)
+        columns = _area_weights(averaged.shape[1], target_w)
+        averaged = np.tensordot(rows, averaged, axes=(1, 0))
+        averaged = np.moveaxis(np.tensordot(columns, averaged, axes=(1, 1)), 0, 1)
+
+    if pixels.dtype.kind in "iu":
+        return np.rint(averaged).astype(pixels.dtype)
+    return averaged
+
+
+def negotiate_image_format(accept: Optional[str], explicit: Optional[str] = None,
+                           preference: Tuple[str, ...] = ("png", "webp", "jpeg")) -> str:
+    """
+    Elegir el formato de salida: parámetro `format` > cabecera Accept > png
+
+    Del Accept se toma el primer formato, en orden de preferencia del
+    servidor, que el cliente acepte (tipo exacto o comodín) con q > 0.
+    """
+    if explicit:
+        key = explicit.lower()
+        key = "jpeg" if key == "jpg" else key
+        if key not in IMAGE_FORMATS:
+            raise ValueError(f"Formato no soportado: {explicit} (disponibles: {', '.join(IMAGE_FORMATS)})")
+        return key
+    if not accept:
+        return preference[0]
+
+    accepted: Dict[str, float] = {}
+    for part in accept.split(','):
+        fields = [field.strip() for field in part.split(';')]
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith('q='):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[fields[0].lower()] = quality
+
+    for fmt in preference:
+        media_type = IMAGE_FORMATS[fmt]
+        for candidate in (media_type, "image/*", "*/*"):
+            if candidate in accepted:
+                if accepted[candidate] > 0:
+                    return fmt
+                break
+    return preference[0]
+
+
+def build_render_params(wc: Optional[float] = None, ww: Optional[float] = None,
+                        preset: Optional[str] = None, invert: bool = False,
+                        size: Optional[int] = None, image_format: str = "png",
+                        quality: Optional[int] = None, auto_window: bool = False) -> Dict[str, Any]:
+    """
+    Validar y normalizar los parámetros de render de un request
+
+    El preset se traduce a (wc, ww) aquí para que requests equivalentes
+    compartan la misma clave de cache. `auto_window` (ventana por percentiles)
+    solo aplica si no se pidió una ventana explícita.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Formato no soportado: {image_format} (disponibles: {', '.join(IMAGE_FORMATS)})")
+    params: Dict[str, Any] = {"format": image_format}
+    if image_format == "jpeg":
+        quality = DEFAULT_JPEG_QUALITY if quality is None else quality
+        if not 1 <= quality <= 95:
+            raise ValueError("quality debe estar entre 1 y 95")
+        params["quality"] = int(quality)
+
+    if preset:
+        key = preset.lower()
+        if key not in WINDOW_PRESETS:
+            raise ValueError(f"Preset de ventana desconocido: {preset} (disponibles: {', '.join(WINDOW_PRESETS)})")
+        preset_wc, preset_ww = WINDOW_PRESETS[key]
+        wc = preset_wc if wc is None else wc
+        ww = preset_ww if ww is None else ww
+
+    if (wc is None) != (ww is None):
+        raise ValueError("wc y ww deben enviarse juntos")
+    if ww is not None:
+        if ww < 1:
+            raise ValueError("ww debe ser >= 1")
+        params["wc"] = float(wc)
+        params["ww"] = float(ww)
+    elif auto_window:
+        params["auto_window"] = True
+    if invert:
+        params["invert"] = True
+    if size is not None:
+        if size not in PYRAMID_LEVELS:
+            raise ValueError(f"Tamaño no soportado: {size} (disponibles: {', '.join(map(str, PYRAMID_LEVELS))})")
+        params["size"] = int(size)
+    return params
+
+
+def _window_to_uint8(values: np.ndarray, wc: float, ww: float, invert: bool) -> np.ndarray:
+    """Función de ventana lineal DICOM (PS3.3 C.11.2.1.2) vectorizada"""
+    lower = wc - 0.5 - (ww - 1) / 2
+    upper = wc - 0.5 + (ww - 1) / 2
+    width = max(ww - 1, 1)
+    scaled = ((values - (wc - 0.5)) / width + 0.5) * 255.0
+    scaled = np.where(values <= lower, 0.0, np.where(values > upper, 255.0, scaled))
+    result = np.clip(scaled, 0, 255).astype(np.uint8)
+    return 255 - result if invert else result
+
+
+@lru_cache(maxsize=64)
+def get_window_lut(dtype_str: str, slope: float, intercept: float,
+                   wc: float, ww: float, invert: bool) -> np.ndarray:
+    """
+    LUT uint8 para todos los valores almacenables del dtype
+
+    Incluye rescale (slope/intercept), ventana e inversión; cambiar de ventana
+    cuesta construir una tabla de 64K entradas (<1 ms) y luego un solo take.
+    """
+    dtype = np.dtype(dtype_str)
+    unsigned = np.dtype(f"u{dtype.itemsize}")
+    stored = np.arange(2 ** (8 * dtype.itemsize), dtype=unsigned).view(dtype)
+    values = stored.astype(np.float64) * slope + intercept
+    lut = _window_to_uint8(values, wc, ww, invert)
+    lut.setflags(write=False)
+    return lut
+
+
+def apply_window(pixels: np.ndarray, slope: float, intercept: float,
+                 wc: float, ww: float, invert: bool = False) -> np.ndarray:
+    """Aplicar rescale + ventana a un array de píxeles almacenados"""
+    if pixels.dtype.kind in "iu" and pixels.dtype.itemsize <= 2:
+        if not pixels.dtype.isnative:
+            pixels = pixels.astype(pixels.dtype.newbyteorder('='))
+        lut = get_window_lut(pixels.dtype.str, float(slope), float(intercept),
+                             float(wc), float(ww), bool(invert))
+        unsigned = np.dtype(f"u{pixels.dtype.itemsize}")
+        return lut[pixels.view(unsigned)]
+
+    # Enteros de 32 bits o flotantes: fórmula directa
+    values = pixels.astype(np.float64) * slope + intercept
+    return _window_to_uint8(values, wc, ww, invert)
+
+
+def _first_value(value: Any) -> Any:
+    """Primer valor de un atributo multivalor (MultiValue) o el valor mismo"""
+    if isinstance(value, (str, bytes)):
+        return value
+    try:
+        return value[0]
+    except (TypeError, IndexError):
+        return value
+
+
+def header_window(ds) -> Optional[Tuple[float, float]]:
+    """Primer par WindowCenter/WindowWidth de la cabecera, si existe"""
+    if not (hasattr(ds, 'WindowCenter') and hasattr(ds, 'WindowWidth')):
+        return None
+    try:
+        wc = float(_first_value(ds.WindowCenter))
+        ww = float(_first_value(ds.WindowWidth))
+    except (TypeError, ValueError):
+        return None
+    return (wc, ww) if ww >= 1 else None
+
+
+def rescale_params(ds) -> Tuple[float, float]:
+    """RescaleSlope / RescaleIntercept con valores por defecto (1, 0)"""
+    try:
+        slope = float(getattr(ds, 'RescaleSlope', 1) or 1)
+        intercept = float(getattr(ds, 'RescaleIntercept', 0) or 0)
+    except (TypeError, ValueError):
+        slope, intercept = 1.0, 0.0
+    return slope, intercept
+
+
+# Sintaxis sin compresión cuyo PixelData puede mapearse directo del archivo
+UNCOMPRESSED_SYNTAXES = (
+    "1.2.840.10008.1.2",      # Implicit VR Little Endian
+    "1.2.840.10008.1.2.1",    # Explicit VR Little Endian
+)
+
+
+def pixel_layout(ds) -> Optional[Dict[str, Any]]:
+    """
+    Ubicación y formato del PixelData para leerlo con np.memmap
+
+    Requiere un dataset leído con defer_size (el elemento PixelData queda sin
+    cargar y conserva su offset en el archivo). Devuelve None si la sintaxis
+    está comprimida o el formato no se puede mapear tal cual.
+    """
+    transfer_syntax = str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', ''))
+    if transfer_syntax not in UNCOMPRESSED_SYNTAXES or 'PixelData' not in ds:
+        return None
+
+    element = ds.get_item('PixelData')
+    offset = getattr(element, 'file_tell', None)
+    if offset is None or getattr(element, 'is_undefined_length', False):
+        return None
+
+    try:
+        rows, columns = int(ds.Rows), int(ds.Columns)
+        bits_allocated = int(ds.BitsAllocated)
+        bits_stored = int(getattr(ds, 'BitsStored', bits_allocated))
+        signed = int(getattr(ds, 'PixelRepresentation', 0)) == 1
+        samples = int(getattr(ds, 'SamplesPerPixel', 1))
+        frames = int(getattr(ds, 'NumberOfFrames', 1) or 1)
+        planar = int(getattr(ds, 'PlanarConfiguration', 0) or 0)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    if bits_allocated not in (8, 16, 32) or (samples > 1 and planar != 0):
+        return None
+    # Con signo y bits altos sin usar habría que extender el signo: lo hace pydicom
+    if signed and bits_stored != bits_allocated:
+        return None
+
+    dtype = np.dtype(f"{'i' if signed else 'u'}{bits_allocated // 8}").newbyteorder('<')
+    shape = [rows, columns] + ([samples] if samples > 1 else [])
+    if frames > 1:
+        shape = [frames] + shape
+    return {"offset": int(offset), "dtype": dtype.str, "shape": shape}
+
+
+# Percentiles que guarda el índice y los que usa la ventana automática
+STAT_PERCENTILES: Tuple[float, ...] = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+AUTO_WINDOW_PERCENTILES = ("p1", "p99")
+DEFAULT_HISTOGRAM_BINS = 256
+
+
+def value_counts(pixels: np.ndarray) -> Optional[Tuple[int, np.ndarray]]:
+    """
+    Conteo exacto por valor con un solo np.bincount (enteros de hasta 16 bits)
+
+    Los enteros con signo se pasan a sin signo invirtiendo el bit de signo,
+    lo que conserva el orden. Devuelve (valor del índice 0, conteos) con
+    todas las 2**bits entradas, así los conteos de varios cortes se suman
+    directamente; None para flotantes o enteros de 32 bits.
+    """
+    if pixels.dtype.kind not in "iu" or pixels.dtype.itemsize > 2:
+        return None
+    flat = pixels.reshape(-1)
+    if not flat.dtype.isnative:
+        flat = flat.astype(flat.dtype.newbyteorder('='))
+    bits = 8 * flat.dtype.itemsize
+    unsigned = np.dtype(f"u{flat.dtype.itemsize}")
+    stored = flat.view(unsigned)
+    base = 0
+    if flat.dtype.kind == "i":
+        sign = 1 << (bits - 1)
+        stored = stored ^ unsigned.type(sign)
+        base = -sign
+    return base, np.bincount(stored, minlength=1 << bits)
+
+
+def _percentile_key(percentile: float) -> str:
+    return f"p{percentile:g}"
+
+
+def stats_from_counts(base: int, counts: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS) -> Dict[str, Any]:
+    """Estadísticas e histograma a partir de conteos por valor (ver value_counts)"""
+    present = np.flatnonzero(counts)
+    if present.size == 0:
+        return {"count": 0}
+    first, last = int(present[0]), int(present[-1])
+    counts = counts[first:last + 1]
+    values = np.arange(base + first, base + last + 1, dtype=np.float64)
+
+    total = int(counts.sum())
+    mean = float(np.dot(counts, values) / total)
+    std = float(np.sqrt(np.dot(counts, (values - mean) ** 2) / total))
+
+    # Percentil por rango más cercano sobre la distribución acumulada
+    cumulative = np.cumsum(counts)
+    ranks = np.maximum(1, np.ceil(np.array(STAT_PERCENTILES) / 100 * total))
+    positions = np.searchsorted(cumulative, ranks, side='left')
+    percentiles = {
+        _percentile_key(p): float(values[pos]) for p, pos in zip(STAT_PERCENTILES, positions)
+    }
+
+    # Cada valor entero ocupa [v, v + 1); con menos valores que bins, un bin por valor
+    span = counts.size
+    bins = min(bins, span)
+    bin_index = (np.arange(span) * bins) // span
+    histogram = np.bincount(bin_index, weights=counts, minlength=bins).astype(np.int64)
+
+    return {
+        "count": total,
+        "min": float(values[0]),
+        "max": float(values[-1]),
+        "mean": mean,
+        "std": std,
+        "percentiles": percentiles,
+        "histogram": {
+            "bins": bins,
+            "start": float(values[0]),
+            "bin_width": span / bins,
+            "counts": histogram.tolist()
+        }
+    }
+
+
+def stats_from_values(values: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS) -> Dict[str, Any]:
+    """Estadísticas e histograma de valores flotantes (o enteros de 32 bits)"""
+    values = values.reshape(-1)
+    values = values[np.isfinite(values)] if values.dtype.kind == "f" else values
+    if values.size == 0:
+        return {"count": 0}
+    v_min, v_max = float(values.min()), float(values.max())
+    found = np.percentile(values, STAT_PERCENTILES, method='inverted_cdf')
+    span = v_max - v_min
+    histogram, _ = np.histogram(values, bins=bins, range=(v_min, v_max if span > 0 else v_min + 1))
+    return {
+        "count": int(values.size),
+        "min": v_min,
+        "max": v_max,
+        "mean": float(values.mean(dtype=np.float64)),
+        "std": float(values.std(dtype=np.float64)),
+        "percentiles": {_percentile_key(p): float(v) for p, v in zip(STAT_PERCENTILES, found)},
+        "histogram": {
+            "bins": bins,
+            "start": v_min,
+            "bin_width": (span if span > 0 else 1.0) / bins,
+            "counts": histogram.tolist()
+        }
+    }
+
+
+def pixel_statistics(pixels: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS) -> Dict[str, Any]:
+    """Min/max, media, desviación, percentiles e histograma de un array reescalado"""
+    counted = value_counts(pixels)
+    if counted is not None:
+        return stats_from_counts(counted[0], counted[1], bins)
+    return stats_from_values(pixels, bins)
+
+
+def percentile_window(stats: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    """Ventana (wc, ww) entre los percentiles 1 y 99 guardados (min/max si coinciden)"""
+    if not stats.get("count"):
+        return None
+    low_key, high_key = AUTO_WINDOW_PERCENTILES
+    low, high = stats["percentiles"][low_key], stats["percentiles"][high_key]
+    if high <= low:
+        low, high = stats["min"], stats["max"]
+    return (low + high) / 2, max(high - low, 1.0)
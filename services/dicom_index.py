@@ -0,0 +1,998 @@
+"""
+Índice persistente de metadatos DICOM (SQLite)
+
+Guarda una fila por instancia DICOM con la clave (ruta, mtime, tamaño) para que
+el listado de estudios no tenga que abrir cada archivo en cada request.
+Además mantiene precalculada la jerarquía Paciente/Estudio/Serie/Instancia.
+"""
+import os
+import json
+import base64
+import hashlib
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Subir la versión cuando cambie el esquema: el índice se reconstruye solo
+SCHEMA_VERSION = 6
+
+# Tablas que se descartan al cambiar de versión
+_TABLES = ("instances", "patients", "studies", "series", "series_stats")
+
+# Límite de página para las consultas jerárquicas
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Campos que puede devolver la búsqueda (nombre -> expresión SQL) por nivel
+SEARCH_FIELDS: Dict[str, Dict[str, str]] = {
+    "studies": {
+        "study_uid": "study_uid",
+        "patient_id": "patient_id",
+        "patient_name": "(SELECT patient_name FROM patients WHERE patients.patient_id = studies.patient_id)",
+        "study_date": "study_date",
+        "study_description": "study_description",
+        "modalities": "modalities",
+        "body_parts": "(SELECT group_concat(DISTINCT body_part) FROM series WHERE series.study_uid = studies.study_uid)",
+        "series_count": "series_count",
+        "instance_count": "instance_count",
+    },
+    "series": {
+        "series_uid": "series_uid",
+        "study_uid": "study_uid",
+        "patient_id": "(SELECT patient_id FROM studies WHERE studies.study_uid = series.study_uid)",
+        "study_date": "(SELECT study_date FROM studies WHERE studies.study_uid = series.study_uid)",
+        "series_number": "series_number",
+        "series_description": "series_description",
+        "modality": "modality",
+        "body_part": "body_part",
+        "instance_count": "instance_count",
+    },
+}
+DEFAULT_SEARCH_FIELDS = {
+    "studies": ("study_uid", "patient_id", "patient_name", "study_date", "study_description",
+                "modalities", "series_count", "instance_count"),
+    "series": ("series_uid", "study_uid", "series_number", "series_description", "modality",
+               "body_part", "instance_count"),
+}
+# Orden (y clave del cursor) de cada nivel
+_SEARCH_ORDER = {
+    "studies": (("study_date", "study_uid"), True),
+    "series": (("study_uid", "series_number", "series_uid"), False),
+}
+
+
+def _to_int(value: Any, default: int = 0) -> int:
+    """Convertir valores DICOM ('12', '12.0', 'N/A') a entero"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_date_range(value: str) -> Tuple[Optional[str], Optional[str]]:
+    """Rango de fechas estilo DICOM: 'AAAAMMDD', 'AAAAMMDD-', '-AAAAMMDD' o 'AAAAMMDD-AAAAMMDD'"""
+    start, separator, end = value.strip().partition('-')
+    if not separator:
+        end = start
+    for part in (start, end):
+        if part and not (len(part) == 8 and part.isdigit()):
+            raise ValueError(f"Fecha inválida: {value} (formato AAAAMMDD o AAAAMMDD-AAAAMMDD)")
+    if not start and not end:
+        raise ValueError(f"Rango de fechas vacío: {value}")
+    return start or None, end or None
+
+
+def _like_pattern(text: str) -> str:
+    """Patrón LIKE de subcadena con los comodines del texto escapados"""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def encode_cursor(key: Tuple) -> str:
+    """Cursor opaco a partir de la clave de ordenamiento del último elemento"""
+    raw = json.dumps(list(key), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """Decodificar un cursor generado por encode_cursor"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f"Cursor inválido: {cursor}")
+    if not isinstance(key, list):
+        raise ValueError(f"Cursor inválido: {cursor}")
+    return key
+
+
+class DicomIndex:
+    """Índice de metadatos DICOM persistido en disco"""
+
+    def __init__(self, db_path: str, dicom_folder: str):
+        self.db_path = db_path
+        self.dicom_folder = dicom_folder
+        self._sync_lock = threading.Lock()
+        self._last_sync = None
+        self._last_sync_stats: Dict[str, Any] = {}
+        # Se incrementa cada vez que cambia el contenido (invalida estructuras derivadas)
+        self.generation = 0
+        # DICOMDIR ya leídos: {ruta: ((mtime, tamaño), {archivo: metadatos})}
+        self._dicomdirs: Dict[str, Tuple[Tuple[float, int], Dict[str, Dict[str, Any]]]] = {}
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._init_schema()
+
+    # ===== CONEXIÓN Y ESQUEMA =====
+
+    @contextmanager
+    def _connect(self):
+        """Abrir conexión transaccional (una por operación, segura entre hilos y workers)"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_schema(self):
+        """Crear tablas o reconstruirlas si la versión del esquema cambió"""
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS index_info (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM index_info WHERE key = 'schema_version'").fetchone()
+
+            if row is None or int(row["value"]) != SCHEMA_VERSION:
+                logger.info(f"🗂️ Creando índice DICOM (esquema v{SCHEMA_VERSION}): {self.db_path}")
+                for table in _TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS instances (
+                    path TEXT PRIMARY KEY,
+                    rel_path TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    patient_id TEXT NOT NULL,
+                    study_uid TEXT NOT NULL,
+                    series_uid TEXT NOT NULL,
+                    instance_number INTEGER NOT NULL,
+                    metadata TEXT NOT NULL,
+                    transfer_syntax TEXT,
+                    pixel_layout TEXT,
+                    pixel_stats TEXT,
+                    indexed_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_instances_file_name ON instances(file_name)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_instances_rel_path ON instances(rel_path)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_instances_series "
+                "ON instances(series_uid, instance_number, rel_path)"
+            )
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS patients (
+                    patient_id TEXT PRIMARY KEY,
+                    patient_name TEXT,
+                    study_count INTEGER NOT NULL,
+                    series_count INTEGER NOT NULL,
+                    instance_count INTEGER NOT NULL,
+                    representative_path TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS studies (
+                    study_uid TEXT PRIMARY KEY,
+                    patient_id TEXT NOT NULL,
+                    study_date TEXT NOT NULL,
+                    study_description TEXT,
+                    modalities TEXT,
+                    series_count INTEGER NOT NULL,
+                    instance_count INTEGER NOT NULL,
+                    representative_path TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_patient ON studies(patient_id, study_date, study_uid)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS series (
+                    series_uid TEXT PRIMARY KEY,
+                    study_uid TEXT NOT NULL,
+                    series_number INTEGER NOT NULL,
+                    series_description TEXT,
+                    modality TEXT,
+                    body_part TEXT,
+                    instance_count INTEGER NOT NULL,
+                    representative_path TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_series_study ON series(study_uid, series_number, series_uid)")
+            # Índices secundarios para la búsqueda (search)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_date ON studies(study_date, study_uid)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_series_modality ON series(modality, study_uid)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_series_body_part ON series(body_part, study_uid)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS series_stats (
+                    series_uid TEXT PRIMARY KEY,
+                    signature TEXT NOT NULL,
+                    stats TEXT NOT NULL
+                )
+            """)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO index_info (key, value) VALUES ('schema_version', ?)",
+                (str(SCHEMA_VERSION),)
+            )
+
+    # ===== SINCRONIZACIÓN =====
+
+    def _scan_files(self) -> Tuple[Dict[str, os.stat_result], List[str]]:
+        """Recorrer la carpeta DICOM y devolver ({ruta .dcm: stat}, [rutas DICOMDIR])"""
+        found = {}
+        dicomdirs = []
+        for root, dirs, files in os.walk(self.dicom_folder):
+            dirs.sort()
+            for file in sorted(files):
+                full_path = os.path.join(root, file)
+                if file.upper() == 'DICOMDIR':
+                    dicomdirs.append(full_path)
+                elif file.lower().endswith('.dcm'):
+                    try:
+                        found[full_path] = os.stat(full_path)
+                    except OSError:
+                        continue
+        return found, dicomdirs
+
+    def _read_dicomdirs(self, dicomdirs: List[str],
+                        reader: Callable[[str], Dict[str, Dict[str, Any]]]) -> Tuple[Dict[str, Dict[str, Any]], set]:
+        """
+        Metadatos de las instancias referenciadas por cada DICOMDIR
+
+        Cada DICOMDIR se lee una sola vez por proceso y solo se vuelve a leer
+        si cambia su (mtime, tamaño). Devuelve {archivo: metadatos} y el
+        conjunto de archivos cuyo DICOMDIR cambió (hay que reindexarlos).
+        """
+        metadata: Dict[str, Dict[str, Any]] = {}
+        refreshed = set()
+        for dicomdir in dicomdirs:
+            try:
+                st = os.stat(dicomdir)
+                signature = (st.st_mtime, st.st_size)
+                cached = self._dicomdirs.get(dicomdir)
+                if cached is None or cached[0] != signature:
+                    entries = reader(dicomdir)
+                    if cached is not None:
+                        refreshed.update(entries)
+                    self._dicomdirs[dicomdir] = (signature, entries)
+                    logger.info(f"📁 DICOMDIR leído: {dicomdir} ({len(entries)} instancias)")
+                metadata.update(self._dicomdirs[dicomdir][1])
+            except Exception as e:
+                logger.error(f"❌ Error leyendo DICOMDIR {dicomdir}: {e}")
+        return metadata, refreshed
+
+    def sync(self, extractor: Callable[[str], Dict[str, Any]], full: bool = False,
+             dicomdir_reader: Optional[Callable[[str], Dict[str, Dict[str, Any]]]] = None) -> Dict[str, Any]:
+        """
+        Sincronizar el índice con el disco de forma incremental
+
+        Solo se vuelven a leer los archivos nuevos o cuyo (mtime, tamaño)
+        cambió; los archivos borrados se eliminan del índice. Los archivos
+        referenciados por un DICOMDIR (tengan o no extensión .dcm) toman los
+        metadatos de sus registros, sin abrir cada archivo.
+
+        Args:
+            extractor: función que devuelve los metadatos de un archivo
+            full: si es True, descarta el índice y lo reconstruye completo
+            dicomdir_reader: función que devuelve {archivo: metadatos} de un DICOMDIR
+        """
+        with self._sync_lock:
+            started = datetime.now()
+            on_disk, dicomdirs = self._scan_files()
+            from_dicomdir: Dict[str, Dict[str, Any]] = {}
+            refreshed: set = set()
+            if dicomdir_reader is not None and dicomdirs:
+                if full:
+                    self._dicomdirs.clear()
+                from_dicomdir, refreshed = self._read_dicomdirs(dicomdirs, dicomdir_reader)
+                for path in from_dicomdir:
+                    try:
+                        on_disk[path] = os.stat(path)
+                    except OSError:
+                        continue
+
+            with self._connect() as conn:
+                if full:
+                    conn.execute("DELETE FROM instances")
+                    known = {}
+                else:
+                    known = {
+                        row["path"]: (row["mtime"], row["size"])
+                        for row in conn.execute("SELECT path, mtime, size FROM instances")
+                    }
+
+                removed = [path for path in known if path not in on_disk]
+                changed = [
+                    path for path, st in on_disk.items()
+                    if known.get(path) != (st.st_mtime, st.st_size) or path in refreshed
+                ]
+
+                rows = []
+                errors = 0
+                for path in changed:
+                    try:
+                        metadata = from_dicomdir.get(path) or extractor(path)
+                    except Exception as e:
+                        logger.error(f"❌ Error indexando {path}: {e}")
+                        errors += 1
+                        continue
+                    st = on_disk[path]
+                    layout = metadata.pop('pixel_layout', None)
+                    transfer_syntax = metadata.pop('transfer_syntax', None)
+                    rows.append((
+                        path,
+                        os.path.relpath(path, self.dicom_folder).replace('\\', '/'),
+                        os.path.basename(path),
+                        st.st_mtime,
+                        st.st_size,
+                        metadata.get('patient_id', 'N/A'),
+                        metadata.get('study_instance_uid', 'N/A'),
+                        metadata.get('series_instance_uid', 'N/A'),
+                        _to_int(metadata.get('instance_number')),
+                        json.dumps(metadata, ensure_ascii=False),
+                        transfer_syntax,
+                        json.dumps(layout) if layout is not None else None,
+                        datetime.now().isoformat()
+                    ))
+
+                if removed:
+                    conn.executemany("DELETE FROM instances WHERE path = ?", [(p,) for p in removed])
+                if rows:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO instances "
+                        "(path, rel_path, file_name, mtime, size, patient_id, study_uid, series_uid, "
+                        "instance_number, metadata, transfer_syntax, pixel_layout, indexed_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+                if rows or removed or full:
+                    self._rebuild_hierarchy(conn)
+                    self.generation += 1
+
+            self._last_sync = datetime.now()
+            self._last_sync_stats = {
+                "full_rebuild": full,
+                "files_on_disk": len(on_disk),
+                "dicomdirs": len(dicomdirs),
+                "from_dicomdir": len(from_dicomdir),
+                "indexed": len(rows),
+                "removed": len(removed),
+                "errors": errors,
+                "duration_ms": round((self._last_sync - started).total_seconds() * 1000, 1),
+                "timestamp": self._last_sync.isoformat()
+            }
+
+            if rows or removed:
+                logger.info(
+                    f"🗂️ Índice DICOM actualizado: +{len(rows)} / -{len(removed)} "
+                    f"({self._last_sync_stats['duration_ms']} ms)"
+                )
+            return self._last_sync_stats
+
+    def _rebuild_hierarchy(self, conn: sqlite3.Connection, patient_ids: Optional[List[str]] = None):
+        """
+        Recalcular las tablas patients/studies/series a partir de instances
+
+        Se ejecuta solo cuando la sincronización detecta cambios, así las
+        consultas jerárquicas nunca agrupan instancias en tiempo de request.
+        Con `patient_ids` solo se recalculan las filas de esos pacientes.
+        """
+        scope = ""
+        scope_params: List[Any] = []
+        if patient_ids is not None:
+            scope = f" WHERE patient_id IN ({', '.join('?' * len(patient_ids))})"
+            scope_params = list(patient_ids)
+
+        series: Dict[str, Dict[str, Any]] = {}
+        for row in conn.execute(
+            "SELECT path, patient_id, study_uid, series_uid, metadata FROM instances"
+            f"{scope} ORDER BY series_uid, instance_number, path",
+            scope_params
+        ):
+            entry = series.setdefault(row["series_uid"], {
+                "study_uid": row["study_uid"],
+                "patient_id": row["patient_id"],
+                "metadata": json.loads(row["metadata"]),
+                "paths": []
+            })
+            entry["paths"].append(row["path"])
+
+        studies: Dict[str, Dict[str, Any]] = {}
+        series_rows = []
+        for series_uid, entry in series.items():
+            metadata = entry["metadata"]
+            paths = entry["paths"]
+            series_rows.append((
+                series_uid,
+                entry["study_uid"],
+                _to_int(metadata.get('series_number')),
+                metadata.get('series_description'),
+                metadata.get('modality'),
+                metadata.get('body_part'),
+                len(paths),
+                paths[len(paths) // 2]
+            ))
+
+            study = studies.setdefault(entry["study_uid"], {
+                "patient_id": entry["patient_id"],
+                "metadata": metadata,
+                "modalities": set(),
+                "series_count": 0,
+                "instance_count": 0,
+                "largest_series": paths
+            })
+            study["modalities"].add(metadata.get('modality', 'N/A'))
+            study["series_count"] += 1
+            study["instance_count"] += len(paths)
+            if len(paths) > len(study["largest_series"]):
+                study["largest_series"] = paths
+
+        patients: Dict[str, Dict[str, Any]] = {}
+        study_rows = []
+        for study_uid, study in studies.items():
+            metadata = study["metadata"]
+            representative = study["largest_series"][len(study["largest_series"]) // 2]
+            study_rows.append((
+                study_uid,
+                study["patient_id"],
+                metadata.get('study_date_raw', ''),
+                metadata.get('study_description'),
+                "\\".join(sorted(study["modalities"])),
+                study["series_count"],
+                study["instance_count"],
+                representative
+            ))
+
+            patient = patients.setdefault(study["patient_id"], {
+                "patient_name": metadata.get('patient_name'),
+                "study_count": 0,
+                "series_count": 0,
+                "instance_count": 0,
+                "representative_path": representative
+            })
+            patient["study_count"] += 1
+            patient["series_count"] += study["series_count"]
+            patient["instance_count"] += study["instance_count"]
+
+        patient_rows = [
+            (patient_id, p["patient_name"], p["study_count"], p["series_count"],
+             p["instance_count"], p["representative_path"])
+            for patient_id, p in patients.items()
+        ]
+
+        if patient_ids is None:
+            for table in ("patients", "studies", "series"):
+                conn.execute(f"DELETE FROM {table}")
+        else:
+            conn.execute(
+                f"DELETE FROM series WHERE study_uid IN (SELECT study_uid FROM studies{scope})", scope_params
+            )
+            conn.execute(
+                "DELETE FROM series WHERE series_uid IN "
+                f"(SELECT DISTINCT series_uid FROM instances{scope})", scope_params
+            )
+            conn.execute(f"DELETE FROM studies{scope}", scope_params)
+            conn.execute(
+                "DELETE FROM studies WHERE study_uid IN "
+                f"(SELECT DISTINCT study_uid FROM instances{scope})", scope_params
+            )
+            conn.execute(f"DELETE FROM patients{scope}", scope_params)
+        conn.executemany("INSERT INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?)", series_rows)
+        conn.executemany("INSERT INTO studies VALUES (?, ?, ?, ?, ?, ?, ?, ?)", study_rows)
+        conn.executemany("INSERT INTO patients VALUES (?, ?, ?, ?, ?, ?)", patient_rows)
+
+    @property
+    def has_synced(self) -> bool:
+        """Si ya hubo al menos una sincronización en este proceso"""
+        return self._last_sync is not None
+
+    def is_fresh(self, max_age_seconds: int) -> bool:
+        """Verificar si la última sincronización es reciente"""
+        if self._last_sync is None:
+            return False
+        elapsed = (datetime.now() - self._last_sync).total_seconds()
+        return elapsed < max_age_seconds
+
+    # ===== CONSULTAS =====
+
+    @staticmethod
+    def _row_to_metadata(row: sqlite3.Row) -> Dict[str, Any]:
+        metadata = json.loads(row["metadata"])
+        metadata['file_path'] = row["path"]
+        return metadata
+
+    def list_instances(self) -> List[Dict[str, Any]]:
+        """Metadatos de todas las instancias, ordenadas por ruta"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path, metadata FROM instances ORDER BY path").fetchall()
+        return [self._row_to_metadata(row) for row in rows]
+
+    def get_instance(self, file_name: str) -> Optional[Dict[str, Any]]:
+        """Buscar una instancia por ruta relativa, sufijo de ruta o, en su defecto, por nombre"""
+        normalized = file_name.replace('\\', '/')
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT path, metadata FROM instances WHERE rel_path = ?", (normalized,)
+            ).fetchone()
+            if row is None and '/' in normalized:
+                row = conn.execute(
+                    "SELECT path, metadata FROM instances WHERE rel_path LIKE ? ESCAPE '\\' "
+                    "ORDER BY path LIMIT 1",
+                    ('%/' + normalized.replace('%', '\\%').replace('_', '\\_'),)
+                ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT path, metadata FROM instances WHERE file_name = ? ORDER BY path LIMIT 1",
+                    (os.path.basename(normalized),)
+                ).fetchone()
+        return self._row_to_metadata(row) if row else None
+
+    def get_series_paths(self, path: str) -> Tuple[Optional[str], List[str]]:
+        """Serie de una instancia y rutas de todos sus cortes en orden de InstanceNumber"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT series_uid FROM instances WHERE path = ?", (path,)).fetchone()
+        if row is None or row["series_uid"] == 'N/A':
+            return None, []
+        return row["series_uid"], self.get_series_instance_paths(row["series_uid"])
+
+    def get_series_instance_paths(self, series_uid: str) -> List[str]:
+        """Rutas de los cortes de una serie en orden de InstanceNumber"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT path FROM instances WHERE series_uid = ? ORDER BY instance_number, path",
+                (series_uid,)
+            ).fetchall()
+        return [row["path"] for row in rows]
+
+    def get_export_series(self, series_uid: Optional[str] = None,
+                          study_uid: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Series a exportar (una serie o todas las de un estudio) ordenadas por SeriesNumber"""
+        column, value = ("series_uid", series_uid) if series_uid else ("study_uid", study_uid)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT series_uid, study_uid, series_number, series_description, modality "
+                f"FROM series WHERE {column} = ? ORDER BY series_number, series_uid",
+                (value,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _get_pixel_column(self, path: str, st: os.stat_result, column: str) -> Any:
+        """
+        Columna JSON de píxeles (p. ej. pixel_stats) de una instancia,
+        solo si el archivo no cambió desde que se indexó
+
+        Van fuera de `metadata` para que los listados no carguen el histograma
+        ni el layout de cada instancia.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT mtime, size, {column} AS value FROM instances WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or row["value"] is None or (row["mtime"], row["size"]) != (st.st_mtime, st.st_size):
+            return None
+        return json.loads(row["value"])
+
+    def get_pixel_source(self, path: str, st: os.stat_result) -> Optional[Dict[str, Any]]:
+        """
+        Layout de PixelData registrado al indexar (offset, dtype, shape) y
+        origen de los metadatos ('header' o 'dicomdir'), o None si la
+        instancia no está en el índice o el archivo cambió
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT mtime, size, pixel_layout, json_extract(metadata, '$.metadata_source') AS source "
+                "FROM instances WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or (row["mtime"], row["size"]) != (st.st_mtime, st.st_size):
+            return None
+        return {
+            "layout": json.loads(row["pixel_layout"]) if row["pixel_layout"] else None,
+            "metadata_source": row["source"]
+        }
+
+    def get_pixel_stats(self, path: str, st: os.stat_result) -> Optional[Dict[str, Any]]:
+        """Estadísticas de píxeles guardadas para una instancia"""
+        return self._get_pixel_column(path, st, 'pixel_stats')
+
+    def set_pixel_stats(self, path: str, st: os.stat_result, stats: Dict[str, Any]):
+        """Guardar las estadísticas de una instancia (si el archivo sigue igual que en el índice)"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE instances SET pixel_stats = ? WHERE path = ? AND mtime = ? AND size = ?",
+                (json.dumps(stats), path, st.st_mtime, st.st_size)
+            )
+
+    def _series_signature(self, conn: sqlite3.Connection, series_uid: str) -> str:
+        """Digest de (ruta, mtime, tamaño) de los cortes de una serie según el índice"""
+        digest = hashlib.sha256(series_uid.encode('utf-8'))
+        for row in conn.execute(
+            "SELECT path, mtime, size FROM instances WHERE series_uid = ? ORDER BY path", (series_uid,)
+        ):
+            digest.update(f"{row['path']}|{row['mtime']}|{row['size']}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_series_stats(self, series_uid: str) -> Optional[Dict[str, Any]]:
+        """Estadísticas guardadas de una serie, si sus cortes no cambiaron"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT signature, stats FROM series_stats WHERE series_uid = ?", (series_uid,)
+            ).fetchone()
+            if row is None or row["signature"] != self._series_signature(conn, series_uid):
+                return None
+        return json.loads(row["stats"])
+
+    def set_series_stats(self, series_uid: str, stats: Dict[str, Any]):
+        """Guardar las estadísticas de una serie con la firma actual de sus cortes"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO series_stats (series_uid, signature, stats) VALUES (?, ?, ?)",
+                (series_uid, self._series_signature(conn, series_uid), json.dumps(stats))
+            )
+
+    def get_paths_without_layout(self) -> List[Tuple[str, str]]:
+        """
+        Pares (ruta, sintaxis de transferencia) de las instancias sin layout
+        de PixelData cuya sintaxis se conoce
+
+        Las de DICOMDIR sin sintaxis registrada quedan fuera hasta su primera
+        lectura completa.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT path, transfer_syntax FROM instances "
+                "WHERE pixel_layout IS NULL AND transfer_syntax IS NOT NULL "
+                "ORDER BY series_uid, instance_number, path"
+            ).fetchall()
+        return [(row["path"], row["transfer_syntax"]) for row in rows]
+
+    def update_metadata(self, path: str, metadata: Dict[str, Any]):
+        """
+        Reemplazar los metadatos de una instancia (p. ej. al leer su cabecera completa)
+
+        Si la instancia es la que da los metadatos de su serie (la primera) o
+        cambió de paciente/estudio/serie, las filas de patients/studies/series
+        del paciente se recalculan en la misma transacción: modalidad, parte
+        del cuerpo y descripciones dejan de ser los valores provisorios del
+        DICOMDIR.
+        """
+        metadata = dict(metadata)
+        layout = metadata.pop('pixel_layout', None)
+        transfer_syntax = metadata.pop('transfer_syntax', None)
+        keys = (
+            metadata.get('patient_id', 'N/A'),
+            metadata.get('study_instance_uid', 'N/A'),
+            metadata.get('series_instance_uid', 'N/A'),
+            _to_int(metadata.get('instance_number'))
+        )
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT patient_id, study_uid, series_uid, instance_number FROM instances WHERE path = ?", (path,)
+            ).fetchone()
+            if row is None:
+                return
+            conn.execute(
+                "UPDATE instances SET metadata = ?, transfer_syntax = ?, pixel_layout = ?, patient_id = ?, "
+                "study_uid = ?, series_uid = ?, instance_number = ? WHERE path = ?",
+                (json.dumps(metadata, ensure_ascii=False), transfer_syntax,
+                 json.dumps(layout) if layout is not None else None) + keys + (path,)
+            )
+            first = conn.execute(
+                "SELECT path FROM instances WHERE series_uid = ? ORDER BY instance_number, path LIMIT 1",
+                (keys[2],)
+            ).fetchone()
+            if tuple(row) != keys or (first is not None and first["path"] == path):
+                self._rebuild_hierarchy(conn, sorted({row["patient_id"], keys[0]}))
+
+    def iter_paths(self) -> List[Tuple[str, str]]:
+        """Pares (ruta, ruta relativa) de todas las instancias"""
+        with self._connect() as conn:
+            return [(row["path"], row["rel_path"]) for row in conn.execute("SELECT path, rel_path FROM instances")]
+
+    def iter_path_labels(self) -> List[Tuple[str, str, Optional[str], Optional[str]]]:
+        """(ruta, ruta relativa, modalidad, sintaxis de transferencia) de todas las instancias"""
+        with self._connect() as conn:
+            return [
+                (row["path"], row["rel_path"], row["modality"], row["transfer_syntax"])
+                for row in conn.execute(
+                    "SELECT path, rel_path, json_extract(metadata, '$.modality') AS modality, "
+                    "transfer_syntax FROM instances"
+                )
+            ]
+
+    def count(self) -> int:
+        """Número de instancias indexadas"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM instances").fetchone()[0]
+
+    # ===== CONSULTAS JERÁRQUICAS (PACIENTE/ESTUDIO/SERIE/INSTANCIA) =====
+
+    def _representatives(self, conn: sqlite3.Connection, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Metadatos de las instancias representativas de una página"""
+        if not paths:
+            return {}
+        placeholders = ",".join("?" * len(paths))
+        rows = conn.execute(
+            f"SELECT path, metadata FROM instances WHERE path IN ({placeholders})", paths
+        ).fetchall()
+        return {row["path"]: self._row_to_metadata(row) for row in rows}
+
+    def _paginate(self, table: str, columns: str, conditions: List[str], params: List[Any],
+                  key_columns: Tuple[str, ...], descending: bool, cursor: Optional[str],
+                  limit: int) -> Dict[str, Any]:
+        """
+        Paginación por cursor (keyset) sobre una consulta ordenada
+
+        El cursor codifica la clave de ordenamiento del último elemento, así
+        cada página es una búsqueda por índice y no un OFFSET creciente. Los
+        filtros llegan como lista de condiciones (unidas con AND); el total
+        se cuenta con los mismos filtros, sin la condición del cursor.
+        """
+        limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        direction = "DESC" if descending else "ASC"
+        count_where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        count_params = list(params)
+        conditions = list(conditions)
+        params = list(params)
+
+        if cursor:
+            key = decode_cursor(cursor)
+            if len(key) != len(key_columns):
+                raise ValueError(f"Cursor inválido: {cursor}")
+            placeholders = ", ".join("?" * len(key))
+            conditions.append(f"({', '.join(key_columns)}) {'<' if descending else '>'} ({placeholders})")
+            params.extend(key)
+
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = ", ".join(f"{column} {direction}" for column in key_columns)
+        sql = f"SELECT {columns} FROM {table}{where} ORDER BY {order} LIMIT ?"
+        params.append(limit + 1)
+
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+            total = conn.execute(f"SELECT COUNT(*) FROM {table}{count_where}", count_params).fetchone()[0]
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            representatives = self._representatives(
+                conn, [row["representative_path"] for row in rows
+                       if "representative_path" in row.keys() and row["representative_path"]]
+            )
+
+        items = []
+        for row in rows:
+            if "metadata" in row.keys():
+                items.append(self._row_to_metadata(row))
+                continue
+            item = dict(row)
+            if "representative_path" in item:
+                item["representative"] = representatives.get(item.pop("representative_path"))
+            items.append(item)
+
+        next_cursor = None
+        if has_more and rows:
+            next_cursor = encode_cursor(tuple(rows[-1][column] for column in key_columns))
+
+        return {
+            "items": items,
+            "total": total,
+            "limit": limit,
+            "next_cursor": next_cursor
+        }
+
+    def list_patients(self, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+        """Pacientes ordenados por ID"""
+        return self._paginate("patients", "*", [], [], ("patient_id",), False, cursor, limit)
+
+    def list_studies(self, patient_id: Optional[str] = None, cursor: Optional[str] = None,
+                     limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+        """Estudios (opcionalmente de un paciente), los más recientes primero"""
+        conditions, params = ([], []) if patient_id is None else (["patient_id = ?"], [patient_id])
+        return self._paginate(
+            "studies", "*", conditions, params, ("study_date", "study_uid"), True, cursor, limit
+        )
+
+    def list_series(self, study_uid: str, cursor: Optional[str] = None,
+                    limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+        """Series de un estudio ordenadas por SeriesNumber"""
+        return self._paginate(
+            "series", "*", ["study_uid = ?"], [study_uid],
+            ("series_number", "series_uid"), False, cursor, limit
+        )
+
+    def list_series_instances(self, series_uid: str, cursor: Optional[str] = None,
+                              limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+        """
+        Instancias de una serie ordenadas por InstanceNumber
+
+        El desempate del cursor es rel_path: la ruta absoluta no debe salir
+        del servidor dentro del cursor.
+        """
+        return self._paginate(
+            "instances", "path, rel_path, instance_number, metadata", ["series_uid = ?"], [series_uid],
+            ("instance_number", "rel_path"), False, cursor, limit
+        )
+
+    # ===== BÚSQUEDA (ESTILO QIDO) =====
+
+    def search(self, level: str = "studies", patient_id: Optional[str] = None,
+               modality: Optional[str] = None, study_date: Optional[str] = None,
+               body_part: Optional[str] = None, description: Optional[str] = None,
+               fields: Optional[List[str]] = None, cursor: Optional[str] = None,
+               limit: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+        """
+        Buscar estudios o series por paciente, modalidad, rango de fechas,
+        parte del cuerpo y subcadena de descripción
+
+        Modalidad y parte del cuerpo se resuelven con los índices de la tabla
+        series, la fecha con el de studies; todos los filtros se combinan con
+        AND. A nivel de estudios, modalidad y parte del cuerpo deben cumplirse
+        en una misma serie. Solo se seleccionan las columnas de `fields`.
+        """
+        if level not in SEARCH_FIELDS:
+            raise ValueError(f"Nivel de búsqueda desconocido: {level} (disponibles: {', '.join(SEARCH_FIELDS)})")
+        available = SEARCH_FIELDS[level]
+        fields = list(fields or DEFAULT_SEARCH_FIELDS[level])
+        unknown = [name for name in fields if name not in available]
+        if unknown:
+            raise ValueError(f"Campos desconocidos: {', '.join(unknown)} (disponibles: {', '.join(available)})")
+
+        # Filtros expresados sobre studies (la serie los hereda por study_uid)
+        study_conditions: List[str] = []
+        study_params: List[Any] = []
+        if patient_id:
+            study_conditions.append("patient_id = ?")
+            study_params.append(patient_id)
+        if study_date:
+            start, end = parse_date_range(study_date)
+            if start:
+                study_conditions.append("study_date >= ?")
+                study_params.append(start)
+            if end:
+                study_conditions.append("study_date <= ?")
+                study_params.append(end)
+
+        # Filtros expresados sobre series
+        series_conditions: List[str] = []
+        series_params: List[Any] = []
+        if modality:
+            series_conditions.append("modality = ?")
+            series_params.append(modality.strip().upper())
+        if body_part:
+            series_conditions.append("body_part = ?")
+            series_params.append(body_part.strip().upper())
+
+        conditions: List[str] = []
+        params: List[Any] = []
+        if level == "studies":
+            conditions += study_conditions
+            params += study_params
+            # Una sola subconsulta: la misma serie debe cumplir todos los filtros
+            if series_conditions:
+                conditions.append(
+                    f"study_uid IN (SELECT study_uid FROM series WHERE {' AND '.join(series_conditions)})"
+                )
+                params += series_params
+            if description:
+                conditions.append(
+                    "(study_description LIKE ? ESCAPE '\\' OR study_uid IN "
+                    "(SELECT study_uid FROM series WHERE series_description LIKE ? ESCAPE '\\'))"
+                )
+                params += [_like_pattern(description)] * 2
+        else:
+            conditions += series_conditions
+            params += series_params
+            if study_conditions:
+                conditions.append(
+                    f"study_uid IN (SELECT study_uid FROM studies WHERE {' AND '.join(study_conditions)})"
+                )
+                params += study_params
+            if description:
+                conditions.append(
+                    "(series_description LIKE ? ESCAPE '\\' OR study_uid IN "
+                    "(SELECT study_uid FROM studies WHERE study_description LIKE ? ESCAPE '\\'))"
+                )
+                params += [_like_pattern(description)] * 2
+
+        key_columns, descending = _SEARCH_ORDER[level]
+        selected = list(dict.fromkeys(fields + list(key_columns)))
+        columns = ", ".join(
+            available[name] if available[name] == name else f"{available[name]} AS {name}"
+            for name in selected
+        )
+        page = self._paginate(level, columns, conditions, params, key_columns, descending, cursor, limit)
+        page["items"] = [{name: item[name] for name in fields} for item in page["items"]]
+        page["level"] = level
+        page["fields"] = fields
+        return page
+
+    def get_status(self) -> Dict[str, Any]:
+        """Estado del índice para health checks"""
+        with self._connect() as conn:
+            counts = {
+                table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in _TABLES
+            }
+        return {
+            "db_path": self.db_path,
+            "schema_version": SCHEMA_VERSION,
+            **counts,
+            "last_sync": self._last_sync_stats or None
+        }
+
+
+class DicomPathMap:
+    """
+    Mapa en memoria ruta pedida -> ruta absoluta con búsqueda O(1)
+
+    Cada instancia se registra bajo su ruta almacenada, su ruta absoluta y
+    todos los sufijos de su ruta relativa ('serie/imagen.dcm', 'imagen.dcm'...).
+    Si un sufijo corresponde a varios archivos se resuelve siempre al primero
+    en orden lexicográfico y se reporta como ambiguo.
+    """
+
+    def __init__(self):
+        self._by_key: Dict[str, List[str]] = {}
+        self._labels: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.generation = -1
+        self.ambiguous_keys = 0
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        normalized = path.replace('\\', '/')
+        while normalized.startswith('./'):
+            normalized = normalized[2:]
+        return normalized
+
+    def rebuild(self, entries: List[Tuple[str, str, Optional[str], Optional[str]]], generation: int):
+        """
+        Reconstruir el mapa completo (se reemplaza de forma atómica)
+
+        Las entradas son las de DicomIndex.iter_path_labels: además de la ruta
+        se guardan la modalidad y la sintaxis de cada instancia, para
+        etiquetar la etapa resolve sin consultar el índice.
+        """
+        by_key: Dict[str, List[str]] = {}
+        labels: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        for path, rel_path, modality, transfer_syntax in sorted(entries, key=lambda entry: entry[:2]):
+            keys = {self._normalize(path), self._normalize(os.path.abspath(path))}
+            parts = self._normalize(rel_path).split('/')
+            keys.update('/'.join(parts[i:]) for i in range(len(parts)))
+            for key in keys:
+                by_key.setdefault(key, []).append(path)
+            labels[path] = (modality, transfer_syntax)
+
+        self._by_key = by_key
+        self._labels = labels
+        self.generation = generation
+        self.ambiguous_keys = sum(1 for paths in by_key.values() if len(paths) > 1)
+        logger.info(f"🧭 Mapa de rutas DICOM: {len(by_key)} claves ({self.ambiguous_keys} ambiguas)")
+
+    def resolve(self, file_path: str) -> List[str]:
+        """Candidatos ordenados para una ruta pedida (lista vacía si no existe)"""
+        return self._by_key.get(self._normalize(file_path), [])
+
+    def labels(self, path: str) -> Tuple[Optional[str], Optional[str]]:
+        """(modalidad, sintaxis de transferencia) de una ruta resuelta; (None, None) si no está"""
+        return self._labels.get(path, (None, None))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._by_key),
+            "ambiguous_keys": self.ambiguous_keys,
+            "generation": self.generation
+        }
@@ -0,0 +1,190 @@
+"""
+Tiempos por etapa del pipeline de render DICOM
+
+Cada conversión junta la duración de sus etapas (lectura, decodificación,
+normalización, PIL, codificación...) en un StageTimings; el proceso
+principal las acumula en histogramas de latencia con buckets logarítmicos,
+por etapa y por grupo (modalidad + sintaxis de transferencia). Medir una
+etapa fuera de una conversión no cuesta nada: `stage` no hace nada si no
+hay un StageTimings activo.
+"""
+import math
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Orden en que se reportan las etapas
+STAGES = ("resolve", "dcmread", "decode", "rescale", "normalize", "pil", "encode", "total")
+
+# Buckets: límites superiores en ms, crecimiento de 10% entre 0.01 ms y 120 s
+_BUCKET_GROWTH = 1.1
+BUCKET_BOUNDS: Tuple[float, ...] = tuple(
+    0.01 * _BUCKET_GROWTH ** i
+    for i in range(int(math.log(120_000 / 0.01, _BUCKET_GROWTH)) + 2)
+)
+
+REPORTED_PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class StageTimings:
+    """Duraciones (ms) de las etapas de una conversión, sus etiquetas y sus codificaciones"""
+    stages: Dict[str, float] = field(default_factory=dict)
+    modality: str = "N/A"
+    transfer_syntax: str = "Unknown"
+    # (formato, ms, bytes) de cada imagen codificada: vuelven al proceso principal con los tiempos
+    encodes: List[Tuple[str, float, int]] = field(default_factory=list)
+
+
+_current: ContextVar[Optional[StageTimings]] = ContextVar("dicom_stage_timings", default=None)
+
+
+@contextmanager
+def collect_stages() -> Iterator[StageTimings]:
+    """Activar la medición de etapas para el código dentro del bloque"""
+    timings = StageTimings()
+    token = _current.set(timings)
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings.stages["total"] = (time.perf_counter() - started) * 1000
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Medir una etapa (se suma si la misma etapa ocurre varias veces)"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        timings.stages[name] = timings.stages.get(name, 0.0) + elapsed
+
+
+def set_labels(modality: str, transfer_syntax: str):
+    """Etiquetar la conversión en curso (modalidad y sintaxis de transferencia)"""
+    timings = _current.get()
+    if timings is not None:
+        timings.modality = modality
+        timings.transfer_syntax = transfer_syntax
+
+
+def record_encode(image_format: str, elapsed_ms: float, nbytes: int) -> bool:
+    """Anotar una codificación en la conversión en curso (False si no hay ninguna activa)"""
+    timings = _current.get()
+    if timings is None:
+        return False
+    timings.encodes.append((image_format, elapsed_ms, nbytes))
+    return True
+
+
+class LatencyHistogram:
+    """Histograma de latencias con buckets fijos (percentiles con error < 10%)"""
+
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, value_ms: float):
+        self.counts[bisect_left(BUCKET_BOUNDS, value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        if value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def percentile(self, percentile: float) -> float:
+        """Límite superior del bucket que contiene el percentil (acotado al máximo)"""
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                bound = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max_ms
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> Dict[str, Any]:
+        result = {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3)
+        }
+        for percentile in REPORTED_PERCENTILES:
+            result[f"p{percentile}_ms"] = round(self.percentile(percentile), 3) if self.count else None
+        return result
+
+
+class PipelineMetrics:
+    """Histogramas por etapa: globales y por (modalidad, sintaxis de transferencia)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._overall: Dict[str, LatencyHistogram] = {}
+        self._groups: Dict[Tuple[str, str], Dict[str, LatencyHistogram]] = {}
+        self.started_at = datetime.now().isoformat()
+
+    def record(self, timings: StageTimings):
+        """Sumar las etapas de una conversión"""
+        group_key = (timings.modality, timings.transfer_syntax)
+        with self._lock:
+            group = self._groups.setdefault(group_key, {})
+            for name, elapsed in timings.stages.items():
+                self._overall.setdefault(name, LatencyHistogram()).add(elapsed)
+                group.setdefault(name, LatencyHistogram()).add(elapsed)
+
+    def record_stage(self, name: str, elapsed_ms: float, modality: Optional[str] = None,
+                     transfer_syntax: Optional[str] = None):
+        """
+        Etapa medida fuera de una conversión (p. ej. resolver la ruta)
+
+        Con modalidad y sintaxis también se suma a su grupo; sin ellas, solo global.
+        """
+        with self._lock:
+            self._overall.setdefault(name, LatencyHistogram()).add(elapsed_ms)
+            if modality is not None and transfer_syntax is not None:
+                group = self._groups.setdefault((modality, transfer_syntax), {})
+                group.setdefault(name, LatencyHistogram()).add(elapsed_ms)
+
+    @staticmethod
+    def _ordered(histograms: Dict[str, LatencyHistogram]) -> Dict[str, Dict[str, Any]]:
+        names = [name for name in STAGES if name in histograms]
+        names += sorted(name for name in histograms if name not in STAGES)
+        return {name: histograms[name].summary() for name in names}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """p50/p95/p99 por etapa, global y por grupo"""
+        with self._lock:
+            groups: List[Dict[str, Any]] = [
+                {
+                    "modality": modality,
+                    "transfer_syntax": transfer_syntax,
+                    "stages": self._ordered(histograms)
+                }
+                for (modality, transfer_syntax), histograms in sorted(self._groups.items())
+            ]
+            return {
+                "since": self.started_at,
+                "stages": self._ordered(self._overall),
+                "groups": groups
+            }
+
+    def reset(self):
+        with self._lock:
+            self._overall.clear()
+            self._groups.clear()
+            self.started_at = datetime.now().isoformat()
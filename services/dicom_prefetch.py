@@ -0,0 +1,192 @@
+"""
+Precarga en segundo plano de series DICOM
+
+Cuando se abre el primer corte de una serie, los cortes vecinos se renderizan
+en background hacia el cache de imágenes, del más cercano al más lejano. Cada
+serie abierta (hasta un límite) tiene su propia precarga.
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _ActivePrefetch:
+    """Precarga de una serie con unos parámetros de render"""
+    task: asyncio.Task
+    paths: frozenset
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class SeriesPrefetcher:
+    """
+    Planificador de precarga por (serie, parámetros de render)
+
+    - Cada serie abierta tiene su propia precarga; varios visores en series
+      distintas no se cancelan entre sí
+    - Una precarga se cancela cuando su serie queda inactiva (sin requests
+      durante `idle_seconds`), cuando hace falta lugar para otra serie
+      (`max_series`, se descarta la usada hace más tiempo) o cuando la misma
+      serie se abre con otros parámetros de render
+    - `concurrency` limita cuántos cortes se renderizan en paralelo entre
+      todas las series
+    - Mientras el pool esté cargado (`can_render` devuelve False) la precarga
+      espera, para no quitarle capacidad a los requests del usuario
+    """
+
+    def __init__(self, render: Callable[[str, Dict[str, Any]], Awaitable[Any]],
+                 concurrency: int = 2, max_slices: int = 0,
+                 can_render: Optional[Callable[[], bool]] = None,
+                 busy_errors: Tuple[type, ...] = (),
+                 max_series: int = 4, idle_seconds: float = 30):
+        self._render = render
+        self.concurrency = concurrency
+        self.max_slices = max_slices
+        self.max_series = max(1, max_series)
+        self.idle_seconds = idle_seconds
+        self._can_render = can_render or (lambda: True)
+        self._busy_errors = busy_errors
+
+        # (serie, parámetros) -> precarga, de la usada hace más tiempo a la más reciente
+        self._active: "OrderedDict[Tuple[str, tuple], _ActivePrefetch]" = OrderedDict()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Contadores
+        self.scheduled = 0
+        self.cancelled = 0
+        self.rendered = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def is_active_for(self, path: str, render_params: Dict[str, Any]) -> bool:
+        """
+        True si alguna precarga ya cubre este corte con estos parámetros
+
+        Cuenta como uso de esa serie: la mantiene activa y al final del LRU.
+        """
+        self._expire_idle()
+        params_key = tuple(sorted(render_params.items()))
+        for key, active in self._active.items():
+            if key[1] == params_key and path in active.paths:
+                active.last_used = time.monotonic()
+                self._active.move_to_end(key)
+                return True
+        return False
+
+    def schedule(self, series_key: str, paths: List[str], current_path: str,
+                 render_params: Dict[str, Any]) -> bool:
+        """
+        Empezar la precarga de una serie alrededor de `current_path`
+
+        Devuelve False si no había nada que hacer (desactivado, serie de un
+        solo corte o precarga ya activa para esta serie).
+        """
+        if not self.enabled or len(paths) < 2 or current_path not in paths:
+            return False
+
+        key = (series_key, tuple(sorted(render_params.items())))
+        if key in self._active:
+            self._active[key].last_used = time.monotonic()
+            self._active.move_to_end(key)
+            return False
+
+        loop = asyncio.get_running_loop()
+        # Precargas de un event loop anterior (p. ej. otro asyncio.run): ya no corren
+        for stale in [other for other, active in self._active.items() if active.task.get_loop() is not loop]:
+            del self._active[stale]
+        self._expire_idle()
+        # La misma serie con otra ventana/formato: la precarga anterior ya no sirve
+        for other in [other for other in self._active if other[0] == series_key]:
+            self._cancel(other)
+        while len(self._active) >= self.max_series:
+            self._cancel(next(iter(self._active)))
+
+        center = paths.index(current_path)
+        order = sorted(
+            (i for i in range(len(paths)) if i != center),
+            key=lambda i: (abs(i - center), i)
+        )
+        if self.max_slices > 0:
+            order = order[:self.max_slices]
+
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots, self._slots_loop = asyncio.Semaphore(self.concurrency), loop
+        task = loop.create_task(
+            self._run([paths[i] for i in order], dict(render_params))
+        )
+        self._active[key] = _ActivePrefetch(task=task, paths=frozenset(paths))
+        self.scheduled += 1
+        logger.info(f"🚀 Precarga de serie iniciada: {len(order)} cortes ({series_key})")
+        return True
+
+    def _expire_idle(self):
+        """Descartar las series sin requests durante `idle_seconds`"""
+        limit = time.monotonic() - self.idle_seconds
+        for key in [key for key, active in self._active.items() if active.last_used < limit]:
+            self._cancel(key)
+
+    def _cancel(self, key: Tuple[str, tuple]):
+        active = self._active.pop(key)
+        if not active.task.done() and not active.task.get_loop().is_closed():
+            active.task.cancel()
+            self.cancelled += 1
+            logger.info(f"🛑 Precarga cancelada: {key[0]}")
+
+    def cancel(self):
+        """Cancelar todas las precargas (al cerrar el servicio)"""
+        for key in list(self._active):
+            self._cancel(key)
+
+    async def _run(self, paths: List[str], render_params: Dict[str, Any]):
+        queue = iter(paths)
+
+        async def worker():
+            for path in queue:
+                async with self._slots:
+                    await self._render_one(path, render_params)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(paths)))))
+        logger.info(f"✅ Precarga de serie completada: {len(paths)} cortes")
+
+    async def _render_one(self, path: str, render_params: Dict[str, Any]):
+        while True:
+            if not self._can_render():
+                await asyncio.sleep(0.05)
+                continue
+            try:
+                await self._render(path, render_params)
+                self.rendered += 1
+                return
+            except self._busy_errors:
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"⚠️ Error precargando {path}: {e}")
+                return
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estado de la precarga para health checks"""
+        return {
+            "enabled": self.enabled,
+            "concurrency": self.concurrency,
+            "max_slices": self.max_slices,
+            "max_series": self.max_series,
+            "idle_seconds": self.idle_seconds,
+            "active_series": [key[0] for key in self._active],
+            "running": sum(not active.task.done() for active in self._active.values()),
+            "scheduled": self.scheduled,
+            "cancelled": self.cancelled,
+            "rendered": self.rendered,
+            "errors": self.errors
+        }
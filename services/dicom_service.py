@@ -1,25 +1,212 @@
 import os
-import glob
 import pydicom
+from pydicom.fileset import FileSet
+from pydicom.uid import UID
 import numpy as np
 from PIL import Image
 import io
 import logging
 import traceback
+import asyncio
+import dataclasses
+import functools
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter
+from itertools import repeat
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from services.dicom_index import DicomIndex, DicomPathMap
+from services.dicom_cache import LRUByteCache, DiskRenderCache
+from services.dicom_prefetch import SeriesPrefetcher
+from services.dicom_cine import CineSession
+from services.dicom_export import ZipExport, build_export_items, safe_filename
+from services.dicom_transcode import TranscodeStore
+from services.dicom_metrics import (
+    PipelineMetrics, StageTimings, collect_stages, record_encode, set_labels, stage
+)
+from services.dicom_volume import (
+    VolumeStore, plane_spacing, project_slab, reformat, slab_range, slice_geometry, sort_slices
+)
+from services.dicom_imaging import (
+    DEFAULT_JPEG_QUALITY, PYRAMID_LEVELS, DecodedSlice, apply_window, downsample_area, header_window,
+    percentile_window, pixel_layout, pixel_statistics, rescale_params, rescale_pixels, stats_from_counts,
+    stats_from_values, value_counts
+)
 
 logger = logging.getLogger(__name__)
 
+
+# Tags que expone extract_dicom_metadata (lectura "tags")
+METADATA_TAGS = [
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+    'StudyDate', 'StudyTime', 'StudyDescription', 'SeriesDescription',
+    'Modality', 'BodyPartExamined', 'InstitutionName', 'Manufacturer',
+    'ManufacturerModelName', 'Rows', 'Columns', 'PixelSpacing', 'SliceThickness',
+    'WindowCenter', 'WindowWidth', 'StudyInstanceUID', 'SeriesInstanceUID',
+    'SOPInstanceUID', 'SeriesNumber', 'InstanceNumber'
+]
+
+# Elementos más grandes que esto se leen recién al accederlos (lectura "deferred")
+DEFER_SIZE = os.getenv("DICOM_DEFER_SIZE", "16 KB")
+
+READ_MODES = ("full", "header", "tags", "deferred")
+
+# Subir cuando cambie el resultado del render: las imágenes viejas del cache en disco dejan de usarse
+RENDER_VERSION = 2
+
+
+def read_dicom_dataset(file_path: str, mode: str = "full", force: bool = False):
+    """
+    Leer un archivo DICOM según el modo
+    
+    - full: todo el archivo, PixelData incluido (lectura original)
+    - header: hasta antes de PixelData (stop_before_pixels)
+    - tags: solo METADATA_TAGS, sin PixelData
+    - deferred: cabecera completa; los elementos grandes (PixelData) se leen
+      del disco recién cuando se accede a ellos
+    """
+    if mode == "header":
+        return pydicom.dcmread(file_path, stop_before_pixels=True, force=force)
+    if mode == "tags":
+        return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=METADATA_TAGS, force=force)
+    if mode == "deferred":
+        return pydicom.dcmread(file_path, defer_size=DEFER_SIZE, force=force)
+    if mode == "full":
+        return pydicom.dcmread(file_path, force=force)
+    raise ValueError(f"Modo de lectura desconocido: {mode} (disponibles: {', '.join(READ_MODES)})")
+
+
+class DicomRenderBusyError(RuntimeError):
+    """La cola de renderizado está llena (el endpoint responde 503)"""
+
+
+# Servicio propio de cada proceso del pool (modo "process")
+_worker_service = None
+
+
+def _init_render_worker(dicom_folder: str, cache_folder: str):
+    """Inicializador de cada proceso del pool de renderizado"""
+    global _worker_service
+    _worker_service = DicomService(dicom_folder=dicom_folder, cache_folder=cache_folder)
+    # La transcodificación la coordina el proceso principal
+    _worker_service.transcode_on_ingest = False
+
+
+def _call_in_worker(method_name: str, *args):
+    """Ejecutar un método del servicio dentro de un proceso del pool"""
+    return getattr(_worker_service, method_name)(*args)
+
+
 class DicomService:
     """
     Servicio para manejo de archivos DICOM con logging completo para debug
     """
     
-    def __init__(self):
-        self.DICOM_FOLDER = r"C:\Users\acairamp\Documents\proyecto\Curso\pythonn\front\hospital-app\data\dicom"
+    def __init__(self, dicom_folder: Optional[str] = None, cache_folder: Optional[str] = None):
+        self.DICOM_FOLDER = dicom_folder or os.getenv(
+            "DICOM_FOLDER",
+            r"C:\Users\acairamp\Documents\proyecto\Curso\pythonn\front\hospital-app\data\dicom"
+        )
+        self.CACHE_FOLDER = cache_folder or os.getenv("DICOM_CACHE_FOLDER", "data/cache/dicom")
         logger.info(f"🩻 DicomService inicializado con carpeta: {self.DICOM_FOLDER}")
         
+        # Logging paso a paso del pipeline (DEBUG); apagado, el hot path no escribe logs
+        self.debug_logging = os.getenv("DICOM_DEBUG_LOG", "0") == "1"
+        if self.debug_logging:
+            logger.setLevel(logging.DEBUG)
+        
+        # Tiempos por etapa de cada conversión (p50/p95/p99)
+        self.metrics = PipelineMetrics()
+        
+        # Índice persistente de metadatos (se sincroniza como máximo cada N segundos)
+        self.index_max_age_seconds = int(os.getenv("DICOM_INDEX_MAX_AGE", "30"))
+        self.index = DicomIndex(os.path.join(self.CACHE_FOLDER, "dicom_index.sqlite3"), self.DICOM_FOLDER)
+        self.path_map = DicomPathMap()
+
+        # Las sincronizaciones corren en un hilo propio; los requests leen lo que ya hay
+        self._index_executor: Optional[ThreadPoolExecutor] = None
+        self._index_future: Optional[Future] = None
+        self._index_refresh_lock = threading.Lock()
+        
+        # Modos de lectura (ver read_dicom_dataset y benchmarks/bench_dicom_read.py)
+        # "deferred" lee los mismos bytes que "header" y además da el offset de
+        # PixelData, que se guarda en el índice para el acceso con memmap
+        self.metadata_read_mode = os.getenv("DICOM_METADATA_READ_MODE", "deferred")
+        self.memmap_enabled = os.getenv("DICOM_MEMMAP_PIXELS", "1") != "0"
+        self.decode_counts = {"memmap": 0, "transcoded": 0, "pydicom": 0}
+        self.render_read_mode = os.getenv("DICOM_RENDER_READ_MODE", "full")
+        
+        # Cache LRU de imágenes ya renderizadas (presupuesto en MB)
+        render_cache_mb = int(os.getenv("DICOM_RENDER_CACHE_MB", "256"))
+        self.render_cache = LRUByteCache(render_cache_mb * 1024 * 1024, name="render")
+        
+        # Cache de píxeles decodificados y reescalados (base de todas las variantes)
+        pixel_cache_mb = int(os.getenv("DICOM_PIXEL_CACHE_MB", "512"))
+        self.pixel_cache = LRUByteCache(
+            pixel_cache_mb * 1024 * 1024, name="decoded_pixels", sizeof=lambda d: d.nbytes
+        )
+        
+        # Cache en disco compartido entre workers (0 = desactivado)
+        disk_cache_mb = int(os.getenv("DICOM_DISK_CACHE_MB", "1024"))
+        self.disk_cache = DiskRenderCache(
+            os.path.join(self.CACHE_FOLDER, "render"), disk_cache_mb * 1024 * 1024
+        ) if disk_cache_mb > 0 else None
+        
+        # Codificación: nivel zlib del PNG (1 = rápido; optimize=True era ~5x más lento)
+        self.png_compress_level = int(os.getenv("DICOM_PNG_COMPRESS_LEVEL", "1"))
+        self._encode_stats: Dict[str, Dict[str, float]] = {}
+        # Protege los contadores que actualizan los hilos del pool (codificación y decodificación)
+        self._stats_lock = threading.Lock()
+        
+        # Estadísticas de píxeles que faltan en el índice: se calculan fuera del render
+        self._stats_executor: Optional[ThreadPoolExecutor] = None
+        self._stats_pending: set = set()
+        
+        # Volúmenes 3D en disco (memmap) y volúmenes abiertos en memoria
+        self.volume_store = VolumeStore(os.path.join(self.CACHE_FOLDER, "volumes"))
+        self._volumes = LRUByteCache(int(os.getenv("DICOM_OPEN_VOLUMES", "8")), name="volumes",
+                                     sizeof=lambda _: 1)
+        self._volume_lock = threading.Lock()
+        
+        # Copias sin compresión de las instancias comprimidas (decodificadas al indexar)
+        self.transcode_store = TranscodeStore(os.path.join(self.CACHE_FOLDER, "pixels"))
+        self.transcode_on_ingest = os.getenv("DICOM_TRANSCODE_ON_INGEST", "1") != "0"
+        self.transcode_workers = int(os.getenv("DICOM_TRANSCODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self._transcode_lock = threading.Lock()
+        self._transcode_executor: Optional[ThreadPoolExecutor] = None
+        self._transcode_future: Optional[Future] = None
+        self.last_transcode: Optional[Dict[str, Any]] = None
+        
+        # Ejecución del pipeline fuera del event loop: "thread", "process" o "inline"
+        self.render_mode = os.getenv("DICOM_RENDER_MODE", "thread").lower()
+        self.render_workers = int(os.getenv("DICOM_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.render_max_pending = int(os.getenv("DICOM_RENDER_MAX_PENDING", "32"))
+        self.render_timeout = float(os.getenv("DICOM_RENDER_TIMEOUT", "30"))
+        self._render_executor: Optional[Executor] = None
+        self._render_pending = 0
+        self.render_rejected = 0
+        self.render_timeouts = 0
+        
+        # Renders en curso por clave de cache (single-flight): los requests
+        # idénticos concurrentes esperan el mismo resultado
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.render_started = 0
+        self.render_coalesced = 0
+        
+        # Precarga de la serie al abrir un corte (0 = desactivada)
+        self.prefetcher = SeriesPrefetcher(
+            render=self._render_cached_async,
+            concurrency=int(os.getenv("DICOM_PREFETCH_CONCURRENCY", "2")),
+            max_slices=int(os.getenv("DICOM_PREFETCH_MAX_SLICES", "0")),
+            can_render=lambda: self._render_pending < self.render_max_pending // 2,
+            busy_errors=(DicomRenderBusyError,),
+            max_series=int(os.getenv("DICOM_PREFETCH_MAX_SERIES", "4")),
+            idle_seconds=float(os.getenv("DICOM_PREFETCH_IDLE_SECONDS", "30"))
+        )
+        
         # Configurar pydicom para ser más permisivo
         pydicom.config.convert_wrong_length_to_UN = True
         pydicom.config.assume_implicit_vr_transfer = True
@@ -51,65 +238,112 @@ class DicomService:
             self.has_pylibjpeg = False
             self.has_gdcm = False
     
+    def _ensure_index(self):
+        """
+        Asegurar que el índice de metadatos esté sincronizado
+
+        Solo la primera sincronización del proceso hace esperar a quien llama;
+        después, un índice vencido se refresca en segundo plano y mientras
+        tanto se responde con los datos actuales.
+        """
+        if not self.index.has_synced:
+            self.schedule_index_refresh().result()
+        elif not self.index.is_fresh(self.index_max_age_seconds):
+            self.schedule_index_refresh()
+
+    async def _ensure_index_async(self):
+        """Igual que _ensure_index pero sin bloquear el event loop en la primera sincronización"""
+        if not self.index.has_synced:
+            await asyncio.wrap_future(self.schedule_index_refresh())
+        elif not self.index.is_fresh(self.index_max_age_seconds):
+            self.schedule_index_refresh()
+
+    def _get_index_executor(self) -> ThreadPoolExecutor:
+        with self._index_refresh_lock:
+            if self._index_executor is None:
+                self._index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dicom-index")
+            return self._index_executor
+
+    def schedule_index_refresh(self) -> Future:
+        """
+        Lanzar la sincronización del índice en su hilo (una sola a la vez)
+
+        Si ya hay una en curso devuelve esa misma, así varios requests con el
+        índice vencido no encolan recorridos repetidos de la carpeta.
+        """
+        executor = self._get_index_executor()
+        with self._index_refresh_lock:
+            if self._index_future is None or self._index_future.done():
+                self._index_future = executor.submit(self._sync_index)
+                self._index_future.add_done_callback(self._on_index_refresh_done)
+            return self._index_future
+
+    def _on_index_refresh_done(self, future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"💥 Error sincronizando el índice DICOM: {future.exception()}")
+
+    def _sync_index(self, full: bool = False) -> Dict[str, Any]:
+        """Sincronizar el índice y, si cambió, reconstruir el mapa de rutas"""
+        stats = self.index.sync(self.extract_dicom_metadata, full=full,
+                                dicomdir_reader=self.extract_dicomdir_metadata)
+        if self.path_map.generation != self.index.generation:
+            self.path_map.rebuild(self.index.iter_path_labels(), self.index.generation)
+        if stats["indexed"] or stats["removed"]:
+            self.schedule_transcode()
+        return stats
+
+    def rebuild_index(self, full: bool = True) -> Dict[str, Any]:
+        """
+        Reconstruye el índice de metadatos bajo demanda
+        """
+        logger.info(f"🗂️ Reconstruyendo índice DICOM (completo={full})")
+        stats = self._sync_index(full=full)
+        self.schedule_transcode()
+        return stats
+
+    async def rebuild_index_async(self, full: bool = True) -> Dict[str, Any]:
+        """Versión asíncrona de rebuild_index (corre en el hilo del índice, detrás de los refrescos)"""
+        return await asyncio.wrap_future(self._get_index_executor().submit(self.rebuild_index, full))
+
+    async def _run_in_thread(self, method_name: str, *args, **kwargs):
+        """
+        Ejecutar una consulta del servicio en el pool de hilos por defecto
+
+        Para las consultas al índice (SQLite): no pasan por el pool de render
+        ni cuentan para su cola.
+        """
+        await self._ensure_index_async()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(getattr(self, method_name), *args, **kwargs))
+    
     def get_dicom_studies(self) -> List[Dict[str, Any]]:
         """
-        Obtiene la lista de estudios DICOM disponibles
+        Obtiene la lista de estudios DICOM disponibles desde el índice
         """
         try:
-            studies = []
-            
-            # Buscar archivos DICOM recursivamente
-            dicom_files = []
-            for root, dirs, files in os.walk(self.DICOM_FOLDER):
-                for file in files:
-                    if file.lower().endswith('.dcm'):
-                        dicom_files.append(os.path.join(root, file))
-            
-            logger.info(f"🩻 Encontrados {len(dicom_files)} archivos DICOM")
-            
-            for file_path in dicom_files:
-                try:
-                    metadata = self.extract_dicom_metadata(file_path)
-                    metadata['file_path'] = file_path
-                    studies.append(metadata)
-                except Exception as e:
-                    logger.error(f"Error procesando {file_path}: {str(e)}")
-                    continue
-            
+            self._ensure_index()
+            studies = self.index.list_instances()
+            logger.info(f"🩻 {len(studies)} archivos DICOM en el índice")
             return studies
             
         except Exception as e:
             logger.error(f"Error obteniendo estudios: {str(e)}")
             raise
     
-    def get_dicom_image(self, file_path: str) -> bytes:
+    async def get_dicom_studies_async(self) -> List[Dict[str, Any]]:
+        """Versión asíncrona de get_dicom_studies (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("get_dicom_studies")
+    
+    def get_dicom_image(self, file_path: str, render_params: Optional[Dict[str, Any]] = None) -> bytes:
         """
         Convierte archivo DICOM a imagen PNG con logging completo
+        
+        render_params viene de dicom_imaging.build_render_params (ventana,
+        preset, inversión); None usa la ventana de la cabecera.
         """
         try:
-            # LOGGING DETALLADO DEL REQUEST
-            logger.info(f"🔍 === INICIO PROCESAMIENTO IMAGEN ===")
-            logger.info(f"🔍 file_path recibido: '{file_path}'")
-            logger.info(f"🔍 tipo: {type(file_path)}")
-            logger.info(f"🔍 longitud: {len(file_path) if file_path else 0}")
-            logger.info(f"🔍 DICOM_FOLDER: {self.DICOM_FOLDER}")
-            
-            if not file_path:
-                raise ValueError("file_path está vacío")
-            
-            # Encontrar el archivo
-            full_path = self._find_dicom_file_debug(file_path)
-            if not full_path:
-                raise FileNotFoundError(f"Archivo DICOM no encontrado: {file_path}")
-            
-            logger.info(f"🎯 Archivo encontrado: {full_path}")
-            
-            # Verificar que existe
-            if not os.path.exists(full_path):
-                raise FileNotFoundError(f"El archivo no existe en el sistema: {full_path}")
-            
-            # Procesar imagen
-            result_bytes = self.dicom_to_image_debug(full_path)
+            full_path = self._resolve_image_request(file_path)
+            result_bytes = self._render_cached(full_path, render_params or {"format": "png"})
             
             logger.info(f"✅ Imagen procesada exitosamente: {len(result_bytes)} bytes")
             logger.info(f"🔍 === FIN PROCESAMIENTO IMAGEN ===")
@@ -126,130 +360,770 @@ class DicomService:
             logger.info("🎨 Creando imagen de error como fallback")
             return self._create_error_image_bytes(error_msg)
     
-    def _find_dicom_file_debug(self, file_path: str) -> str:
+    def _resolve_image_request(self, file_path: str, refresh: bool = True) -> str:
         """
-        Encuentra archivo DICOM con logging detallado
+        Validar y resolver la ruta pedida por el cliente
+        
+        Con refresh=False solo se consulta el mapa de rutas en memoria (desde
+        el event loop); el refresco del índice queda en su hilo.
         """
-        logger.info(f"🔍 === INICIO BÚSQUEDA DE ARCHIVO ===")
-        logger.info(f"🔍 Buscando: {file_path}")
+        # LOGGING DETALLADO DEL REQUEST
+        logger.debug(f"🔍 === INICIO PROCESAMIENTO IMAGEN ===")
+        logger.debug(f"🔍 file_path recibido: '{file_path}'")
+        logger.debug(f"🔍 tipo: {type(file_path)}")
+        logger.debug(f"🔍 longitud: {len(file_path) if file_path else 0}")
+        logger.debug(f"🔍 DICOM_FOLDER: {self.DICOM_FOLDER}")
         
-        # Normalizar separadores
-        normalized_path = file_path.replace('\\', '/')
-        logger.info(f"🔧 Ruta normalizada: {normalized_path}")
+        if not file_path:
+            raise ValueError("file_path está vacío")
         
-        # Estrategia 1: Ruta absoluta
-        if os.path.isabs(file_path):
-            logger.info(f"🔍 Estrategia 1: Ruta absoluta")
-            if os.path.exists(file_path):
-                logger.info(f"✅ Encontrado (absoluta): {file_path}")
-                return file_path
+        # Encontrar el archivo
+        full_path = self._find_dicom_file_debug(file_path, refresh)
+        if not full_path:
+            raise FileNotFoundError(f"Archivo DICOM no encontrado: {file_path}")
         
-        # Estrategia 2: Combinaciones directas
-        logger.info(f"🔍 Estrategia 2: Combinaciones directas")
-        possible_paths = [
-            os.path.join(self.DICOM_FOLDER, normalized_path),
-            os.path.join(self.DICOM_FOLDER, file_path),
-            file_path
-        ]
+        logger.debug(f"🎯 Archivo encontrado: {full_path}")
         
-        for i, path in enumerate(possible_paths, 1):
-            logger.info(f"🔍   Probando {i}: {path}")
-            if os.path.exists(path) and path.lower().endswith('.dcm'):
-                logger.info(f"✅ Encontrado (combinación {i}): {path}")
-                return path
+        # Verificar que existe
+        if not os.path.exists(full_path):
+            raise FileNotFoundError(f"El archivo no existe en el sistema: {full_path}")
         
-        # Estrategia 3: Búsqueda recursiva
-        logger.info(f"🔍 Estrategia 3: Búsqueda recursiva")
-        target_filename = os.path.basename(normalized_path)
-        logger.info(f"🔍 Buscando archivo: {target_filename}")
-        
-        matches_found = []
-        for root, dirs, files in os.walk(self.DICOM_FOLDER):
-            for file in files:
-                if file.lower().endswith('.dcm'):
-                    full_file_path = os.path.join(root, file)
-                    
-                    # Coincidencia exacta por nombre
-                    if file == target_filename:
-                        matches_found.append(('exact_name', full_file_path))
-                        logger.info(f"🎯 Coincidencia exacta: {full_file_path}")
-                    
-                    # Coincidencia por contenido de ruta
-                    elif normalized_path in full_file_path.replace('\\', '/'):
-                        matches_found.append(('path_contains', full_file_path))
-                        logger.info(f"🎯 Coincidencia parcial: {full_file_path}")
-        
-        # Preferir coincidencias exactas
-        for match_type, match_path in matches_found:
-            if match_type == 'exact_name':
-                logger.info(f"✅ Usando coincidencia exacta: {match_path}")
-                return match_path
-        
-        # Si no hay exactas, usar la primera parcial
-        for match_type, match_path in matches_found:
-            if match_type == 'path_contains':
-                logger.info(f"✅ Usando coincidencia parcial: {match_path}")
-                return match_path
-        
-        # Estrategia 4: Listado de archivos disponibles
-        logger.info(f"🔍 Estrategia 4: Listando archivos disponibles")
-        available_files = []
-        for root, dirs, files in os.walk(self.DICOM_FOLDER):
-            for file in files:
-                if file.lower().endswith('.dcm'):
-                    rel_path = os.path.relpath(os.path.join(root, file), self.DICOM_FOLDER)
-                    available_files.append(rel_path)
-        
-        logger.info(f"📋 Primeros 10 archivos disponibles:")
-        for i, avail_file in enumerate(available_files[:10], 1):
-            logger.info(f"   {i}. {avail_file}")
+        return full_path
+    
+    async def _resolve_timed(self, file_path: str) -> str:
+        """
+        Resolver en el event loop registrando la duración como etapa resolve
+        
+        Solo lee el mapa en memoria: si el índice está vencido se refresca en
+        segundo plano y este request usa el mapa actual.
+        """
+        await self._ensure_index_async()
+        started = time.perf_counter()
+        full_path = self._resolve_image_request(file_path, refresh=False)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        # Mismas etiquetas que las demás etapas, tomadas del mapa (sin leer el archivo)
+        modality, transfer_syntax = self.path_map.labels(full_path)
+        self.metrics.record_stage(
+            "resolve", elapsed_ms, modality or "N/A",
+            self._transfer_syntax_name(transfer_syntax) if transfer_syntax else "Unknown"
+        )
+        return full_path
+    
+    def _render_lookup(self, full_path: str, render_params: Dict[str, Any],
+                       check_disk: bool = True) -> tuple:
+        """Buscar en los caches de memoria y disco: devuelve (clave, bytes o None)"""
+        cache_key = self._render_cache_key(full_path, render_params)
+        return cache_key, self._cache_lookup(cache_key, check_disk, render_params.get('format', 'png'))
+    
+    def _cache_lookup(self, cache_key: tuple, check_disk: bool = True,
+                      extension: str = "png") -> Optional[bytes]:
+        """Buscar una imagen codificada en memoria y, si no está, en disco"""
+        cached = self.render_cache.get(cache_key)
+        if cached is not None:
+            logger.debug(f"⚡ Imagen servida desde cache: {len(cached)} bytes")
+            return cached
+        
+        if check_disk and self.disk_cache is not None:
+            cached = self.disk_cache.get(cache_key, extension)
+            if cached is not None:
+                logger.debug(f"⚡ Imagen servida desde cache de disco: {len(cached)} bytes")
+                self.render_cache.put(cache_key, cached)
+                return cached
         
-        logger.error(f"❌ Archivo no encontrado: {file_path}")
-        logger.info(f"🔍 === FIN BÚSQUEDA DE ARCHIVO ===")
         return None
     
-    def dicom_to_image_debug(self, file_path: str) -> bytes:
+    def _render_store(self, cache_key: tuple, result_bytes: bytes, extension: str = "png"):
+        """Guardar una imagen recién renderizada en ambos caches"""
+        self.render_cache.put(cache_key, result_bytes)
+        if self.disk_cache is not None:
+            self.disk_cache.put(cache_key, result_bytes, extension)
+    
+    def _convert(self, full_path: str, render_params: Dict[str, Any]) -> bytes:
+        """Pipeline completo sin cache"""
+        return self.dicom_to_image_debug(full_path, render_params)
+    
+    def _convert_timed(self, full_path: str, render_params: Dict[str, Any]) -> Tuple[bytes, StageTimings]:
         """
-        Convierte DICOM a imagen con logging detallado
+        Pipeline completo midiendo sus etapas (es lo que se ejecuta en el pool)
+        
+        Los tiempos vuelven junto con la imagen para acumularlos en el proceso
+        principal, también en modo "process".
+        """
+        with collect_stages() as timings:
+            result_bytes = self._convert(full_path, render_params)
+        return result_bytes, timings
+    
+    def _call_with_encodes(self, method_name: str, *args) -> Tuple[Any, List[Tuple[str, float, int]]]:
+        """Ejecutar un método en el pool devolviendo también sus codificaciones (MPR, slab)"""
+        with collect_stages() as timings:
+            result = getattr(self, method_name)(*args)
+        return result, timings.encodes
+    
+    def _record_timings(self, timings: StageTimings):
+        """Acumular en este proceso los tiempos de una conversión y sus codificaciones"""
+        self.metrics.record(timings)
+        for encode in timings.encodes:
+            self._add_encode_stats(*encode)
+    
+    def _render_cached(self, full_path: str, render_params: Dict[str, Any],
+                       check_disk: bool = True) -> bytes:
         """
+        Renderizar pasando por los caches: memoria -> disco -> conversión
+        """
+        cache_key, cached = self._render_lookup(full_path, render_params, check_disk)
+        if cached is not None:
+            return cached
+        
+        result_bytes, timings = self._convert_timed(full_path, render_params)
+        self._record_timings(timings)
+        self._render_store(cache_key, result_bytes, render_params.get('format', 'png'))
+        return result_bytes
+    
+    # ===== EJECUCIÓN FUERA DEL EVENT LOOP =====
+    
+    def _get_render_executor(self) -> Optional[Executor]:
+        """Crear el pool de renderizado la primera vez que se usa"""
+        if self.render_mode == "inline":
+            return None
+        if self._render_executor is None:
+            if self.render_mode == "process":
+                self._render_executor = ProcessPoolExecutor(
+                    max_workers=self.render_workers,
+                    initializer=_init_render_worker,
+                    initargs=(self.DICOM_FOLDER, self.CACHE_FOLDER)
+                )
+            else:
+                self._render_executor = ThreadPoolExecutor(
+                    max_workers=self.render_workers, thread_name_prefix="dicom-render"
+                )
+            logger.info(f"🧵 Pool de renderizado DICOM: modo={self.render_mode}, workers={self.render_workers}")
+        return self._render_executor
+    
+    async def _run_render(self, full_path: str, render_params: Dict[str, Any]) -> bytes:
+        """Ejecutar la conversión de un archivo en el pool y registrar sus tiempos"""
+        result_bytes, timings = await self._run_in_pool("_convert_timed", full_path, render_params)
+        self._record_timings(timings)
+        return result_bytes
+    
+    async def _run_in_pool(self, method_name: str, *args):
+        """
+        Ejecutar un método del servicio en el pool con cola acotada y timeout
+        
+        El contador de pendientes se libera cuando el trabajo termina de verdad
+        (no cuando vence el timeout), así la cola nunca supera el límite aunque
+        haya conversiones colgadas.
+        """
+        executor = self._get_render_executor()
+        if executor is None:
+            return getattr(self, method_name)(*args)
+        
+        if self._render_pending >= self.render_max_pending:
+            self.render_rejected += 1
+            raise DicomRenderBusyError(
+                f"Cola de renderizado llena ({self._render_pending}/{self.render_max_pending})"
+            )
+        
+        loop = asyncio.get_running_loop()
+        if self.render_mode == "process":
+            future = loop.run_in_executor(executor, _call_in_worker, method_name, *args)
+        else:
+            future = loop.run_in_executor(executor, getattr(self, method_name), *args)
+        
+        self._render_pending += 1
+        future.add_done_callback(self._on_render_done)
         try:
-            logger.info(f"🔄 === INICIO CONVERSIÓN ===")
-            logger.info(f"🔄 Procesando: {os.path.basename(file_path)}")
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.render_timeout)
+        except asyncio.TimeoutError:
+            self.render_timeouts += 1
+            future.cancel()
+            raise
+    
+    def _on_render_done(self, future):
+        self._render_pending -= 1
+    
+    async def _render_cached_async(self, full_path: str, render_params: Dict[str, Any],
+                                   check_disk: bool = True) -> bytes:
+        """
+        Igual que _render_cached pero la conversión corre en el pool
+        
+        Si ya hay un render en curso con la misma clave (archivo + parámetros)
+        se espera ese en vez de lanzar otro. El render corre en su propia task:
+        cancelar a quien lo inició (p. ej. la precarga) no afecta a los demás.
+        """
+        cache_key, cached = self._render_lookup(full_path, render_params, check_disk)
+        if cached is not None:
+            return cached
+        
+        task = self._inflight.get(cache_key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.render_coalesced += 1
+            logger.debug(f"🔗 Render en curso compartido: {os.path.basename(full_path)}")
+            return await asyncio.shield(task)
+        
+        task = asyncio.get_running_loop().create_task(self._render_and_store(cache_key, full_path, render_params))
+        self._inflight[cache_key] = task
+        self.render_started += 1
+        task.add_done_callback(lambda done: self._on_inflight_done(cache_key, done))
+        return await asyncio.shield(task)
+    
+    async def _render_and_store(self, cache_key: tuple, full_path: str, render_params: Dict[str, Any]) -> bytes:
+        result_bytes = await self._run_render(full_path, render_params)
+        self._render_store(cache_key, result_bytes, render_params.get('format', 'png'))
+        return result_bytes
+    
+    def _on_inflight_done(self, cache_key: tuple, task: asyncio.Task):
+        if self._inflight.get(cache_key) is task:
+            del self._inflight[cache_key]
+        # Marcar la excepción como leída aunque todos los que esperaban se hayan ido
+        if not task.cancelled():
+            task.exception()
+    
+    async def get_dicom_image_async(self, file_path: str,
+                                    render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Versión asíncrona de get_dicom_image para los endpoints
+        
+        DicomRenderBusyError y asyncio.TimeoutError se propagan para que el
+        endpoint responda 503/504; cualquier otro error devuelve la imagen de error.
+        """
+        try:
+            full_path = await self._resolve_timed(file_path)
+            render_params = render_params or {"format": "png"}
+            self._schedule_prefetch(full_path, render_params)
+            return await self._render_cached_async(full_path, render_params)
+        except (DicomRenderBusyError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            error_msg = f"Error procesando imagen DICOM: {str(e)}"
+            logger.error(f"💥 {error_msg}")
+            logger.error(f"💥 Traceback completo:\n{traceback.format_exc()}")
+            return self._create_error_image_bytes(error_msg)
+    
+    async def get_dicom_image_or_file_async(self, file_path: str,
+                                            render_params: Optional[Dict[str, Any]] = None
+                                            ) -> Tuple[Optional[BinaryIO], Optional[bytes]]:
+        """
+        Imagen para el endpoint resolviendo y renderizando una sola vez
+        
+        Devuelve (archivo abierto, None) si la imagen está en el cache de
+        disco, para enviarla desde ese descriptor (quien llama lo cierra), o
+        (None, bytes) si hubo que renderizarla o el cache de disco está
+        desactivado. El archivo se abre antes de responder: si otro worker lo
+        desaloja mientras se envía, el descriptor sigue siendo válido; si ya
+        no estaba, se renderiza. Igual que get_dicom_image_async,
+        DicomRenderBusyError y asyncio.TimeoutError se propagan y cualquier
+        otro error devuelve la imagen de error.
+        """
+        try:
+            full_path = await self._resolve_timed(file_path)
+            render_params = render_params or {"format": "png"}
+            self._schedule_prefetch(full_path, render_params)
             
-            # Leer DICOM
-            logger.info(f"📖 Leyendo archivo DICOM...")
-            ds = self._read_dicom_safely_debug(file_path)
-            logger.info(f"✅ Archivo DICOM leído correctamente")
+            if self.disk_cache is None:
+                return None, await self._render_cached_async(full_path, render_params)
             
-            # Obtener píxeles
-            logger.info(f"🖼️ Extrayendo píxeles...")
-            pixel_array = self._get_pixel_array_debug(ds, file_path)
+            cache_key = self._render_cache_key(full_path, render_params)
+            cached_file = await asyncio.get_running_loop().run_in_executor(
+                None, self.disk_cache.open_file, cache_key, render_params.get('format', 'png')
+            )
+            if cached_file is not None:
+                return cached_file, None
+            return None, await self._render_cached_async(full_path, render_params, check_disk=False)
+            
+        except (DicomRenderBusyError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            error_msg = f"Error procesando imagen DICOM: {str(e)}"
+            logger.error(f"💥 {error_msg}")
+            logger.error(f"💥 Traceback completo:\n{traceback.format_exc()}")
+            return None, self._create_error_image_bytes(error_msg)
+    
+    def _schedule_prefetch(self, full_path: str, render_params: Dict[str, Any]):
+        """Lanzar la precarga de la serie del corte pedido (si no está ya en curso)"""
+        if not self.prefetcher.enabled or self.prefetcher.is_active_for(full_path, render_params):
+            return
+        try:
+            series_uid, paths = self.index.get_series_paths(full_path)
+            if series_uid:
+                self.prefetcher.schedule(series_uid, paths, full_path, render_params)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo programar la precarga: {e}")
+    
+    def create_cine_session(self, series_uid: str, render_params: Optional[Dict[str, Any]] = None,
+                            fps: float = 20, loop: bool = True) -> CineSession:
+        """
+        Sesión de reproducción cine de una serie (en orden de InstanceNumber)
+        
+        Los frames pasan por los caches de imágenes y se renderizan en el pool.
+        """
+        self._ensure_index()
+        paths = self.index.get_series_instance_paths(series_uid)
+        if not paths:
+            raise FileNotFoundError(f"Serie no encontrada: {series_uid}")
+        return CineSession(
+            paths,
+            render=self._render_cached_async,
+            render_params=render_params or {"format": "png"},
+            fps=fps,
+            loop=loop,
+            render_ahead=int(os.getenv("DICOM_CINE_RENDER_AHEAD", "12")),
+            buffer_frames=int(os.getenv("DICOM_CINE_BUFFER_FRAMES", "64")),
+            busy_errors=(DicomRenderBusyError,)
+        )
+    
+    async def create_cine_session_async(self, series_uid: str, render_params: Optional[Dict[str, Any]] = None,
+                                        fps: float = 20, loop: bool = True) -> CineSession:
+        """Versión asíncrona de create_cine_session (la consulta de la serie corre fuera del event loop)"""
+        return await self._run_in_thread("create_cine_session", series_uid, render_params, fps=fps, loop=loop)
+    
+    def create_zip_export(self, series_uid: Optional[str] = None, study_uid: Optional[str] = None,
+                          mode: str = "rendered",
+                          render_params: Optional[Dict[str, Any]] = None) -> Tuple[ZipExport, str]:
+        """
+        Exportación ZIP en streaming de una serie o de un estudio completo
+        
+        Devuelve el exportador y el nombre sugerido del archivo. Las imágenes
+        pasan por los caches y el pool de render, igual que el cine.
+        """
+        if not series_uid and not study_uid:
+            raise ValueError("Debe indicar una serie o un estudio")
+        self._ensure_index()
+        series = self.index.get_export_series(series_uid=series_uid, study_uid=study_uid)
+        if not series:
+            raise FileNotFoundError(
+                f"Serie no encontrada: {series_uid}" if series_uid else f"Estudio no encontrado: {study_uid}"
+            )
+        
+        render_params = render_params or {"format": "png"}
+        paths_by_series = {info["series_uid"]: self.index.get_series_instance_paths(info["series_uid"])
+                           for info in series}
+        items = build_export_items(series, paths_by_series, mode, render_params.get("format", "png"))
+        
+        export = ZipExport(
+            items,
+            render=self._render_cached_async,
+            render_params=render_params,
+            mode=mode,
+            render_ahead=int(os.getenv("DICOM_EXPORT_RENDER_AHEAD", "8")),
+            busy_errors=(DicomRenderBusyError,),
+            manifest={"series_uid": series_uid, "study_uid": study_uid or series[0]["study_uid"],
+                      "series": series}
+        )
+        filename = safe_filename(f"{'serie' if series_uid else 'estudio'}_{series_uid or study_uid}") + ".zip"
+        logger.info(f"📦 Exportación ZIP ({mode}): {len(series)} series, {len(items)} instancias")
+        return export, filename
+    
+    async def create_zip_export_async(self, series_uid: Optional[str] = None, study_uid: Optional[str] = None,
+                                      mode: str = "rendered",
+                                      render_params: Optional[Dict[str, Any]] = None) -> Tuple[ZipExport, str]:
+        """Versión asíncrona de create_zip_export (la consulta de las series corre fuera del event loop)"""
+        return await self._run_in_thread("create_zip_export", series_uid=series_uid, study_uid=study_uid,
+                                         mode=mode, render_params=render_params)
+    
+    def get_render_pool_stats(self) -> Dict[str, Any]:
+        """Estado del pool de renderizado"""
+        return {
+            "mode": self.render_mode,
+            "workers": self.render_workers,
+            "started": self._render_executor is not None,
+            "pending": self._render_pending,
+            "max_pending": self.render_max_pending,
+            "timeout_seconds": self.render_timeout,
+            "rejected": self.render_rejected,
+            "timeouts": self.render_timeouts,
+            "renders_started": self.render_started,
+            "coalesced": self.render_coalesced,
+            "in_flight": len(self._inflight)
+        }
+    
+    def shutdown(self):
+        """Cancelar la precarga y cerrar el pool de renderizado"""
+        self.prefetcher.cancel()
+        if self._stats_executor is not None:
+            self._stats_executor.shutdown(wait=False, cancel_futures=True)
+            self._stats_executor = None
+        if self._index_executor is not None:
+            self._index_executor.shutdown(wait=False, cancel_futures=True)
+            self._index_executor = None
+        if self._transcode_executor is not None:
+            self._transcode_executor.shutdown(wait=False, cancel_futures=True)
+            self._transcode_executor = None
+        if self._render_executor is not None:
+            self._render_executor.shutdown(wait=False, cancel_futures=True)
+            self._render_executor = None
+            logger.info("🧵 Pool de renderizado DICOM cerrado")
+    
+    # ===== TRANSCODIFICACIÓN AL INDEXAR =====
+    
+    def schedule_transcode(self) -> bool:
+        """
+        Lanzar transcode_pending en segundo plano (un solo hilo coordinador)
+        
+        Devuelve False si está desactivado o ya hay una pasada en curso.
+        """
+        if not self.transcode_on_ingest:
+            return False
+        if self._transcode_future is not None and not self._transcode_future.done():
+            return False
+        if self._transcode_executor is None:
+            self._transcode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dicom-transcode")
+        self._transcode_future = self._transcode_executor.submit(self.transcode_pending)
+        return True
+    
+    def transcode_pending(self) -> Dict[str, Any]:
+        """
+        Decodificar una vez las instancias que no se pueden mapear con memmap
+        
+        Las candidatas son las instancias del índice con sintaxis de
+        transferencia comprimida que todavía no tienen copia (las sin
+        compresión se leen con memmap); se decodifican en un pool de procesos
+        propio, separado del de renderizado. Las copias de archivos borrados,
+        modificados o que ya no hacen falta se eliminan.
+        """
+        if not self._transcode_lock.acquire(blocking=False):
+            return {"status": "running"}
+        try:
+            self._ensure_index()
+            started = time.perf_counter()
+            keep = []
+            candidates = []
+            for path, transfer_syntax in self.index.get_paths_without_layout():
+                try:
+                    if not UID(transfer_syntax).is_compressed:
+                        continue
+                except ValueError:
+                    # Sintaxis privada o desconocida: pydicom tampoco sabría decodificarla
+                    continue
+                try:
+                    key = self.transcode_store.key_for(path, os.stat(path))
+                except OSError:
+                    continue
+                keep.append(key)
+                if not self.transcode_store.has(key):
+                    candidates.append(path)
+            pruned = self.transcode_store.prune(keep)
             
+            transcoded = 0
+            errors = 0
+            total_bytes = 0
+            if candidates:
+                logger.info(f"🔁 Transcodificando {len(candidates)} instancias comprimidas "
+                            f"({self.transcode_workers} workers)")
+                if self.transcode_workers > 1 and len(candidates) > 1:
+                    with ProcessPoolExecutor(
+                        max_workers=self.transcode_workers,
+                        initializer=_init_render_worker,
+                        initargs=(self.DICOM_FOLDER, self.CACHE_FOLDER)
+                    ) as executor:
+                        results = list(executor.map(
+                            _call_in_worker, repeat("transcode_instance"), candidates, chunksize=8
+                        ))
+                else:
+                    results = [self.transcode_instance(path) for path in candidates]
+                
+                for nbytes in results:
+                    if nbytes is None:
+                        errors += 1
+                    elif nbytes:
+                        transcoded += 1
+                        total_bytes += nbytes
+            
+            self.last_transcode = {
+                "status": "done",
+                "candidates": len(keep),
+                "transcoded": transcoded,
+                "errors": errors,
+                "pruned": pruned,
+                "bytes_written": total_bytes,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                "timestamp": datetime.now().isoformat()
+            }
+            if candidates:
+                logger.info(f"✅ Transcodificación: {transcoded} instancias, {total_bytes} bytes "
+                            f"({self.last_transcode['duration_ms']} ms)")
+            return self.last_transcode
+        finally:
+            self._transcode_lock.release()
+    
+    def transcode_instance(self, file_path: str) -> Optional[int]:
+        """
+        Decodificar una instancia y guardar sus píxeles almacenados (sin rescale)
+        
+        Devuelve los bytes escritos, 0 si no tiene píxeles y None si falló.
+        """
+        try:
+            st = os.stat(file_path)
+            ds = read_dicom_dataset(file_path, self.render_read_mode, force=True)
+            pixel_array = self._get_pixel_array_debug(ds, file_path)
             if pixel_array is None:
-                logger.warning("⚠️ No se pudieron extraer píxeles, usando fallback")
-                pixel_array = self._create_test_pattern_debug(512, 512)
+                return 0
+            return self.transcode_store.save(self.transcode_store.key_for(file_path, st), pixel_array)
+        except Exception as e:
+            logger.error(f"❌ Error transcodificando {file_path}: {e}")
+            return None
+    
+    def get_transcode_status(self) -> Dict[str, Any]:
+        """Estado de la transcodificación para health checks"""
+        return {
+            "enabled": self.transcode_on_ingest,
+            "workers": self.transcode_workers,
+            "running": self._transcode_lock.locked(),
+            "last_run": self.last_transcode,
+            "store": self.transcode_store.get_stats()
+        }
+    
+    # ===== VOLÚMENES 3D Y MPR =====
+    
+    def get_volume(self, series_uid: str) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """
+        Volumen (cortes, filas, columnas) de una serie, abierto con memmap
+        
+        La primera vez se ensambla desde los cortes decodificados y se guarda
+        en disco; después solo se abre el .npy.
+        """
+        self._ensure_index()
+        paths = self.index.get_series_instance_paths(series_uid)
+        if not paths:
+            raise FileNotFoundError(f"Serie no encontrada: {series_uid}")
+        
+        key = self.volume_store.key_for(series_uid, paths)
+        opened = self._volumes.get(key)
+        if opened is not None:
+            return opened
+        
+        with self._volume_lock:
+            opened = self.volume_store.load(key)
+            if opened is None:
+                opened = self._build_volume(key, series_uid, paths)
+        self._volumes.put(key, opened)
+        return opened
+    
+    def _build_volume(self, key: str, series_uid: str, paths: List[str]) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Ordenar cortes por ImagePositionPatient y apilarlos"""
+        logger.info(f"🧊 Construyendo volumen de la serie {series_uid} ({len(paths)} cortes)")
+        items = []
+        for path in paths:
+            ds = read_dicom_dataset(path, "header", force=True)
+            items.append((path, slice_geometry(ds)))
+        ordered, slice_spacing = sort_slices(items)
+        
+        decoded = [(path, self.get_decoded_slice(path)) for path in ordered]
+        decoded = [(path, d) for path, d in decoded if not d.is_color]
+        if not decoded:
+            raise ValueError("La serie no tiene cortes en escala de grises")
+        
+        # Descartar cortes con otra matriz (localizadores, reconstrucciones sueltas)
+        shape = Counter(d.pixels.shape for _, d in decoded).most_common(1)[0][0]
+        decoded = [(path, d) for path, d in decoded if d.pixels.shape == shape]
+        if len(decoded) < 2:
+            raise ValueError("La serie no tiene suficientes cortes compatibles para un volumen")
+        
+        geometry = dict(items)
+        first_path, first = decoded[0]
+        meta = {
+            "volume_key": key,
+            "series_uid": series_uid,
+            "paths": [path for path, _ in decoded],
+            "slice_spacing": slice_spacing,
+            "pixel_spacing": geometry[first_path]["pixel_spacing"] or [1.0, 1.0],
+            "window": list(first.window) if first.window else None,
+            "photometric": first.photometric,
+            "modality": first.modality
+        }
+        return self.volume_store.save(key, [d.pixels for _, d in decoded], meta)
+    
+    def get_volume_info(self, series_uid: str) -> Dict[str, Any]:
+        """Dimensiones, espaciado y número de cortes por plano"""
+        volume, meta = self.get_volume(series_uid)
+        info = {k: v for k, v in meta.items() if k != "paths"}
+        info["planes"] = {
+            "axial": volume.shape[0],
+            "coronal": volume.shape[1],
+            "sagittal": volume.shape[2]
+        }
+        return info
+    
+    async def get_volume_info_async(self, series_uid: str) -> Dict[str, Any]:
+        """Versión asíncrona de get_volume_info (la primera construcción es costosa)"""
+        return await self._run_in_pool("get_volume_info", series_uid)
+    
+    def render_mpr(self, series_uid: str, plane: str, index: int,
+                   render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Reformateo axial/coronal/sagital de un volumen como PNG
+        
+        El corte sale directamente del memmap; en coronal y sagital se
+        reescala la altura según el espaciado entre cortes para conservar
+        la proporción real.
+        """
+        render_params = render_params or {"format": "png"}
+        volume, meta = self.get_volume(series_uid)
+        pixels = reformat(volume, plane, index)
+        
+        cache_key = ("mpr", meta["volume_key"], plane, index, tuple(sorted(render_params.items())))
+        cached = self._cache_lookup(cache_key, extension=render_params.get('format', 'png'))
+        if cached is not None:
+            return cached
+        
+        result_bytes = self._encode_volume_plane(np.ascontiguousarray(pixels), meta, plane, render_params)
+        self._render_store(cache_key, result_bytes, render_params.get('format', 'png'))
+        return result_bytes
+    
+    def render_slab(self, series_uid: str, plane: str, index: int, thickness: int, mode: str,
+                    render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Proyección MIP / MinIP / promedio de un slab de `thickness` cortes
+        
+        La proyección (array) se cachea en el cache de píxeles por
+        (volumen, plano, rango, modo), así cambiar la ventana no vuelve a
+        reducir el slab; el PNG se cachea como cualquier otra imagen.
+        """
+        render_params = render_params or {"format": "png"}
+        volume, meta = self.get_volume(series_uid)
+        start, stop = slab_range(volume, plane, index, thickness)
+        
+        cache_key = ("slab", meta["volume_key"], plane, start, stop, mode, tuple(sorted(render_params.items())))
+        cached = self._cache_lookup(cache_key, extension=render_params.get('format', 'png'))
+        if cached is not None:
+            return cached
+        
+        projection_key = ("slab", meta["volume_key"], plane, start, stop, mode)
+        projection = self.pixel_cache.get(projection_key)
+        if projection is None:
+            projection = DecodedSlice(
+                pixels=project_slab(volume, plane, start, stop, mode),
+                window=tuple(meta["window"]) if meta.get("window") else None,
+                photometric=meta.get("photometric", ""),
+                modality=meta.get("modality", "N/A")
+            )
+            projection.pixels.setflags(write=False)
+            self.pixel_cache.put(projection_key, projection)
+            logger.info(f"🧊 Slab {mode} {plane} [{start}, {stop}) calculado")
+        
+        result_bytes = self._encode_volume_plane(projection.pixels, meta, plane, render_params)
+        self._render_store(cache_key, result_bytes, render_params.get('format', 'png'))
+        return result_bytes
+    
+    def _encode_volume_plane(self, pixels: np.ndarray, meta: Dict[str, Any], plane: str,
+                             render_params: Dict[str, Any]) -> bytes:
+        """Ventana + corrección de proporción + PNG de un plano del volumen"""
+        if render_params.get('size'):
+            pixels = downsample_area(pixels, render_params['size'])
+        decoded = DecodedSlice(
+            pixels=pixels,
+            window=tuple(meta["window"]) if meta.get("window") else None,
+            photometric=meta.get("photometric", ""),
+            modality=meta.get("modality", "N/A")
+        )
+        image = self._create_pil_image_debug(self._normalize_pixel_array_debug(decoded, render_params))
+        
+        row_spacing, col_spacing = plane_spacing(meta, plane)
+        if col_spacing > 0 and abs(row_spacing / col_spacing - 1) > 0.01:
+            height = max(1, round(image.height * row_spacing / col_spacing))
+            image = image.resize((image.width, height), Image.BILINEAR)
+        
+        return self._encode_image(image, render_params)
+    
+    async def render_mpr_async(self, series_uid: str, plane: str, index: int,
+                               render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """Versión asíncrona de render_mpr (corre en el pool de renderizado)"""
+        return await self._run_with_encodes("render_mpr", series_uid, plane, index, render_params)
+    
+    async def render_slab_async(self, series_uid: str, plane: str, index: int, thickness: int, mode: str,
+                                render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """Versión asíncrona de render_slab (corre en el pool de renderizado)"""
+        return await self._run_with_encodes("render_slab", series_uid, plane, index, thickness, mode, render_params)
+    
+    async def _run_with_encodes(self, method_name: str, *args) -> bytes:
+        """_run_in_pool acumulando aquí los tiempos de codificación del worker"""
+        result_bytes, encodes = await self._run_in_pool("_call_with_encodes", method_name, *args)
+        for encode in encodes:
+            self._add_encode_stats(*encode)
+        return result_bytes
+    
+    def _render_cache_key(self, full_path: str, render_params: Dict[str, Any]) -> tuple:
+        """
+        Clave de cache: ruta resuelta + mtime/tamaño del archivo + parámetros de render
+        
+        Si el archivo se reemplaza en disco cambia su mtime, así que la entrada
+        vieja deja de usarse y termina desalojada por el LRU.
+        """
+        st = os.stat(full_path)
+        return (
+            RENDER_VERSION,
+            os.path.abspath(full_path),
+            st.st_mtime_ns,
+            st.st_size,
+            tuple(sorted(render_params.items()))
+        )
+    
+    def _find_dicom_file_debug(self, file_path: str, refresh: bool = True) -> str:
+        """
+        Encuentra archivo DICOM con búsqueda O(1) en el mapa de rutas
+        """
+        logger.debug(f"🔍 === INICIO BÚSQUEDA DE ARCHIVO ===")
+        logger.debug(f"🔍 Buscando: {file_path}")
+        
+        # Estrategia 1: Mapa de rutas (ruta almacenada, absoluta o sufijo relativo)
+        if refresh:
+            self._ensure_path_map()
+        candidates = self.path_map.resolve(file_path)
+        if candidates:
+            if len(candidates) > 1:
+                logger.warning(
+                    f"⚠️ Ruta ambigua '{file_path}': {len(candidates)} coincidencias, "
+                    f"usando {candidates[0]} (otras: {candidates[1:4]})"
+                )
+            logger.debug(f"✅ Encontrado (mapa de rutas): {candidates[0]}")
+            return candidates[0]
+        
+        # Estrategia 2: Ruta absoluta o relativa fuera del índice
+        for path in (file_path, os.path.join(self.DICOM_FOLDER, file_path.replace('\\', '/'))):
+            if os.path.isfile(path) and path.lower().endswith('.dcm'):
+                logger.debug(f"✅ Encontrado (ruta directa): {path}")
+                return path
+        
+        logger.error(f"❌ Archivo no encontrado: {file_path}")
+        logger.debug(f"🔍 === FIN BÚSQUEDA DE ARCHIVO ===")
+        return None
+    
+    def _ensure_path_map(self):
+        """Reconstruir el mapa de rutas solo si el índice cambió"""
+        self._ensure_index()
+        if self.path_map.generation != self.index.generation:
+            self.path_map.rebuild(self.index.iter_path_labels(), self.index.generation)
+    
+    def dicom_to_image_debug(self, file_path: str, render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Convierte DICOM a imagen con logging detallado
+        
+        La lectura y decodificación pasan por el cache de píxeles, así cambiar
+        la ventana o el tamaño no vuelve a ejecutar dcmread ni pixel_array.
+        """
+        try:
+            logger.debug(f"🔄 === INICIO CONVERSIÓN ===")
+            logger.debug(f"🔄 Procesando: {os.path.basename(file_path)}")
             
-            logger.info(f"✅ Píxeles obtenidos: {pixel_array.shape if pixel_array is not None else 'None'}")
+            # Leer y decodificar (o tomar del cache de píxeles)
+            decoded = self.get_decoded_slice(file_path, render_params.get('size') if render_params else None)
+            set_labels(decoded.modality, self._transfer_syntax_name(decoded.transfer_syntax))
             
             # Normalizar
-            logger.info(f"🔧 Normalizando píxeles...")
-            normalized_array = self._normalize_pixel_array_debug(pixel_array, ds)
-            logger.info(f"✅ Píxeles normalizados: {normalized_array.shape}")
+            logger.debug(f"🔧 Normalizando píxeles...")
+            with stage("normalize"):
+                render_params = self._stats_window(file_path, decoded, render_params or {})
+                normalized_array = self._normalize_pixel_array_debug(decoded, render_params)
+            logger.debug(f"✅ Píxeles normalizados: {normalized_array.shape}")
             
             # Crear imagen PIL
-            logger.info(f"🎨 Creando imagen PIL...")
-            image = self._create_pil_image_debug(normalized_array)
-            logger.info(f"✅ Imagen PIL creada: {image.size}")
-            
-            # Convertir a PNG
-            logger.info(f"💾 Convirtiendo a PNG...")
-            img_buffer = io.BytesIO()
-            image.save(img_buffer, format='PNG', optimize=True)
-            img_buffer.seek(0)
-            result_bytes = img_buffer.getvalue()
+            logger.debug(f"🎨 Creando imagen PIL...")
+            with stage("pil"):
+                image = self._create_pil_image_debug(normalized_array)
+            logger.debug(f"✅ Imagen PIL creada: {image.size}")
             
-            logger.info(f"✅ PNG creado: {len(result_bytes)} bytes")
-            logger.info(f"🔄 === FIN CONVERSIÓN ===")
+            # Codificar (png / webp / jpeg)
+            result_bytes = self._encode_image(image, render_params)
+            logger.debug(f"🔄 === FIN CONVERSIÓN ===")
             
             return result_bytes
             
@@ -260,19 +1134,394 @@ class DicomService:
             logger.error(f"💥 Traceback:\n{error_trace}")
             raise
     
+    def _stats_window(self, file_path: str, decoded: DecodedSlice,
+                      render_params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ventana a partir de las estadísticas guardadas en el índice
+        
+        Con auto_window usa los percentiles 1-99; sin ventana en el request ni
+        en la cabecera usa el min/max guardado, en vez de recorrer el array.
+        Si el corte todavía no tiene estadísticas, este frame usa el min/max
+        de los píxeles ya decodificados y el histograma completo se calcula
+        y guarda en segundo plano, fuera del render.
+        """
+        if decoded.is_color or 'wc' in render_params:
+            return render_params
+        auto_window = render_params.get('auto_window')
+        if not auto_window and (decoded.window is not None or decoded.pixels.dtype == np.uint8):
+            return render_params
+        
+        st = os.stat(file_path)
+        stats = self.index.get_pixel_stats(file_path, st)
+        if stats is None:
+            self._schedule_slice_stats(file_path)
+            low, high = float(decoded.pixels.min()), float(decoded.pixels.max())
+            window = ((low + high) / 2, high - low + 1) if high > low else None
+        elif auto_window:
+            window = percentile_window(stats)
+        elif not stats.get("count") or stats["min"] >= stats["max"]:
+            return render_params
+        else:
+            window = ((stats["min"] + stats["max"]) / 2, stats["max"] - stats["min"] + 1)
+        
+        if window is None:
+            return render_params
+        logger.debug(f"📊 Ventana desde estadísticas: {window[0]:.1f}/{window[1]:.1f}")
+        return dict(render_params, wc=window[0], ww=window[1])
+    
+    def _schedule_slice_stats(self, file_path: str):
+        """Calcular y guardar en segundo plano las estadísticas de un corte (una vez por archivo)"""
+        with self._stats_lock:
+            if file_path in self._stats_pending:
+                return
+            self._stats_pending.add(file_path)
+            if self._stats_executor is None:
+                self._stats_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dicom-stats")
+            self._stats_executor.submit(self._record_slice_stats, file_path)
+    
+    def _record_slice_stats(self, file_path: str):
+        try:
+            self._slice_stats(file_path)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron calcular las estadísticas de {file_path}: {e}")
+        finally:
+            with self._stats_lock:
+                self._stats_pending.discard(file_path)
+    
+    def _count_decode(self, source: str):
+        with self._stats_lock:
+            self.decode_counts[source] += 1
+    
+    # ===== ESTADÍSTICAS E HISTOGRAMAS =====
+    
+    def _slice_stats(self, full_path: str) -> Dict[str, Any]:
+        """Estadísticas de un corte a resolución completa, guardadas en el índice"""
+        st = os.stat(full_path)
+        stats = self.index.get_pixel_stats(full_path, st)
+        if stats is None:
+            stats = pixel_statistics(self.get_decoded_slice(full_path).pixels)
+            self.index.set_pixel_stats(full_path, st, stats)
+        return stats
+    
+    def get_slice_stats(self, file_path: str) -> Dict[str, Any]:
+        """Histograma, min/max, media, percentiles y ventana automática de un corte"""
+        full_path = self._resolve_image_request(file_path)
+        stats = self._slice_stats(full_path)
+        window = percentile_window(stats)
+        return {
+            "file_name": os.path.basename(full_path),
+            "auto_window": {"center": window[0], "width": window[1]} if window else None,
+            **stats
+        }
+    
+    def get_series_stats(self, series_uid: str) -> Dict[str, Any]:
+        """
+        Estadísticas de una serie completa
+        
+        Los conteos por valor de cada corte (np.bincount) se suman, así el
+        resultado es exacto; de paso quedan guardadas las de cada corte. Las
+        series con valores no enteros se calculan sobre todos los píxeles.
+        """
+        self._ensure_index()
+        stats = self.index.get_series_stats(series_uid)
+        if stats is None:
+            paths = self.index.get_series_instance_paths(series_uid)
+            if not paths:
+                raise FileNotFoundError(f"Serie no encontrada: {series_uid}")
+            
+            logger.info(f"📊 Calculando estadísticas de la serie {series_uid} ({len(paths)} cortes)")
+            totals = None
+            base = None
+            float_parts = []
+            instances = 0
+            for path in paths:
+                decoded = self.get_decoded_slice(path)
+                if decoded.is_color:
+                    continue
+                instances += 1
+                counted = value_counts(decoded.pixels)
+                st = os.stat(path)
+                if self.index.get_pixel_stats(path, st) is None:
+                    slice_stats = (stats_from_counts(*counted) if counted is not None
+                                   else pixel_statistics(decoded.pixels))
+                    self.index.set_pixel_stats(path, st, slice_stats)
+                
+                if counted is None or (base is not None and (counted[0], counted[1].size) != (base, totals.size)):
+                    float_parts.append(decoded.pixels.reshape(-1).astype(np.float32))
+                elif totals is None:
+                    base, totals = counted[0], counted[1].copy()
+                else:
+                    totals += counted[1]
+            
+            if instances == 0:
+                raise ValueError("La serie no tiene cortes en escala de grises")
+            if float_parts:
+                if totals is not None:
+                    values = np.repeat(np.arange(base, base + totals.size, dtype=np.float32), totals)
+                    float_parts.append(values)
+                stats = stats_from_values(np.concatenate(float_parts))
+            else:
+                stats = stats_from_counts(base, totals)
+            stats["instances"] = instances
+            self.index.set_series_stats(series_uid, stats)
+        
+        window = percentile_window(stats)
+        return {
+            "series_uid": series_uid,
+            "auto_window": {"center": window[0], "width": window[1]} if window else None,
+            **stats
+        }
+    
+    async def get_slice_stats_async(self, file_path: str) -> Dict[str, Any]:
+        """Versión asíncrona de get_slice_stats (la decodificación corre en el pool)"""
+        return await self._run_in_pool("get_slice_stats", file_path)
+    
+    async def get_series_stats_async(self, series_uid: str) -> Dict[str, Any]:
+        """Versión asíncrona de get_series_stats (corre en el pool)"""
+        return await self._run_in_pool("get_series_stats", series_uid)
+    
+    def get_decoded_slice(self, file_path: str, size: Optional[int] = None) -> DecodedSlice:
+        """
+        Píxeles decodificados y reescalados de un archivo, vía cache de píxeles
+        
+        Con `size` devuelve un nivel de la pirámide (64/128/256): cada nivel se
+        genera por promedio de áreas a partir del nivel inmediatamente mayor,
+        con el lado mayor exactamente en `size`, y se cachea igual que el
+        corte completo.
+        """
+        st = os.stat(file_path)
+        cache_key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size, size)
+        
+        decoded = self.pixel_cache.get(cache_key)
+        if decoded is not None:
+            logger.debug(f"⚡ Píxeles desde cache: {decoded.pixels.shape} {decoded.pixels.dtype}")
+            return decoded
+        
+        if size is None:
+            decoded = self._decode_slice(file_path)
+        else:
+            larger = [level for level in PYRAMID_LEVELS if level > size]
+            source = self.get_decoded_slice(file_path, larger[0] if larger else None)
+            pixels = downsample_area(source.pixels, size)
+            if pixels is not source.pixels:
+                pixels.setflags(write=False)
+            decoded = dataclasses.replace(source, pixels=pixels)
+            logger.debug(f"🔽 Nivel {size}px generado: {pixels.shape}")
+        
+        self.pixel_cache.put(cache_key, decoded)
+        return decoded
+    
+    def _decode_slice(self, file_path: str) -> DecodedSlice:
+        """
+        Leer archivo -> pixel_array -> rescale
+        
+        Si el índice tiene el layout de PixelData (sintaxis sin compresión),
+        los píxeles se mapean con np.memmap sin pasar por pydicom; si hay una
+        copia transcodificada se abre esa; si no, se usa la decodificación
+        normal. Las instancias indexadas desde un DICOMDIR completan sus
+        metadatos y layout en esta primera lectura.
+        """
+        pixel_array = None
+        layout = self._get_pixel_layout(file_path) if self.memmap_enabled else None
+        if layout is not None:
+            with stage("dcmread"):
+                ds = read_dicom_dataset(file_path, "header", force=True)
+            with stage("decode"):
+                pixel_array = self._memmap_pixels(file_path, layout)
+        else:
+            with stage("decode"):
+                pixel_array = self.transcode_store.load(file_path, os.stat(file_path))
+            if pixel_array is not None:
+                with stage("dcmread"):
+                    ds = read_dicom_dataset(file_path, "header", force=True)
+                self._count_decode("transcoded")
+                logger.debug(f"📦 Píxeles desde copia transcodificada: {pixel_array.shape} {pixel_array.dtype}")
+        
+        if pixel_array is None:
+            # Leer DICOM
+            logger.debug(f"📖 Leyendo archivo DICOM...")
+            with stage("dcmread"):
+                ds = self._read_dicom_safely_debug(file_path)
+            logger.debug(f"✅ Archivo DICOM leído correctamente")
+            
+            # Obtener píxeles
+            logger.debug(f"🖼️ Extrayendo píxeles...")
+            with stage("decode"):
+                pixel_array = self._get_pixel_array_debug(ds, file_path)
+            self._count_decode("pydicom")
+        
+        if pixel_array is None:
+            logger.warning("⚠️ No se pudieron extraer píxeles, usando fallback")
+            pixel_array = self._create_test_pattern_debug(512, 512)
+        
+        logger.debug(f"✅ Píxeles obtenidos: {pixel_array.shape}")
+        
+        photometric = str(getattr(ds, 'PhotometricInterpretation', ''))
+        is_color = pixel_array.ndim == 3 and pixel_array.shape[-1] in (3, 4)
+        slope, intercept = (1.0, 0.0) if is_color else rescale_params(ds)
+        with stage("rescale"):
+            pixel_array = rescale_pixels(pixel_array, slope, intercept)
+        
+        pixel_array.setflags(write=False)
+        return DecodedSlice(
+            pixels=pixel_array,
+            window=header_window(ds),
+            photometric=photometric,
+            transfer_syntax=str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', 'Unknown')),
+            modality=str(getattr(ds, 'Modality', 'N/A')),
+            rescale=(slope, intercept)
+        )
+    
+    def _get_pixel_layout(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Layout de PixelData guardado en el índice (None si no hay o cambió el archivo)
+        
+        Las instancias que vienen de un DICOMDIR no tienen layout: la primera
+        vez se lee su cabecera, se calcula y se actualiza el índice.
+        """
+        try:
+            source = self.index.get_pixel_source(file_path, os.stat(file_path))
+            if source is None:
+                return None
+            if source["metadata_source"] == 'dicomdir':
+                metadata = self.extract_dicom_metadata(file_path)
+                self.index.update_metadata(file_path, metadata)
+                return metadata.get('pixel_layout')
+            return source["layout"]
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo consultar el layout de píxeles: {e}")
+            return None
+    
+    def _memmap_pixels(self, file_path: str, layout: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Píxeles como np.memmap de solo lectura (sin copia)"""
+        try:
+            pixel_array = np.memmap(
+                file_path, dtype=np.dtype(layout["dtype"]), mode='r',
+                offset=layout["offset"], shape=tuple(layout["shape"])
+            )
+        except (ValueError, OSError) as e:
+            logger.warning(f"⚠️ memmap falló, se usa pydicom: {e}")
+            return None
+        self._count_decode("memmap")
+        logger.debug(f"🗺️ Píxeles mapeados con memmap: {pixel_array.shape} {pixel_array.dtype}")
+        return pixel_array
+    
+    def get_raw_slice(self, file_path: str, size: Optional[int] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """
+        Píxeles decodificados sin codificar, para ventana/nivel en el cliente
+        
+        Devuelve el mismo buffer del cache de píxeles (little-endian,
+        C-contiguo; solo se copia si no lo es) y una cabecera con forma, dtype,
+        rescale aplicado y ventana por defecto.
+        """
+        full_path = self._resolve_image_request(file_path)
+        decoded = self.get_decoded_slice(full_path, size)
+        
+        pixels = decoded.pixels
+        little_endian = pixels.dtype.newbyteorder('<')
+        if pixels.dtype != little_endian:
+            pixels = pixels.astype(little_endian)
+        pixels = np.ascontiguousarray(pixels)
+        
+        header = {
+            "shape": list(pixels.shape),
+            "dtype": pixels.dtype.name,
+            "byte_order": "little",
+            "rescale_slope": decoded.rescale[0],
+            "rescale_intercept": decoded.rescale[1],
+            "rescale_applied": True,
+            "window": {"center": decoded.window[0], "width": decoded.window[1]} if decoded.window else None,
+            "min": float(pixels.min()),
+            "max": float(pixels.max()),
+            "photometric": decoded.photometric,
+            "modality": decoded.modality
+        }
+        return pixels, header
+    
+    async def get_raw_slice_async(self, file_path: str, size: Optional[int] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Versión asíncrona de get_raw_slice (la decodificación corre en el pool)"""
+        return await self._run_in_pool("get_raw_slice", file_path, size)
+    
+    def _encode_image(self, image: Image.Image, render_params: Optional[Dict[str, Any]] = None) -> bytes:
+        """
+        Codificar la imagen en el formato pedido y registrar el tiempo
+        
+        - png: compress_level configurable (DICOM_PNG_COMPRESS_LEVEL)
+        - webp: sin pérdida, esfuerzo bajo
+        - jpeg: calidad ajustable, para previews
+        """
+        render_params = render_params or {}
+        image_format = render_params.get('format', 'png')
+        
+        started = time.perf_counter()
+        img_buffer = io.BytesIO()
+        with stage("encode"):
+            if image_format == 'jpeg':
+                if image.mode not in ('L', 'RGB'):
+                    image = image.convert('RGB')
+                image.save(img_buffer, format='JPEG', quality=render_params.get('quality', DEFAULT_JPEG_QUALITY))
+            elif image_format == 'webp':
+                image.save(img_buffer, format='WEBP', lossless=True, quality=25, method=1)
+            else:
+                image.save(img_buffer, format='PNG', compress_level=self.png_compress_level)
+            result_bytes = img_buffer.getvalue()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        
+        # Dentro de una conversión medida el tiempo viaja con la imagen (también desde un worker)
+        if not record_encode(image_format, elapsed_ms, len(result_bytes)):
+            self._add_encode_stats(image_format, elapsed_ms, len(result_bytes))
+        
+        logger.debug(f"✅ {image_format.upper()} creado: {len(result_bytes)} bytes en {elapsed_ms:.1f} ms")
+        return result_bytes
+    
+    def _add_encode_stats(self, image_format: str, elapsed_ms: float, nbytes: int):
+        with self._stats_lock:
+            stats = self._encode_stats.setdefault(
+                image_format, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "total_bytes": 0}
+            )
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["total_bytes"] += nbytes
+    
+    @staticmethod
+    def _transfer_syntax_name(transfer_syntax: str) -> str:
+        """Nombre legible de una sintaxis de transferencia (el UID si no se conoce)"""
+        try:
+            return pydicom.uid.UID(transfer_syntax).name
+        except Exception:
+            return transfer_syntax
+    
+    def get_pipeline_stats(self) -> Dict[str, Any]:
+        """Latencias p50/p95/p99 por etapa del pipeline (global y por modalidad + sintaxis)"""
+        return dict(self.metrics.get_stats(), render_mode=self.render_mode, debug_logging=self.debug_logging)
+    
+    def get_encode_stats(self) -> Dict[str, Any]:
+        """Tiempos y tamaños medios de codificación por formato (incluye los workers del pool)"""
+        with self._stats_lock:
+            return {
+                image_format: {
+                    "count": stats["count"],
+                    "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+                    "max_ms": round(stats["max_ms"], 2),
+                    "avg_bytes": int(stats["total_bytes"] / stats["count"])
+                }
+                for image_format, stats in self._encode_stats.items()
+            }
+    
     def _read_dicom_safely_debug(self, file_path: str):
         """Lee DICOM con logging"""
         try:
-            logger.info(f"📖 Intento 1: Lectura normal")
-            ds = pydicom.dcmread(file_path)
-            logger.info(f"✅ Lectura normal exitosa")
+            logger.debug(f"📖 Intento 1: Lectura normal ({self.render_read_mode})")
+            ds = read_dicom_dataset(file_path, self.render_read_mode)
+            logger.debug(f"✅ Lectura normal exitosa")
             return ds
         except Exception as e1:
             logger.warning(f"⚠️ Intento 1 falló: {e1}")
             try:
-                logger.info(f"📖 Intento 2: Lectura con force=True")
-                ds = pydicom.dcmread(file_path, force=True)
-                logger.info(f"✅ Lectura con force exitosa")
+                logger.debug(f"📖 Intento 2: Lectura con force=True")
+                ds = read_dicom_dataset(file_path, self.render_read_mode, force=True)
+                logger.debug(f"✅ Lectura con force exitosa")
                 return ds
             except Exception as e2:
                 logger.error(f"❌ Intento 2 falló: {e2}")
@@ -286,17 +1535,17 @@ class DicomService:
                 logger.warning("⚠️ No hay PixelData")
                 return None
             
-            logger.info(f"📊 PixelData presente: {len(ds.PixelData)} bytes")
+            logger.debug(f"📊 PixelData presente: {len(ds.PixelData)} bytes")
             
             # Transfer Syntax
             transfer_syntax = getattr(ds, 'file_meta', {}).get('TransferSyntaxUID', 'Unknown')
-            logger.info(f"📋 Transfer Syntax: {transfer_syntax}")
+            logger.debug(f"📋 Transfer Syntax: {transfer_syntax}")
             
             # Intentar acceso directo
             try:
-                logger.info(f"🔄 Intento 1: Acceso directo")
+                logger.debug(f"🔄 Intento 1: Acceso directo")
                 pixel_array = ds.pixel_array
-                logger.info(f"✅ Acceso directo exitoso: {pixel_array.shape}")
+                logger.debug(f"✅ Acceso directo exitoso: {pixel_array.shape}")
                 return pixel_array
             except Exception as e1:
                 logger.warning(f"⚠️ Acceso directo falló: {e1}")
@@ -304,10 +1553,10 @@ class DicomService:
             # Intentar descompresión
             if hasattr(ds, 'decompress'):
                 try:
-                    logger.info(f"🔄 Intento 2: Descompresión")
+                    logger.debug(f"🔄 Intento 2: Descompresión")
                     ds.decompress()
                     pixel_array = ds.pixel_array
-                    logger.info(f"✅ Descompresión exitosa: {pixel_array.shape}")
+                    logger.debug(f"✅ Descompresión exitosa: {pixel_array.shape}")
                     return pixel_array
                 except Exception as e2:
                     logger.warning(f"⚠️ Descompresión falló: {e2}")
@@ -349,73 +1598,83 @@ class DicomService:
         logger.info(f"✅ Patrón de prueba creado")
         return pattern
     
-    def _normalize_pixel_array_debug(self, pixel_array, ds):
-        """Normaliza con logging"""
+    def _normalize_pixel_array_debug(self, decoded: DecodedSlice, render_params: Optional[Dict[str, Any]] = None):
+        """
+        Normaliza a uint8 aplicando la ventana con una LUT precalculada
+        
+        Los píxeles ya vienen reescalados. Prioridad de la ventana: parámetros
+        del request (wc/ww o preset), primer WindowCenter/WindowWidth de la
+        cabecera y, por último, min/max.
+        """
+        render_params = render_params or {}
+        pixel_array = decoded.pixels
         try:
-            logger.info(f"🔧 Tipo original: {pixel_array.dtype}")
-            
-            if pixel_array.dtype == np.uint8:
-                logger.info(f"✅ Ya está en uint8")
-                return pixel_array
+            logger.debug(f"🔧 Tipo original: {pixel_array.dtype}")
             
-            # Window/Level
-            if hasattr(ds, 'WindowCenter') and hasattr(ds, 'WindowWidth'):
-                try:
-                    wc = float(ds.WindowCenter[0] if isinstance(ds.WindowCenter, list) else ds.WindowCenter)
-                    ww = float(ds.WindowWidth[0] if isinstance(ds.WindowWidth, list) else ds.WindowWidth)
-                    logger.info(f"🪟 Window/Level: {wc}/{ww}")
-                    
-                    img_min = wc - ww // 2
-                    img_max = wc + ww // 2
-                    
-                    pixel_array = np.clip(pixel_array, img_min, img_max)
-                    pixel_array = ((pixel_array - img_min) / (img_max - img_min) * 255).astype(np.uint8)
-                    
-                    logger.info(f"✅ Normalización con Window/Level")
-                    return pixel_array
-                except Exception as we:
-                    logger.warning(f"⚠️ Error con Window/Level: {we}")
+            invert = bool(render_params.get('invert'))
+            if decoded.photometric == 'MONOCHROME1':
+                invert = not invert
             
-            # Normalización estándar
-            logger.info(f"🔧 Normalización estándar")
-            pixel_array = pixel_array.astype(np.float64)
-            p_min, p_max = pixel_array.min(), pixel_array.max()
-            logger.info(f"📊 Rango: {p_min} - {p_max}")
+            if decoded.is_color or (pixel_array.dtype == np.uint8 and 'wc' not in render_params):
+                logger.debug(f"✅ Ya está en uint8 / color")
+                if pixel_array.dtype != np.uint8:
+                    pixel_array = self._min_max_to_uint8(pixel_array)
+                return 255 - pixel_array if invert else pixel_array
             
-            if p_min < p_max:
-                pixel_array = (pixel_array - p_min) / (p_max - p_min) * 255
+            # Window/Level
+            if 'wc' in render_params:
+                window = (render_params['wc'], render_params['ww'])
             else:
-                pixel_array = np.full_like(pixel_array, 128)
+                window = decoded.window
+            
+            if window is None:
+                # Normalización estándar (rango completo de la imagen)
+                logger.debug(f"🔧 Normalización estándar")
+                p_min, p_max = float(pixel_array.min()), float(pixel_array.max())
+                logger.debug(f"📊 Rango: {p_min} - {p_max}")
+                if p_min >= p_max:
+                    return np.full(pixel_array.shape, 128, dtype=np.uint8)
+                window = ((p_min + p_max) / 2, p_max - p_min + 1)
             
-            result = pixel_array.astype(np.uint8)
-            logger.info(f"✅ Normalización completada")
+            wc, ww = window
+            logger.debug(f"🪟 Window/Level: {wc}/{ww} (invertir={invert})")
+            result = apply_window(pixel_array, 1.0, 0.0, wc, ww, invert)
+            logger.debug(f"✅ Normalización completada")
             return result
             
         except Exception as e:
             logger.error(f"💥 Error en normalización: {e}")
             return np.full((512, 512), 128, dtype=np.uint8)
     
+    def _min_max_to_uint8(self, pixel_array):
+        """Escalar min/max a 0-255 (imágenes a color que no vienen en uint8)"""
+        pixel_array = pixel_array.astype(np.float64)
+        p_min, p_max = pixel_array.min(), pixel_array.max()
+        if p_min >= p_max:
+            return np.full(pixel_array.shape, 128, dtype=np.uint8)
+        return ((pixel_array - p_min) / (p_max - p_min) * 255).astype(np.uint8)
+    
     def _create_pil_image_debug(self, pixel_array):
         """Crea imagen PIL con logging"""
         try:
-            logger.info(f"🎨 Forma del array: {pixel_array.shape}")
+            logger.debug(f"🎨 Forma del array: {pixel_array.shape}")
             
             if len(pixel_array.shape) == 2:
-                logger.info(f"📷 Modo: Escala de grises")
+                logger.debug(f"📷 Modo: Escala de grises")
                 image = Image.fromarray(pixel_array, mode='L')
             elif len(pixel_array.shape) == 3:
                 if pixel_array.shape[2] == 3:
-                    logger.info(f"📷 Modo: RGB")
+                    logger.debug(f"📷 Modo: RGB")
                     image = Image.fromarray(pixel_array, mode='RGB')
                 else:
-                    logger.info(f"📷 Modo: Primer canal como escala de grises")
+                    logger.debug(f"📷 Modo: Primer canal como escala de grises")
                     image = Image.fromarray(pixel_array[:,:,0], mode='L')
             else:
                 logger.warning(f"⚠️ Forma no reconocida, usando fallback")
                 fallback = np.zeros((512, 512), dtype=np.uint8)
                 image = Image.fromarray(fallback, mode='L')
             
-            logger.info(f"✅ Imagen PIL creada: {image.size}")
+            logger.debug(f"✅ Imagen PIL creada: {image.size}")
             return image
             
         except Exception as e:
@@ -461,68 +1720,173 @@ class DicomService:
             return buffer.getvalue()
     
     def extract_dicom_metadata(self, file_path: str) -> Dict[str, Any]:
-        """Extrae metadatos"""
+        """Extrae metadatos (solo cabecera, sin leer PixelData)"""
         try:
-            ds = pydicom.dcmread(file_path)
-            
-            def safe_get(attr, default="N/A"):
-                try:
-                    value = getattr(ds, attr, default)
-                    return str(value) if value else default
-                except:
-                    return default
-            
-            study_date = safe_get('StudyDate', '')
-            if study_date and len(study_date) == 8:
-                try:
-                    formatted_date = datetime.strptime(study_date, '%Y%m%d').strftime('%d/%m/%Y')
-                except:
-                    formatted_date = study_date
-            else:
-                formatted_date = study_date or 'N/A'
-            
-            return {
-                'patient_name': safe_get('PatientName', 'Paciente sin nombre'),
-                'patient_id': safe_get('PatientID'),
-                'patient_birth_date': safe_get('PatientBirthDate'),
-                'patient_sex': safe_get('PatientSex'),
-                'study_date': formatted_date,
-                'study_time': safe_get('StudyTime'),
-                'study_description': safe_get('StudyDescription'),
-                'series_description': safe_get('SeriesDescription'),
-                'modality': safe_get('Modality'),
-                'body_part': safe_get('BodyPartExamined'),
-                'institution': safe_get('InstitutionName', 'Hospital San José'),
-                'manufacturer': safe_get('Manufacturer'),
-                'model': safe_get('ManufacturerModelName'),
-                'rows': safe_get('Rows'),
-                'columns': safe_get('Columns'),
-                'pixel_spacing': safe_get('PixelSpacing'),
-                'slice_thickness': safe_get('SliceThickness'),
-                'window_center': safe_get('WindowCenter'),
-                'window_width': safe_get('WindowWidth'),
-                'file_name': os.path.basename(file_path)
-            }
+            ds = read_dicom_dataset(file_path, self.metadata_read_mode)
+            metadata = self._build_metadata(ds, file_path)
+            metadata['metadata_source'] = 'header'
+            metadata['transfer_syntax'] = str(getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', '')) or None
+            metadata['pixel_layout'] = pixel_layout(ds)
+            return metadata
             
         except Exception as e:
             logger.error(f"Error extrayendo metadatos: {e}")
             raise
     
+    def extract_dicomdir_metadata(self, dicomdir_path: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Metadatos de todas las instancias de un DICOMDIR en una sola lectura
+        
+        Cada instancia hereda los atributos de sus registros PATIENT / STUDY /
+        SERIES / IMAGE; las cabeceras de los archivos no se abren aquí.
+        """
+        fileset = FileSet(pydicom.dcmread(dicomdir_path))
+        base_folder = os.path.dirname(dicomdir_path)
+        
+        result = {}
+        for instance in fileset:
+            file_path = os.path.join(base_folder, os.path.relpath(instance.path, fileset.path))
+            metadata = self._build_metadata(instance, file_path)
+            metadata['metadata_source'] = 'dicomdir'
+            metadata['transfer_syntax'] = getattr(instance, 'ReferencedTransferSyntaxUIDInFile', None) or None
+            result[file_path] = metadata
+        return result
+    
+    def _build_metadata(self, source, file_path: str) -> Dict[str, Any]:
+        """Diccionario de metadatos a partir de un Dataset o de un registro de DICOMDIR"""
+        def safe_get(attr, default="N/A"):
+            try:
+                value = getattr(source, attr, default)
+                return str(value) if value else default
+            except:
+                return default
+        
+        study_date = safe_get('StudyDate', '')
+        if study_date and len(study_date) == 8:
+            try:
+                formatted_date = datetime.strptime(study_date, '%Y%m%d').strftime('%d/%m/%Y')
+            except:
+                formatted_date = study_date
+        else:
+            formatted_date = study_date or 'N/A'
+        
+        return {
+            'patient_name': safe_get('PatientName', 'Paciente sin nombre'),
+            'patient_id': safe_get('PatientID'),
+            'patient_birth_date': safe_get('PatientBirthDate'),
+            'patient_sex': safe_get('PatientSex'),
+            'study_date': formatted_date,
+            'study_time': safe_get('StudyTime'),
+            'study_description': safe_get('StudyDescription'),
+            'series_description': safe_get('SeriesDescription'),
+            'modality': safe_get('Modality'),
+            'body_part': safe_get('BodyPartExamined'),
+            'institution': safe_get('InstitutionName', 'Hospital San José'),
+            'manufacturer': safe_get('Manufacturer'),
+            'model': safe_get('ManufacturerModelName'),
+            'rows': safe_get('Rows'),
+            'columns': safe_get('Columns'),
+            'pixel_spacing': safe_get('PixelSpacing'),
+            'slice_thickness': safe_get('SliceThickness'),
+            'window_center': safe_get('WindowCenter'),
+            'window_width': safe_get('WindowWidth'),
+            'study_date_raw': study_date,
+            'study_instance_uid': safe_get('StudyInstanceUID'),
+            'series_instance_uid': safe_get('SeriesInstanceUID'),
+            'sop_instance_uid': safe_get('SOPInstanceUID', safe_get('ReferencedSOPInstanceUIDInFile')),
+            'series_number': safe_get('SeriesNumber'),
+            'instance_number': safe_get('InstanceNumber'),
+            'file_name': os.path.basename(file_path)
+        }
+    
+    def get_patients(self, cursor: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """Pacientes con conteo de estudios/series/instancias (paginado)"""
+        self._ensure_index()
+        return self.index.list_patients(cursor=cursor, limit=limit)
+    
+    async def get_patients_async(self, cursor: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """Versión asíncrona de get_patients (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("get_patients", cursor=cursor, limit=limit)
+    
+    def get_studies_page(self, patient_id: Optional[str] = None, cursor: Optional[str] = None,
+                         limit: int = 50) -> Dict[str, Any]:
+        """Estudios agrupados por StudyInstanceUID (paginado)"""
+        self._ensure_index()
+        return self.index.list_studies(patient_id=patient_id, cursor=cursor, limit=limit)
+    
+    async def get_studies_page_async(self, patient_id: Optional[str] = None, cursor: Optional[str] = None,
+                                     limit: int = 50) -> Dict[str, Any]:
+        """Versión asíncrona de get_studies_page (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("get_studies_page", patient_id=patient_id, cursor=cursor, limit=limit)
+    
+    def get_study_series(self, study_uid: str, cursor: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """Series de un estudio agrupadas por SeriesInstanceUID (paginado)"""
+        self._ensure_index()
+        return self.index.list_series(study_uid, cursor=cursor, limit=limit)
+    
+    async def get_study_series_async(self, study_uid: str, cursor: Optional[str] = None,
+                                     limit: int = 50) -> Dict[str, Any]:
+        """Versión asíncrona de get_study_series (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("get_study_series", study_uid, cursor=cursor, limit=limit)
+    
+    def get_series_instances(self, series_uid: str, cursor: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """Instancias de una serie ordenadas por InstanceNumber (paginado)"""
+        self._ensure_index()
+        return self.index.list_series_instances(series_uid, cursor=cursor, limit=limit)
+    
+    async def get_series_instances_async(self, series_uid: str, cursor: Optional[str] = None,
+                                         limit: int = 50) -> Dict[str, Any]:
+        """Versión asíncrona de get_series_instances (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("get_series_instances", series_uid, cursor=cursor, limit=limit)
+    
+    def search(self, level: str = "studies", patient_id: Optional[str] = None,
+               modality: Optional[str] = None, study_date: Optional[str] = None,
+               body_part: Optional[str] = None, description: Optional[str] = None,
+               fields: Optional[List[str]] = None, cursor: Optional[str] = None,
+               limit: int = 50) -> Dict[str, Any]:
+        """Búsqueda de estudios o series estilo QIDO sobre el índice (paginada)"""
+        self._ensure_index()
+        return self.index.search(
+            level=level, patient_id=patient_id, modality=modality, study_date=study_date,
+            body_part=body_part, description=description, fields=fields, cursor=cursor, limit=limit
+        )
+    
+    async def search_async(self, **filters) -> Dict[str, Any]:
+        """Versión asíncrona de search (la consulta corre fuera del event loop)"""
+        return await self._run_in_thread("search", **filters)
+    
     def get_dicom_metadata(self, file_name: str) -> Dict[str, Any]:
         """Obtiene metadatos de archivo específico"""
+        self._ensure_index()
+        metadata = self.index.get_instance(file_name)
+        if metadata is not None:
+            if metadata.get('metadata_source') == 'dicomdir':
+                # Indexado desde el DICOMDIR: leer la cabecera completa una vez
+                file_path = metadata['file_path']
+                metadata = self.extract_dicom_metadata(file_path)
+                self.index.update_metadata(file_path, metadata)
+                metadata.pop('pixel_layout', None)
+                metadata.pop('transfer_syntax', None)
+                metadata['file_path'] = file_path
+            return metadata
+        
         file_path = os.path.join(self.DICOM_FOLDER, file_name)
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"Archivo no encontrado: {file_path}")
-        return self.extract_dicom_metadata(file_path)
+        metadata = self.extract_dicom_metadata(file_path)
+        metadata.pop('pixel_layout', None)
+        metadata.pop('transfer_syntax', None)
+        return metadata
+    
+    async def get_dicom_metadata_async(self, file_name: str) -> Dict[str, Any]:
+        """Versión asíncrona de get_dicom_metadata (índice y cabecera se leen fuera del event loop)"""
+        return await self._run_in_thread("get_dicom_metadata", file_name)
     
     def test_dicom_processing(self) -> Dict[str, Any]:
         """Test del procesamiento"""
         try:
-            dicom_files = []
-            for root, dirs, files in os.walk(self.DICOM_FOLDER):
-                for file in files:
-                    if file.lower().endswith('.dcm'):
-                        dicom_files.append(os.path.join(root, file))
+            self._ensure_index()
+            dicom_files = [study['file_path'] for study in self.index.list_instances()]
             
             if not dicom_files:
                 return {
@@ -562,28 +1926,49 @@ class DicomService:
                 "message": str(e)
             }
     
+    async def test_dicom_processing_async(self) -> Dict[str, Any]:
+        """Versión asíncrona de test_dicom_processing (lee y convierte fuera del event loop)"""
+        return await self._run_in_thread("test_dicom_processing")
+    
+    def _index_refreshing(self) -> bool:
+        return self._index_future is not None and not self._index_future.done()
+    
     def health_check(self) -> Dict[str, Any]:
         """Health check"""
         try:
             folder_exists = os.path.exists(self.DICOM_FOLDER)
             
-            dicom_files = []
             if folder_exists:
-                for root, dirs, files in os.walk(self.DICOM_FOLDER):
-                    for file in files:
-                        if file.lower().endswith('.dcm'):
-                            dicom_files.append(os.path.join(root, file))
+                self._ensure_index()
             
             return {
                 "status": "healthy" if folder_exists else "warning",
                 "message": "Servicio DICOM con logging completo",
                 "dicom_folder": self.DICOM_FOLDER,
                 "folder_exists": folder_exists,
-                "dicom_files_found": len(dicom_files),
+                "dicom_files_found": self.index.count(),
                 "compression_support": {
                     "pylibjpeg": getattr(self, 'has_pylibjpeg', False),
                     "gdcm": getattr(self, 'has_gdcm', False)
                 },
+                "metadata_index": dict(self.index.get_status(), refreshing=self._index_refreshing()),
+                "path_map": self.path_map.get_stats(),
+                "pixel_cache": self.pixel_cache.get_stats(),
+                "prefetch": self.prefetcher.get_stats(),
+                "pixel_decode": dict(self.decode_counts, memmap_enabled=self.memmap_enabled),
+                "transcode": self.get_transcode_status(),
+                "read_modes": {
+                    "metadata": self.metadata_read_mode,
+                    "render": self.render_read_mode
+                },
+                "encoding": {
+                    "png_compress_level": self.png_compress_level,
+                    "formats": self.get_encode_stats()
+                },
+                "volumes": dict(self.volume_store.get_stats(), open=self._volumes.get_stats()["entries"]),
+                "render_cache": self.render_cache.get_stats(),
+                "disk_cache": self.disk_cache.get_stats() if self.disk_cache else None,
+                "render_pool": self.get_render_pool_stats(),
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -592,4 +1977,8 @@ class DicomService:
                 "status": "error",
                 "message": str(e),
                 "timestamp": datetime.now().isoformat()
-            }
\ No newline at end of file
+            }
+    
+    async def health_check_async(self) -> Dict[str, Any]:
+        """Versión asíncrona de health_check (consulta el índice fuera del event loop)"""
+        return await self._run_in_thread("health_check")
\ No newline at end of file
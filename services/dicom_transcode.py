@@ -0,0 +1,107 @@
+"""
+Copias internas sin compresión de instancias DICOM
+
+Las instancias comprimidas (JPEG Lossless, JPEG 2000, RLE...) se decodifican
+una sola vez al indexar y sus píxeles almacenados (antes del rescale) se
+guardan como .npy; las lecturas siguientes los abren con memmap y no vuelven
+a pasar por pylibjpeg/GDCM.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeStore:
+    """
+    Un .npy por instancia en `cache_dir`
+
+    El nombre depende de (ruta, mtime, tamaño) del DICOM original, así un
+    archivo modificado nunca reutiliza una copia vieja; `prune` borra las
+    que ya no corresponden a ninguna instancia.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.loads = 0
+        self.saves = 0
+        self.pruned = 0
+
+    @staticmethod
+    def key_for(path: str, st: os.stat_result) -> str:
+        """Digest de la copia según el estado actual del archivo"""
+        source = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, path: str, st: os.stat_result) -> Optional[np.ndarray]:
+        """Píxeles almacenados de una instancia (memmap de solo lectura) o None"""
+        try:
+            pixels = np.load(self._path(self.key_for(path, st)), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        with self._lock:
+            self.loads += 1
+        return pixels
+
+    def save(self, key: str, pixels: np.ndarray) -> int:
+        """Escribir la copia de forma atómica y devolver su tamaño en bytes"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-", suffix=".npy")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, np.ascontiguousarray(pixels))
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.saves += 1
+        return pixels.nbytes
+
+    def prune(self, keep: Iterable[str]) -> int:
+        """Borrar las copias cuyo digest no está en `keep`"""
+        keep = {key + ".npy" for key in keep}
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy") and name not in keep and not name.startswith(".tmp-"):
+                try:
+                    os.unlink(os.path.join(self.cache_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self.pruned += removed
+        if removed:
+            logger.info(f"🧹 {removed} copias transcodificadas obsoletas eliminadas")
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas para health checks"""
+        files = [entry for entry in os.scandir(self.cache_dir)
+                 if entry.name.endswith(".npy") and not entry.name.startswith(".tmp-")]
+        with self._lock:
+            return {
+                "cache_dir": self.cache_dir,
+                "files": len(files),
+                "bytes": sum(entry.stat().st_size for entry in files),
+                "loads": self.loads,
+                "saves": self.saves,
+                "pruned": self.pruned
+            }
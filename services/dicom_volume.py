@@ -0,0 +1,242 @@
+"""
+Volúmenes 3D y reconstrucción multiplanar (MPR)
+
+Una serie se ensambla una sola vez en un array (cortes, filas, columnas)
+ordenado por ImagePositionPatient y se guarda como .npy; las siguientes
+lecturas lo abren con memmap, así los reformateos son slices del array y no
+vuelven a leer los archivos DICOM.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PLANES = ("axial", "coronal", "sagittal")
+
+# Proyecciones de slab grueso
+PROJECTIONS = ("mip", "minip", "avg")
+
+
+def _float_list(value: Any, length: int) -> Optional[List[float]]:
+    """Convertir un atributo multivalor a lista de floats de largo fijo"""
+    try:
+        values = [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+    return values if len(values) == length else None
+
+
+def slice_geometry(ds) -> Dict[str, Any]:
+    """Geometría de un corte a partir de su cabecera"""
+    try:
+        instance_number = int(getattr(ds, 'InstanceNumber', 0) or 0)
+    except (TypeError, ValueError):
+        instance_number = 0
+    try:
+        thickness = float(getattr(ds, 'SliceThickness', 0) or 0)
+    except (TypeError, ValueError):
+        thickness = 0.0
+    return {
+        "position": _float_list(getattr(ds, 'ImagePositionPatient', None), 3),
+        "orientation": _float_list(getattr(ds, 'ImageOrientationPatient', None), 6),
+        "pixel_spacing": _float_list(getattr(ds, 'PixelSpacing', None), 2),
+        "thickness": thickness,
+        "instance_number": instance_number
+    }
+
+
+def sort_slices(items: Sequence[Tuple[str, Dict[str, Any]]]) -> Tuple[List[str], float]:
+    """
+    Ordenar cortes (ruta, geometría) a lo largo de la normal del plano
+
+    La posición de cada corte se proyecta sobre la normal (producto vectorial
+    de los cosenos de fila y columna). Solo se conservan los cortes con la
+    orientación mayoritaria (los localizadores mezclados en la serie quedan
+    fuera). Sin geometría se usa InstanceNumber. Devuelve las rutas ordenadas
+    y el espaciado entre cortes (mediana).
+    """
+    orientations = Counter(
+        tuple(round(v, 4) for v in geometry["orientation"])
+        for _, geometry in items if geometry["orientation"]
+    )
+    if orientations:
+        dominant = orientations.most_common(1)[0][0]
+        items = [
+            (path, geometry) for path, geometry in items
+            if geometry["orientation"] and tuple(round(v, 4) for v in geometry["orientation"]) == dominant
+        ]
+
+    first = items[0][1]
+    if first["orientation"] and all(geometry["position"] for _, geometry in items):
+        row, col = np.array(first["orientation"][:3]), np.array(first["orientation"][3:])
+        normal = np.cross(row, col)
+        keyed = sorted(
+            ((float(np.dot(geometry["position"], normal)), path) for path, geometry in items),
+            key=lambda item: item[0]
+        )
+        gaps = np.abs(np.diff([key for key, _ in keyed]))
+        gaps = gaps[gaps > 1e-6]
+        spacing = float(np.median(gaps)) if gaps.size else 0.0
+        paths = [path for _, path in keyed]
+    else:
+        paths = [path for path, _ in sorted(items, key=lambda item: (item[1]["instance_number"], item[0]))]
+        spacing = 0.0
+
+    if spacing <= 0:
+        spacing = first["thickness"] or 1.0
+    return paths, spacing
+
+
+def reformat(volume: np.ndarray, plane: str, index: int) -> np.ndarray:
+    """
+    Corte 2D de un volumen (cortes, filas, columnas)
+
+    En coronal y sagital el eje de cortes se invierte para que el último
+    corte (el más alto en una adquisición axial estándar) quede arriba.
+    """
+    if plane not in PLANES:
+        raise ValueError(f"Plano desconocido: {plane} (disponibles: {', '.join(PLANES)})")
+    axis = PLANES.index(plane)
+    if not 0 <= index < volume.shape[axis]:
+        raise IndexError(f"Índice {index} fuera de rango para {plane} (0-{volume.shape[axis] - 1})")
+    if plane == "axial":
+        return volume[index]
+    if plane == "coronal":
+        return volume[::-1, index, :]
+    return volume[::-1, :, index]
+
+
+def slab_range(volume: np.ndarray, plane: str, index: int, thickness: int) -> Tuple[int, int]:
+    """Rango [inicio, fin) de `thickness` cortes centrado en `index`, recortado al volumen"""
+    if plane not in PLANES:
+        raise ValueError(f"Plano desconocido: {plane} (disponibles: {', '.join(PLANES)})")
+    if thickness < 1:
+        raise ValueError("thickness debe ser >= 1")
+    count = volume.shape[PLANES.index(plane)]
+    if not 0 <= index < count:
+        raise IndexError(f"Índice {index} fuera de rango para {plane} (0-{count - 1})")
+    start = max(0, min(index - thickness // 2, count - thickness))
+    return start, min(count, start + thickness)
+
+
+def project_slab(volume: np.ndarray, plane: str, start: int, stop: int, mode: str) -> np.ndarray:
+    """
+    Proyección MIP / MinIP / promedio de los cortes [start, stop) de un plano
+
+    Una sola reducción de numpy sobre el eje del plano; la orientación del
+    resultado es la misma que la de `reformat`.
+    """
+    if mode not in PROJECTIONS:
+        raise ValueError(f"Proyección desconocida: {mode} (disponibles: {', '.join(PROJECTIONS)})")
+    axis = PLANES.index(plane)
+    slab = volume[(slice(None),) * axis + (slice(start, stop),)]
+
+    if mode == "mip":
+        projected = slab.max(axis=axis)
+    elif mode == "minip":
+        projected = slab.min(axis=axis)
+    else:
+        projected = slab.mean(axis=axis, dtype=np.float32)
+
+    return projected if plane == "axial" else projected[::-1]
+
+
+def plane_spacing(meta: Dict[str, Any], plane: str) -> Tuple[float, float]:
+    """Espaciado (filas, columnas) en mm del plano pedido"""
+    slice_spacing = meta["slice_spacing"]
+    row_spacing, col_spacing = meta["pixel_spacing"]
+    if plane == "axial":
+        return row_spacing, col_spacing
+    if plane == "coronal":
+        return slice_spacing, col_spacing
+    return slice_spacing, row_spacing
+
+
+class VolumeStore:
+    """
+    Volúmenes en disco: <digest>.npy (píxeles) + <digest>.json (metadatos)
+
+    El digest depende de la serie y de (ruta, mtime, tamaño) de cada corte,
+    así un archivo modificado produce un volumen nuevo. El .json se escribe
+    al final y hace de marca de volumen completo.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.builds = 0
+        self.loads = 0
+
+    @staticmethod
+    def key_for(series_uid: str, paths: Sequence[str]) -> str:
+        """Digest del volumen según el estado actual de los archivos"""
+        digest = hashlib.sha256(series_uid.encode('utf-8'))
+        for path in sorted(paths):
+            st = os.stat(path)
+            digest.update(f"{path}|{st.st_mtime_ns}|{st.st_size}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return base + ".npy", base + ".json"
+
+    def load(self, key: str) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+        """Abrir un volumen ya construido (memmap de solo lectura)"""
+        npy_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            volume = np.load(npy_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        with self._lock:
+            self.loads += 1
+        return volume, meta
+
+    def save(self, key: str, slices: Sequence[np.ndarray], meta: Dict[str, Any]) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Escribir el volumen corte a corte y devolverlo abierto con memmap"""
+        npy_path, meta_path = self._paths(key)
+        dtype = np.result_type(*[s.dtype for s in slices])
+        shape = (len(slices),) + slices[0].shape
+
+        fd, tmp_npy = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-", suffix=".npy")
+        os.close(fd)
+        try:
+            out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=dtype, shape=shape)
+            for i, pixels in enumerate(slices):
+                out[i] = pixels
+            out.flush()
+            del out
+            os.replace(tmp_npy, npy_path)
+
+            meta = dict(meta, shape=list(shape), dtype=str(dtype))
+            fd, tmp_meta = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-", suffix=".json")
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(meta, file, ensure_ascii=False)
+            os.replace(tmp_meta, meta_path)
+        except Exception:
+            try:
+                os.unlink(tmp_npy)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self.builds += 1
+        logger.info(f"🧊 Volumen guardado: {shape} {dtype} ({os.path.getsize(npy_path)} bytes)")
+        return np.load(npy_path, mmap_mode='r'), meta
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas para health checks"""
+        with self._lock:
+            return {"cache_dir": self.cache_dir, "builds": self.builds, "loads": self.loads}
@@ -0,0 +1,86 @@
+"""
+Paginación por cursor de la búsqueda del índice DICOM
+"""
+import os
+
+import pytest
+
+from services.dicom_index import DicomIndex, decode_cursor
+
+# (paciente, estudio, fecha, serie, modalidad, parte del cuerpo)
+SERIES = [
+    ("P1", "1.1", "20240101", "1.1.1", "CT", "HEAD"),
+    ("P1", "1.1", "20240101", "1.1.2", "MR", "HEAD"),
+    ("P1", "1.2", "20240215", "1.2.1", "CT", "CHEST"),
+    ("P2", "2.1", "20240310", "2.1.1", "CT", "ABDOMEN"),
+    ("P2", "2.2", "20240402", "2.2.1", "MR", "KNEE"),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    folder = tmp_path / "dicom"
+    metadata = {}
+    for patient_id, study_uid, study_date, series_uid, modality, body_part in SERIES:
+        for number in (1, 2):
+            path = folder / series_uid / f"{number}.dcm"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"")
+            metadata[str(path)] = {
+                "patient_id": patient_id,
+                "patient_name": f"Paciente {patient_id}",
+                "study_instance_uid": study_uid,
+                "study_date_raw": study_date,
+                "series_instance_uid": series_uid,
+                "series_number": series_uid.rsplit(".", 1)[1],
+                "instance_number": number,
+                "modality": modality,
+                "body_part": body_part,
+            }
+
+    index = DicomIndex(str(tmp_path / "index.sqlite3"), str(folder))
+    index.sync(lambda path: dict(metadata[os.path.normpath(path)]))
+    return index
+
+
+def _page_all(index, level, **filters):
+    items, cursor = [], None
+    while True:
+        page = index.search(level=level, cursor=cursor, limit=1, **filters)
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items, page["total"]
+
+
+# Los campos calculados con subconsultas llevan su propio WHERE dentro del SELECT
+@pytest.mark.parametrize("level, key, fields, expected", [
+    ("studies", "study_uid", None, {"1.1", "1.2", "2.1", "2.2"}),
+    ("studies", "study_uid", ["study_uid", "patient_name", "body_parts"], {"1.1", "1.2", "2.1", "2.2"}),
+    ("series", "series_uid", None, {series[3] for series in SERIES}),
+    ("series", "series_uid", ["series_uid", "patient_id", "study_date"], {series[3] for series in SERIES}),
+])
+def test_unfiltered_search_pages_through_every_item(index, level, key, fields, expected):
+    items, total = _page_all(index, level, fields=fields)
+    uids = [item[key] for item in items]
+    assert len(uids) == total == len(expected)
+    assert set(uids) == expected
+
+
+def test_filtered_search_pages_with_cursor(index):
+    items, total = _page_all(index, "series", modality="CT")
+    assert total == 3
+    assert [item["series_uid"] for item in items] == ["1.1.1", "1.2.1", "2.1.1"]
+
+
+def test_instance_cursor_does_not_expose_absolute_path(index, tmp_path):
+    numbers, cursor = [], None
+    while True:
+        page = index.list_series_instances("1.1.1", cursor=cursor, limit=1)
+        numbers += [item["instance_number"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+        key = decode_cursor(cursor)
+        assert not any(str(tmp_path) in str(value) for value in key)
+    assert numbers == [1, 2]